@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Front end AsyncTeleBot con gli handler sincroni eseguiti in un pool di thread.
+
+Solo la parte di rete verso Telegram è asincrona: il polling e le chiamate
+all'API girano sull'event loop di AsyncTeleBot. Gli handler di handlers.py e
+callbacks.py restano quelli sincroni e girano in un ThreadPoolExecutor di
+ASYNC_MAX_CONCURRENT_UPDATES thread, parlando con Telegram attraverso
+SyncBotBridge; il database è il DatabaseManager sincrono (sqlite3), con le
+stesse connessioni e cache del runtime a thread.
+
+Gli update sono quindi elaborati in parallelo fino al numero di thread del
+pool: un handler lento occupa un thread, non l'intero bot, ma non ci sono
+handler né accessi al database nativamente asincroni.
+"""
+
+import asyncio
+import functools
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from telebot import apihelper, asyncio_helper
+from telebot.async_telebot import AsyncTeleBot
+
+from config import BOT_TOKEN, ASYNC_MAX_CONCURRENT_UPDATES
+from database import db_manager
+from outbox import outbox_dispatcher
+
+logger = logging.getLogger(__name__)
+
+class SyncBotBridge:
+    """Espone i metodi di AsyncTeleBot come chiamate bloccanti per i thread worker.
+
+    Gli errori di Telegram sono rilanciati come telebot.apihelper.ApiTelegramException,
+    la stessa classe del runtime sincrono, così retry e gestione degli utenti
+    irraggiungibili funzionano allo stesso modo.
+    """
+
+    def __init__(self, async_bot, loop):
+        self.async_bot = async_bot
+        self.loop = loop
+
+    def __getattr__(self, name):
+        attr = getattr(self.async_bot, name)
+        if not asyncio.iscoroutinefunction(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def call(*args, **kwargs):
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is self.loop:
+                raise RuntimeError(f"{name}() bloccante chiamato dall'event loop: usa 'await async_bot.{name}()'")
+            future = asyncio.run_coroutine_threadsafe(attr(*args, **kwargs), self.loop)
+            try:
+                return future.result()
+            except asyncio_helper.ApiTelegramException as e:
+                raise apihelper.ApiTelegramException(e.function_name, e.result, e.result_json) from e
+
+        return call
+
+def make_async_handler(handler, bridge, executor, semaphore):
+    """Versione asincrona di un handler sincrono: gira nel pool senza bloccare il loop"""
+    @functools.wraps(handler)
+    async def run_handler(update):
+        async with semaphore:
+            loop = asyncio.get_running_loop()
+            try:
+                await loop.run_in_executor(executor, handler, bridge, update)
+            except Exception as e:
+                logger.error(f"Errore nell'handler {handler.__name__}: {str(e)}")
+    return run_handler
+
+async def _main(register_handlers):
+    loop = asyncio.get_running_loop()
+    executor = ThreadPoolExecutor(max_workers=ASYNC_MAX_CONCURRENT_UPDATES, thread_name_prefix="handler")
+    semaphore = asyncio.Semaphore(ASYNC_MAX_CONCURRENT_UPDATES)
+
+    await loop.run_in_executor(executor, db_manager.init_db)
+    await loop.run_in_executor(executor, db_manager.upgrade_db)
+
+    async_bot = AsyncTeleBot(BOT_TOKEN)
+    bridge = SyncBotBridge(async_bot, loop)
+    register_handlers(async_bot, lambda handler: make_async_handler(handler, bridge, executor, semaphore))
+    await async_bot.remove_webhook()
+
+    # Il dispatcher dell'outbox gira nel suo thread e usa il bridge per inviare
+    outbox_dispatcher.start(bridge)
+
+    logger.info("Bot avviato (front end AsyncTeleBot) – in attesa di comandi.")
+    try:
+        await async_bot.infinity_polling()
+    finally:
+        # stop() attende il thread del dispatcher, che può avere bisogno del loop
+        await loop.run_in_executor(None, outbox_dispatcher.stop)
+        executor.shutdown(wait=True)
+        await async_bot.close_session()
+
+def run(register_handlers):
+    """Avvia il bot con il front end AsyncTeleBot"""
+    asyncio.run(_main(register_handlers))
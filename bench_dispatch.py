@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Micro-benchmark della latenza di smistamento: Router a dizionari contro la
+vecchia catena di predicati valutati in ordine di registrazione.
+
+Uso: python bench_dispatch.py [numero_rotte]
+"""
+
+import sys
+import timeit
+from types import SimpleNamespace
+
+from router import Router
+
+def noop(bot, update):
+    pass
+
+def make_message(chat_id, text=None, content_type="text"):
+    return SimpleNamespace(chat=SimpleNamespace(id=chat_id), text=text, content_type=content_type)
+
+def build_routes(n):
+    """n comandi, n callback e n/4 stati di input con nomi sintetici"""
+    commands = [f"cmd{i}" for i in range(n)]
+    prefixes = [f"cb{i}" for i in range(n)]
+    states = [f"state{i}" for i in range(max(1, n // 4))]
+    return commands, prefixes, states
+
+def build_router(commands, prefixes, states, chat_states):
+    router = Router(state_of=chat_states.get)
+    for name in commands:
+        router.command(name, noop)
+    for name in states:
+        router.state(name, noop)
+    for prefix in prefixes:
+        router.callback(prefix, noop)
+    router.content("photo", noop)
+    return router
+
+def build_chain(commands, prefixes, states, chat_states):
+    """Replica della registrazione precedente: lista di (handler, predicato)"""
+    messages = []
+    for name in commands:
+        messages.append((noop, lambda m, name=name: m.content_type == "text"
+                         and Router.extract_command(m.text) == name))
+    for name in states:
+        # Un dizionario per stato, come i vecchi has_pending_*()
+        pending = {cid for cid, st in chat_states.items() if st == name}
+        messages.append((noop, lambda m, pending=pending: m.content_type == "text" and m.chat.id in pending))
+    messages.append((noop, lambda m: m.content_type == "photo"))
+    calls = [(noop, lambda c, prefix=prefix + "|": c.data.startswith(prefix)) for prefix in prefixes]
+    return messages, calls
+
+def chain_dispatch(chain, update):
+    for handler, predicate in chain:
+        if predicate(update):
+            handler(None, update)
+            return True
+    return False
+
+def run(n=60, number=20000):
+    commands, prefixes, states = build_routes(n)
+    chat_states = {1000 + i: name for i, name in enumerate(states)}
+    router = build_router(commands, prefixes, states, chat_states)
+    msg_chain, call_chain = build_chain(commands, prefixes, states, chat_states)
+
+    # Casi peggiori per la catena: ultima rotta registrata
+    samples = {
+        "comando (ultimo)": make_message(1, f"/{commands[-1]} arg"),
+        "stato di input (ultimo)": make_message(1000 + len(states) - 1, "testo libero"),
+        "foto": make_message(1, content_type="photo"),
+    }
+    call = SimpleNamespace(data=f"{prefixes[-1]}|42")
+
+    print(f"{n} comandi, {n} callback, {len(states)} stati – {number} iterazioni\n")
+    print(f"{'caso':<26}{'router µs':>12}{'catena µs':>12}")
+    for label, msg in samples.items():
+        t_router = timeit.timeit(lambda: router.dispatch_message(None, msg), number=number)
+        t_chain = timeit.timeit(lambda: chain_dispatch(msg_chain, msg), number=number)
+        print(f"{label:<26}{t_router / number * 1e6:>12.2f}{t_chain / number * 1e6:>12.2f}")
+    t_router = timeit.timeit(lambda: router.dispatch_callback(None, call), number=number)
+    t_chain = timeit.timeit(lambda: chain_dispatch(call_chain, call), number=number)
+    print(f"{'callback (ultima)':<26}{t_router / number * 1e6:>12.2f}{t_chain / number * 1e6:>12.2f}")
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 60)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import time
+import logging
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor, wait
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+
+from config import BROADCAST_MODE
+
+logger = logging.getLogger(__name__)
+
+# Limiti di Telegram: ~30 messaggi/s in totale, ~1 messaggio/s per singola chat
+GLOBAL_RATE = 30
+GLOBAL_BURST = 30
+PER_CHAT_RATE = 1
+PER_CHAT_BURST = 2
+MAX_WORKERS = 8
+MAX_RETRIES = 3
+
+# Lunghezza massima della didascalia di un media e numero massimo di media per album
+CAPTION_LIMIT = 1024
+ALBUM_SIZE = 10
+
+# Errori che indicano un utente non più raggiungibile
+UNREACHABLE_KEYWORDS = ("blocked", "not found", "deactivated")
+
+# ————— PAYLOAD —————
+def text_payload(text, parse_mode=None):
+    """Crea il payload per un messaggio di testo"""
+    return {"method": "send_message", "params": {"text": text, "parse_mode": parse_mode}}
+
+def media_payload(media_type, file_id, caption=None, parse_mode=None):
+    """Crea il payload per una foto o un video"""
+    if media_type == "video":
+        return {"method": "send_video", "params": {"video": file_id, "caption": caption, "parse_mode": parse_mode}}
+    return {"method": "send_photo", "params": {"photo": file_id, "caption": caption, "parse_mode": parse_mode}}
+
+def album_payload(items):
+    """Crea il payload di un album; items: dict con file_id, media_type e caption"""
+    return {"method": "send_media_group", "params": {"media": [
+        {"type": "video" if it["media_type"] == "video" else "photo", "media": it["file_id"], "caption": it.get("caption")}
+        for it in items
+    ]}}
+
+def _call_params(payload):
+    # Gli album viaggiano come dict serializzabili e diventano InputMedia solo all'invio
+    params = payload["params"]
+    if payload["method"] != "send_media_group":
+        return params
+    media = [
+        (types.InputMediaVideo if m["type"] == "video" else types.InputMediaPhoto)(m["media"], caption=m.get("caption"))
+        for m in params["media"]
+    ]
+    return dict(params, media=media)
+
+def announcement_payloads(media_type, file_id, text, caption=None, parse_mode=None, mode=None):
+    """Payload di un annuncio con media.
+
+    In modalità "caption" testo e media partono in un'unica chiamata; se il testo
+    supera il limite della didascalia si ricade sull'invio separato.
+    """
+    mode = mode or BROADCAST_MODE
+    if mode == "caption" and len(text) <= CAPTION_LIMIT:
+        return [media_payload(media_type, file_id, caption=text, parse_mode=parse_mode)]
+    return [
+        text_payload(text, parse_mode=parse_mode),
+        media_payload(media_type, file_id, caption=caption)
+    ]
+
+# ————— RATE LIMIT —————
+class TokenBucket:
+    """Token bucket thread-safe: acquire() attende finché un token è disponibile"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                self._refill(time.monotonic())
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def is_idle(self, now):
+        with self.lock:
+            self._refill(now)
+            return self.tokens >= self.capacity
+
+class DeliveryReport:
+    """Esito di un invio massivo"""
+
+    def __init__(self):
+        self.sent = []
+        self.failed = {}  # chiave → descrizione errore
+        self.blocked = []  # chiavi destinate a chat non più raggiungibili
+        self.retries = 0
+        self.started = time.monotonic()
+        self.elapsed = 0.0
+        self.lock = Lock()
+
+    @property
+    def sent_count(self):
+        return len(self.sent)
+
+    @property
+    def total(self):
+        return len(self.sent) + len(self.failed) + len(self.blocked)
+
+    def __repr__(self):
+        return (f"DeliveryReport(sent={len(self.sent)}, failed={len(self.failed)}, "
+                f"blocked={len(self.blocked)}, retries={self.retries}, elapsed={self.elapsed:.2f}s)")
+
+# ————— MOTORE DI BROADCAST —————
+class BroadcastEngine:
+    """Invia messaggi a più chat in parallelo rispettando i limiti di Telegram"""
+
+    def __init__(self, max_workers=MAX_WORKERS, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 per_chat_rate=PER_CHAT_RATE, per_chat_burst=PER_CHAT_BURST, max_retries=MAX_RETRIES):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="broadcast")
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_retries = max_retries
+        self.chat_buckets = {}
+        self.chat_buckets_lock = Lock()
+        self.paused_until = 0.0  # flood wait globale dopo un 429
+
+    def set_global_rate(self, rate, burst=None):
+        """Cambia il limite globale, ad esempio per dividerlo tra più processi"""
+        self.global_bucket = TokenBucket(rate, burst if burst is not None else max(1, rate))
+
+    def _chat_bucket(self, chat_id):
+        with self.chat_buckets_lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                if len(self.chat_buckets) > 1024:
+                    now = time.monotonic()
+                    for cid in [c for c, b in self.chat_buckets.items() if b.is_idle(now)]:
+                        del self.chat_buckets[cid]
+                bucket = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+                self.chat_buckets[chat_id] = bucket
+            return bucket
+
+    def _wait_flood(self):
+        delay = self.paused_until - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def send(self, bot, chat_id, payload, report=None):
+        """Esegue una singola chiamata rispettando i limiti e ritentando sui 429"""
+        method = getattr(bot, payload["method"])
+        bucket = self._chat_bucket(chat_id)
+        attempt = 0
+        while True:
+            self._wait_flood()
+            bucket.acquire()
+            self.global_bucket.acquire()
+            try:
+                return method(chat_id, **_call_params(payload))
+            except ApiTelegramException as e:
+                if e.error_code != 429 or attempt >= self.max_retries:
+                    raise
+                retry_after = (e.result_json.get("parameters") or {}).get("retry_after", 1)
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                attempt += 1
+                if report:
+                    with report.lock:
+                        report.retries += 1
+                logger.warning(f"429 da Telegram per {chat_id}, nuovo tentativo tra {retry_after}s")
+
+    def send_gallery(self, bot, chat_id, items, album_size=ALBUM_SIZE):
+        """Invia una galleria come album da al più album_size elementi.
+
+        Un album con un solo elemento diventa un invio singolo; se un album viene
+        rifiutato (es. un file_id non più valido) i suoi elementi sono inviati uno per uno.
+        """
+        for start in range(0, len(items), album_size):
+            chunk = items[start:start + album_size]
+            try:
+                if len(chunk) == 1:
+                    self._send_item(bot, chat_id, chunk[0])
+                else:
+                    self.send(bot, chat_id, album_payload(chunk))
+                continue
+            except ApiTelegramException as e:
+                if len(chunk) == 1 or any(kw in str(e).lower() for kw in UNREACHABLE_KEYWORDS):
+                    raise
+                logger.warning(f"Album rifiutato per {chat_id}, invio singolo: {str(e)}")
+            for item in chunk:
+                try:
+                    self._send_item(bot, chat_id, item)
+                except ApiTelegramException as e:
+                    logger.error(f"Errore invio media: {str(e)}")
+
+    def _send_item(self, bot, chat_id, item):
+        payload = media_payload(item["media_type"], item["file_id"], caption=item.get("caption"))
+        if item.get("reply_markup") is not None:
+            payload["params"]["reply_markup"] = item["reply_markup"]
+        return self.send(bot, chat_id, payload)
+
+    def _deliver_chat(self, bot, chat_id, jobs, report):
+        # I job di una stessa chat sono eseguiti in ordine dallo stesso worker
+        for idx, (key, payloads) in enumerate(jobs):
+            try:
+                for payload in payloads:
+                    self.send(bot, chat_id, payload, report)
+            except ApiTelegramException as e:
+                error_msg = str(e).lower()
+                if any(kw in error_msg for kw in UNREACHABLE_KEYWORDS):
+                    with report.lock:
+                        report.blocked.extend(k for k, _ in jobs[idx:])
+                    return
+                with report.lock:
+                    report.failed[key] = error_msg
+                continue
+            except Exception as e:
+                with report.lock:
+                    report.failed[key] = str(e)
+                continue
+            with report.lock:
+                report.sent.append(key)
+
+    def deliver(self, bot, jobs):
+        """Esegue i job (chiave, chat_id, payloads) e restituisce un DeliveryReport indicizzato per chiave"""
+        report = DeliveryReport()
+        by_chat = {}
+        for key, chat_id, payloads in jobs:
+            by_chat.setdefault(chat_id, []).append((key, payloads))
+        futures = [
+            self.executor.submit(self._deliver_chat, bot, chat_id, chat_jobs, report)
+            for chat_id, chat_jobs in by_chat.items()
+        ]
+        wait(futures)
+        report.elapsed = time.monotonic() - report.started
+        for key, error in report.failed.items():
+            logger.error(f"Errore invio {key}: {error}")
+        logger.info(f"Invio completato: {report}")
+        return report
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+# Istanza globale del motore di broadcast
+broadcast_engine = BroadcastEngine()
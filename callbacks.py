@@ -8,7 +8,117 @@ from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 from config import ADMIN_CHAT_ID, logger
 from database import db_manager
 from states import state_manager
-from utils import format_username, format_user_info
+from broadcast import broadcast_engine, announcement_payloads
+from outbox import outbox_dispatcher
+from keyboards import mode_keyboard, selection_keyboard, SELECTIONS, EXCLUDE_SELF, ADMIN_SELECTIONS
+from utils import format_username, format_user_info, build_weapon_text, get_media_emoji
+
+# ————— HELPER GALLERIE —————
+def _gallery_item(media, caption=None):
+    """Elemento di galleria per broadcast_engine.send_gallery"""
+    return {
+        "file_id": media["file_id"],
+        "media_type": media["media_type"] or "photo",
+        "caption": caption
+    }
+
+def _target_line(sighting):
+    """Riga con il bersaglio di un'arma, vuota per le segnalazioni normali"""
+    if sighting["target_username"] or sighting["target_first_name"]:
+        target = sighting["target_username"] or sighting["target_first_name"]
+        return f"\n💥 Usato contro: {target}"
+    return ""
+
+def _page_buttons(kind, target_id, mode, rows, has_prev, has_next):
+    """Pulsanti per scorrere le pagine di una galleria"""
+    buttons = []
+    if has_prev:
+        buttons.append(InlineKeyboardButton(
+            "◀️ Più recenti", callback_data=f"gallery_page|{kind}|{target_id}|{mode}|p|{rows[0]['id']}"
+        ))
+    if has_next:
+        buttons.append(InlineKeyboardButton(
+            "Più vecchie ▶️", callback_data=f"gallery_page|{kind}|{target_id}|{mode}|n|{rows[-1]['id']}"
+        ))
+    return buttons
+
+def _send_media_page(bot, chat_id, items, nav_buttons):
+    try:
+        broadcast_engine.send_gallery(bot, chat_id, items)
+    except Exception as e:
+        logger.error(f"Errore invio media: {str(e)}")
+    if nav_buttons:
+        markup = InlineKeyboardMarkup()
+        markup.row(*nav_buttons)
+        bot.send_message(chat_id, "📄 Altre segnalazioni:", reply_markup=markup)
+
+def _send_user_gallery_page(bot, chat_id, user_chat_id, cursor=None, direction="next"):
+    rows, has_prev, has_next = db_manager.get_user_gallery_page(user_chat_id, cursor, direction)
+    if not rows:
+        bot.send_message(chat_id, "📭 Nessun'altra segnalazione.")
+        return
+    
+    items = [
+        _gallery_item(s, caption=f"{s['name']}: {s['points_awarded']} punti\n📅 {s['timestamp'][:10]}" + _target_line(s))
+        for s in rows
+    ]
+    _send_media_page(bot, chat_id, items, _page_buttons("u", user_chat_id, "photos", rows, has_prev, has_next))
+
+def _send_matto_gallery_page(bot, chat_id, matto_id, mode, cursor=None, direction="next"):
+    rows, has_prev, has_next = db_manager.get_matto_gallery_page(matto_id, cursor, direction)
+    if not rows:
+        bot.send_message(chat_id, "📭 Nessun'altra segnalazione.")
+        return
+    
+    nav_buttons = _page_buttons("m", matto_id, mode, rows, has_prev, has_next)
+    
+    if mode == "text":
+        text = ""
+        for sighting in rows:
+            username = sighting['username'] or sighting['first_name'] or "Utente sconosciuto"
+            media_emoji = get_media_emoji(sighting['media_type'])
+            text += f"{media_emoji} {sighting['timestamp'][:10]} - Segnalato da: {username}"
+            text += _target_line(sighting).replace("\n", "\n   ") + "\n"
+        
+        markup = None
+        if nav_buttons:
+            markup = InlineKeyboardMarkup()
+            markup.row(*nav_buttons)
+        bot.send_message(chat_id, text, reply_markup=markup, parse_mode=None)
+        return
+    
+    items = []
+    for sighting in rows:
+        username = sighting['username'] or sighting['first_name'] or "Utente sconosciuto"
+        media_emoji = get_media_emoji(sighting['media_type'])
+        caption = f"{media_emoji} {sighting['timestamp'][:10]} - Da: {username}" + _target_line(sighting)
+        items.append(_gallery_item(sighting, caption=caption))
+    _send_media_page(bot, chat_id, items, nav_buttons)
+
+def _send_manage_page(bot, chat_id, user_chat_id, cursor=None, direction="next"):
+    rows, has_prev, has_next = db_manager.get_user_gallery_page(user_chat_id, cursor, direction)
+    if not rows:
+        bot.send_message(chat_id, "📭 Nessun'altra segnalazione.")
+        return
+    
+    try:
+        broadcast_engine.send_gallery(bot, chat_id, [
+            _gallery_item(s, caption=f"#{idx} {s['name']} – {s['timestamp'][:10]}")
+            for idx, s in enumerate(rows, 1)
+        ])
+    except Exception as e:
+        logger.error(f"Errore invio media: {str(e)}")
+    
+    # Gli album non supportano pulsanti: elimina e navigazione stanno in un messaggio a parte
+    markup = InlineKeyboardMarkup(row_width=5)
+    markup.add(*[
+        InlineKeyboardButton(text=f"❌ #{idx}", callback_data=f"delete_sighting|{s['id']}")
+        for idx, s in enumerate(rows, 1)
+    ])
+    nav_buttons = _page_buttons("a", user_chat_id, "photos", rows, has_prev, has_next)
+    if nav_buttons:
+        markup.row(*nav_buttons)
+    bot.send_message(chat_id, "🗑️ Elimina segnalazioni:", reply_markup=markup)
 
 # ————— CALLBACK MATTO SELECTION —————
 def callback_matto(bot, call: types.CallbackQuery):
@@ -96,12 +206,7 @@ def callback_select_user(bot, call: types.CallbackQuery):
     user_chat_id = int(parts[1])
     state_manager.set_pending_gallery_user(chat_id, user_chat_id)
     
-    # Crea tastiera per scegliere la modalità di visualizzazione
-    markup = InlineKeyboardMarkup()
-    markup.row(
-        InlineKeyboardButton("Solo testo", callback_data="gallery_mode|text"),
-        InlineKeyboardButton("Con media", callback_data="gallery_mode|photos")
-    )
+    markup = mode_keyboard("gallery_mode")
     
     bot.send_message(
         chat_id,
@@ -123,12 +228,7 @@ def callback_select_matto(bot, call: types.CallbackQuery):
     matto_id = int(parts[1])
     state_manager.set_pending_gallery_matto(chat_id, matto_id)
     
-    # Crea tastiera per scegliere la modalità di visualizzazione
-    markup = InlineKeyboardMarkup()
-    markup.row(
-        InlineKeyboardButton("Solo testo", callback_data="matto_mode|text"),
-        InlineKeyboardButton("Con media", callback_data="matto_mode|photos")
-    )
+    markup = mode_keyboard("matto_mode")
     
     bot.send_message(
         chat_id,
@@ -148,8 +248,7 @@ def callback_modifica_punti(bot, call: types.CallbackQuery):
     target_chat_id = int(call.data.split("|")[1])
     state_manager.set_awaiting_point_update(chat_id, target_chat_id)
 
-    users = db_manager.get_registered_users()
-    user = next((u for u in users if u['chat_id'] == target_chat_id), None)
+    user = db_manager.get_user(target_chat_id)
     
     if user:
         nome = user["first_name"] or user["username"] or str(target_chat_id)
@@ -171,53 +270,26 @@ def callback_manage_user(bot, call: types.CallbackQuery):
     user_chat_id = int(parts[1])
     state_manager.set_pending_manage_user(chat_id, user_chat_id)
     
-    matto_stats = db_manager.get_user_gallery(user_chat_id)
+    matto_stats = db_manager.get_user_matto_stats(user_chat_id)
     
     if not matto_stats:
         bot.send_message(chat_id, "📭 Questo utente non ha ancora segnalato nessun matto!")
         return
     
     # Ottieni i dettagli dell'utente
-    users = db_manager.get_registered_users()
-    user = next((u for u in users if u['chat_id'] == user_chat_id), None)
+    user = db_manager.get_user(user_chat_id)
     
     if user:
         username = format_username(user['username'], user['first_name'], user['chat_id'])
         text = f"👤 *Galleria di {username}*\n\n"
         
-        for matto, stats in matto_stats.items():
-            text += f"• *{matto}*: {stats['count']} segnalazioni, {stats['points']} punti\n"
+        for stats in matto_stats:
+            text += f"• *{stats['name']}*: {stats['sightings']} segnalazioni, {stats['points']} punti\n"
         
         bot.send_message(chat_id, text, parse_mode="Markdown")
         
-        # Per ogni matto, mostra le segnalazioni con pulsante elimina
-        for matto, stats in matto_stats.items():
-            text = f"🖼️ *{matto}* - Segnalazioni:"
-            bot.send_message(chat_id, text, parse_mode="Markdown")
-            
-            for photo in stats["photos"]:
-                markup = InlineKeyboardMarkup()
-                markup.add(InlineKeyboardButton(
-                    text="❌ Elimina segnalazione",
-                    callback_data=f"delete_sighting|{photo['sighting_id']}"
-                ))
-                
-                try:
-                    media_type = photo.get("media_type", "photo")
-                    if media_type == "video":
-                        bot.send_video(
-                            chat_id, 
-                            video=photo["file_id"],
-                            reply_markup=markup
-                        )
-                    else:
-                        bot.send_photo(
-                            chat_id, 
-                            photo=photo["file_id"],
-                            reply_markup=markup
-                        )
-                except Exception as e:
-                    logger.error(f"Errore invio media: {str(e)}")
+        # Prima pagina delle segnalazioni con i pulsanti elimina
+        _send_manage_page(bot, chat_id, user_chat_id)
     
     bot.answer_callback_query(call.id)
 
@@ -238,7 +310,21 @@ def callback_delete_sighting(bot, call: types.CallbackQuery):
     
     if db_manager.delete_sighting(sighting_id):
         bot.answer_callback_query(call.id, "✅ Segnalazione eliminata con successo!", show_alert=True)
-        bot.delete_message(chat_id, call.message.message_id)
+        
+        # I pulsanti degli album stanno in un messaggio a parte: si toglie solo quello premuto
+        markup = call.message.reply_markup
+        rows = [
+            [btn for btn in row if btn.callback_data != call.data]
+            for row in (markup.keyboard if markup else [])
+        ]
+        rows = [row for row in rows if row]
+        if call.message.content_type == "text" and rows:
+            new_markup = InlineKeyboardMarkup()
+            for row in rows:
+                new_markup.row(*row)
+            bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=new_markup)
+        else:
+            bot.delete_message(chat_id, call.message.message_id)
     else:
         bot.answer_callback_query(call.id, "❌ Errore durante l'eliminazione!", show_alert=True)
 
@@ -271,9 +357,9 @@ def callback_use_weapon(bot, call: types.CallbackQuery):
     )
     
     # Ottieni i nomi per la notifica
-    users = db_manager.get_registered_users()
-    finder = next((u for u in users if u['chat_id'] == chat_id), None)
-    target = next((u for u in users if u['chat_id'] == target_chat_id), None)
+    users = db_manager.get_users((chat_id, target_chat_id))
+    finder = users.get(chat_id)
+    target = users.get(target_chat_id)
     matto = db_manager.get_matto_by_id(weapon_info['matto_id'])
     
     finder_name = finder['first_name'] or finder['username'] or "Sconosciuto" if finder else "Sconosciuto"
@@ -282,21 +368,10 @@ def callback_use_weapon(bot, call: types.CallbackQuery):
     damage = abs(matto['points']) if matto else 0
     
     # Notifica a tutti
-    text = (
-        f"💥 *{finder_name}* ha usato l'arma *{matto_name}* contro *{target_name}*!\n"
-        f"🔥 {target_name} perde *{damage} punti*!"
-    )
-    
-    for cid in db_manager.get_registered_chat_ids():
-        try:
-            bot.send_message(cid, text, parse_mode="Markdown")
-            # Invia il media appropriato
-            if media_type == "video":
-                bot.send_video(cid, video=weapon_info['file_id'])
-            else:
-                bot.send_photo(cid, photo=weapon_info['file_id'])
-        except Exception:
-            continue
+    text = build_weapon_text(finder_name, matto_name, target_name, damage)
+    payloads = announcement_payloads(media_type, weapon_info['file_id'], text, parse_mode="Markdown")
+
+    outbox_dispatcher.enqueue(db_manager.get_registered_chat_ids(), payloads)
     
     bot.answer_callback_query(call.id, "💥 Arma usata con successo!", show_alert=True)
 
@@ -310,7 +385,7 @@ def callback_gallery_mode(bot, call: types.CallbackQuery):
         return
     
     user_chat_id = state_manager.get_pending_gallery_user(chat_id)
-    matto_stats = db_manager.get_user_gallery(user_chat_id)
+    matto_stats = db_manager.get_user_matto_stats(user_chat_id)
     
     if not matto_stats:
         bot.send_message(chat_id, "📭 Questo utente non ha segnalato nessun matto!")
@@ -318,49 +393,21 @@ def callback_gallery_mode(bot, call: types.CallbackQuery):
         return
     
     # Ottieni i dettagli dell'utente
-    users = db_manager.get_registered_users()
-    user = next((u for u in users if u['chat_id'] == user_chat_id), None)
+    user = db_manager.get_user(user_chat_id)
     username = format_username(user['username'], user['first_name'], user['chat_id']) if user else "Utente sconosciuto"
     
     if mode == "text":
         # Visualizzazione testuale
         text = f"📋 *Galleria di {username}:*\n"
-        for matto, stats in matto_stats.items():
-            text += f"\n- *{matto}*: {stats['count']} volte, {stats['points']} punti"
+        for stats in matto_stats:
+            text += f"\n- *{stats['name']}*: {stats['sightings']} volte, {stats['points']} punti"
         
         bot.send_message(chat_id, text, parse_mode="Markdown")
     
     elif mode == "photos":
-        # Visualizzazione con media (foto e video)
+        # Visualizzazione con media (foto e video), una pagina alla volta
         bot.send_message(chat_id, f"📸 *Galleria di {username}:*", parse_mode="Markdown")
-        
-        for matto, stats in matto_stats.items():
-            text = f"*{matto}*: {stats['count']} segnalazioni, {stats['points']} punti"
-            bot.send_message(chat_id, text, parse_mode="Markdown")
-            
-            for idx, media in enumerate(stats["photos"], 1):
-                caption = f"Segnalazione {idx}/{stats['count']}"
-                # Aggiungi info sull'attacco se presente
-                if media["target_first_name"] or media["target_username"]:
-                    target = media["target_username"] or media["target_first_name"]
-                    caption += f"\n💥 Usato contro: {target}"
-                
-                try:
-                    media_type = media.get("media_type", "photo")
-                    if media_type == "video":
-                        bot.send_video(
-                            chat_id, 
-                            video=media["file_id"],
-                            caption=caption
-                        )
-                    else:
-                        bot.send_photo(
-                            chat_id, 
-                            photo=media["file_id"],
-                            caption=caption
-                        )
-                except Exception as e:
-                    logger.error(f"Errore invio media: {str(e)}")
+        _send_user_gallery_page(bot, chat_id, user_chat_id)
     
     state_manager.remove_pending_gallery_user(chat_id)
     bot.answer_callback_query(call.id)
@@ -374,9 +421,9 @@ def callback_matto_mode(bot, call: types.CallbackQuery):
         return
     
     matto_id = state_manager.get_pending_gallery_matto(chat_id)
-    gallery = db_manager.get_matto_gallery(matto_id)
+    total = db_manager.count_matto_sightings(matto_id)
     
-    if not gallery:
+    if not total:
         bot.send_message(chat_id, "📭 Nessuna segnalazione per questo matto!")
         bot.answer_callback_query(call.id)
         return
@@ -386,53 +433,44 @@ def callback_matto_mode(bot, call: types.CallbackQuery):
     matto_name = matto['name'] if matto else "Matto sconosciuto"
     
     if mode == "text":
-        # Visualizzazione testuale
-        text = f"📋 *Galleria di {matto_name}:*\n"
-        text += f"Totale segnalazioni: {len(gallery)}\n\n"
-        
-        for idx, sighting in enumerate(gallery, 1):
-            username = sighting['username'] or sighting['first_name'] or "Utente sconosciuto"
-            media_emoji = "📹" if sighting.get('media_type') == 'video' else "📸"
-            text += f"{idx}. {media_emoji} Segnalato da: {username}\n"
-            if sighting['target_username'] or sighting['target_first_name']:
-                target = sighting['target_username'] or sighting['target_first_name']
-                text += f"   💥 Usato contro: {target}\n"
-        
-        bot.send_message(chat_id, text, parse_mode="Markdown")
+        bot.send_message(chat_id, f"📋 *Galleria di {matto_name}:*\nTotale segnalazioni: {total}", parse_mode="Markdown")
+    else:
+        bot.send_message(chat_id, f"📸 *Galleria di {matto_name}:*\nTotale: {total} segnalazioni", parse_mode="Markdown")
     
-    elif mode == "photos":
-        # Visualizzazione con media
-        bot.send_message(chat_id, f"📸 *Galleria di {matto_name}:*\nTotale: {len(gallery)} segnalazioni", parse_mode="Markdown")
-        
-        for idx, sighting in enumerate(gallery, 1):
-            username = sighting['username'] or sighting['first_name'] or "Utente sconosciuto"
-            media_type = sighting.get('media_type', 'photo')
-            media_emoji = "📹" if media_type == 'video' else "📸"
-            caption = f"{media_emoji} Segnalazione {idx}/{len(gallery)} - Da: {username}"
-            
-            if sighting['target_username'] or sighting['target_first_name']:
-                target = sighting['target_username'] or sighting['target_first_name']
-                caption += f"\n💥 Usato contro: {target}"
-            
-            try:
-                if media_type == "video":
-                    bot.send_video(
-                        chat_id,
-                        video=sighting['file_id'],
-                        caption=caption
-                    )
-                else:
-                    bot.send_photo(
-                        chat_id,
-                        photo=sighting['file_id'],
-                        caption=caption
-                    )
-            except Exception as e:
-                logger.error(f"Errore invio media: {str(e)}")
+    # Le segnalazioni arrivano una pagina alla volta
+    if mode in ("text", "photos"):
+        _send_matto_gallery_page(bot, chat_id, matto_id, mode)
     
     state_manager.remove_pending_gallery_matto(chat_id)
     bot.answer_callback_query(call.id)
 
+def callback_gallery_page(bot, call: types.CallbackQuery):
+    """Mostra la pagina successiva/precedente di una galleria"""
+    chat_id = call.from_user.id
+    parts = call.data.split("|")
+    
+    if (len(parts) != 6 or parts[1] not in ("u", "m", "a") or parts[4] not in ("n", "p")
+            or not parts[2].lstrip("-").isdigit() or not parts[5].isdigit()):
+        bot.answer_callback_query(call.id, "Pagina non valida!", show_alert=True)
+        return
+    
+    kind, mode = parts[1], parts[3]
+    target_id = int(parts[2])
+    direction = "next" if parts[4] == "n" else "prev"
+    cursor = int(parts[5])
+    
+    if kind == "u":
+        _send_user_gallery_page(bot, chat_id, target_id, cursor, direction)
+    elif kind == "m":
+        _send_matto_gallery_page(bot, chat_id, target_id, mode, cursor, direction)
+    else:
+        if chat_id != ADMIN_CHAT_ID:
+            bot.answer_callback_query(call.id, "❌ Solo l'admin può gestire le segnalazioni!", show_alert=True)
+            return
+        _send_manage_page(bot, chat_id, target_id, cursor, direction)
+    
+    bot.answer_callback_query(call.id)
+
 # ————— CALLBACK SUGGESTION REVIEW —————
 def callback_approve_suggestion(bot, call: types.CallbackQuery):
     """Gestisce l'approvazione di un suggerimento"""
@@ -525,3 +563,98 @@ def callback_reject_suggestion(bot, call: types.CallbackQuery):
             "❌ Inserisci il motivo del rifiuto:"
         )
         bot.answer_callback_query(call.id)
+
+# ————— CALLBACK IMPORT CATALOGO —————
+def _import_id(bot, call):
+    """Id dell'import dalla callback 'import_...|id', o None dopo aver risposto all'utente"""
+    if call.from_user.id != ADMIN_CHAT_ID:
+        bot.answer_callback_query(call.id, "❌ Comando riservato all'admin!", show_alert=True)
+        return None
+    parts = call.data.split("|", 1)
+    if len(parts) < 2 or not parts[1].isdigit():
+        bot.answer_callback_query(call.id, "ID non valido!", show_alert=True)
+        return None
+    return int(parts[1])
+
+def callback_import_apply(bot, call: types.CallbackQuery):
+    """Applica al catalogo un import mostrato in anteprima"""
+    import_id = _import_id(bot, call)
+    if import_id is None:
+        return
+    
+    diff = db_manager.apply_catalogue_import(import_id)
+    if diff is None:
+        bot.answer_callback_query(call.id, "⌛ Anteprima scaduta o già gestita.", show_alert=True)
+        return
+    
+    bot.edit_message_text(
+        f"✅ Import applicato: {diff['new']} nuovi matti, {diff['changed']} aggiornati, "
+        f"{diff['unchanged']} invariati.",
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode=None
+    )
+    bot.answer_callback_query(call.id, "✅ Catalogo aggiornato!")
+
+def callback_import_cancel(bot, call: types.CallbackQuery):
+    """Scarta un import mostrato in anteprima"""
+    import_id = _import_id(bot, call)
+    if import_id is None:
+        return
+    
+    db_manager.discard_import(import_id)
+    bot.edit_message_text(
+        "❌ Import annullato, il catalogo non è stato modificato.",
+        call.message.chat.id,
+        call.message.message_id,
+        parse_mode=None
+    )
+    bot.answer_callback_query(call.id)
+
+# ————— CALLBACK TASTIERE DI SELEZIONE —————
+def _selection_allowed(bot, call, prefix):
+    if prefix not in SELECTIONS:
+        bot.answer_callback_query(call.id, "Selezione non valida!", show_alert=True)
+        return False
+    if prefix in ADMIN_SELECTIONS and call.from_user.id != ADMIN_CHAT_ID:
+        bot.answer_callback_query(call.id, "❌ Solo l'admin può farlo!", show_alert=True)
+        return False
+    if prefix in EXCLUDE_SELF and not state_manager.has_pending_weapon_target(call.from_user.id):
+        bot.answer_callback_query(call.id, "❌ Sessione scaduta, riprova.")
+        return False
+    return True
+
+def callback_selection_page(bot, call: types.CallbackQuery):
+    """Cambia pagina in una tastiera di selezione (kb_page|prefisso|pagina)"""
+    parts = call.data.split("|")
+    if len(parts) != 3 or not parts[2].isdigit():
+        bot.answer_callback_query(call.id, "Pagina non valida!", show_alert=True)
+        return
+    
+    prefix, page = parts[1], int(parts[2])
+    if not _selection_allowed(bot, call, prefix):
+        return
+    
+    exclude = call.from_user.id if prefix in EXCLUDE_SELF else None
+    markup = selection_keyboard(prefix, page, exclude=exclude)
+    try:
+        bot.edit_message_reply_markup(call.message.chat.id, call.message.message_id, reply_markup=markup)
+    except Exception as e:
+        # Stessa pagina già mostrata ("message is not modified")
+        logger.debug(f"Pagina {page} di {prefix} non aggiornata: {str(e)}")
+    bot.answer_callback_query(call.id)
+
+def callback_selection_search(bot, call: types.CallbackQuery):
+    """Chiede il testo da cercare in una tastiera di selezione (kb_search|prefisso)"""
+    parts = call.data.split("|")
+    if len(parts) != 2:
+        bot.answer_callback_query(call.id, "Selezione non valida!", show_alert=True)
+        return
+    
+    prefix = parts[1]
+    if not _selection_allowed(bot, call, prefix):
+        return
+    
+    state_manager.set_pending_search(call.from_user.id, prefix)
+    bot.send_message(call.message.chat.id, "🔍 Scrivi il nome (o parte del nome) da cercare:", parse_mode=None)
+    bot.answer_callback_query(call.id)
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from threading import Lock
+
+class MattiCatalogue:
+    """Copia in memoria del catalogo dei matti, caricata alla prima lettura.
+
+    Ogni modifica al catalogo chiama invalidate(), che incrementa la versione:
+    un caricamento iniziato prima dell'invalidazione non viene salvato, così
+    la cache non può trattenere dati vecchi.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.items = None  # righe ordinate come list_matti(), None se da ricaricare
+        self.by_id = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def _load(self, loader):
+        with self.lock:
+            version = self.version
+        rows = tuple(loader())
+        with self.lock:
+            if self.version == version:
+                self.items = rows
+                self.by_id = {row["id"]: row for row in rows}
+        return rows, {row["id"]: row for row in rows}
+
+    def list(self, loader):
+        """Tutti i matti; loader() legge il catalogo dal database in caso di miss"""
+        with self.lock:
+            items = self.items
+            if items is not None:
+                self.hits += 1
+                return items
+            self.misses += 1
+        return self._load(loader)[0]
+
+    def get(self, matto_id, loader):
+        """Un matto per id, o None"""
+        with self.lock:
+            if self.items is not None:
+                self.hits += 1
+                return self.by_id.get(matto_id)
+            self.misses += 1
+        return self._load(loader)[1].get(matto_id)
+
+    def invalidate(self):
+        with self.lock:
+            self.version += 1
+            self.items = None
+            self.by_id = {}
+
+    def stats(self):
+        """Contatori della cache: versione, hit, miss e numero di matti caricati"""
+        with self.lock:
+            return {
+                "version": self.version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self.items) if self.items is not None else 0,
+            }
@@ -0,0 +1,25 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Verifica i piani di esecuzione di tutte le query di database.py.
+Esce con codice 1 se una query ricorre a una scansione completa di una tabella
+che cresce con l'uso: da eseguire prima di ogni rilascio o in CI.
+"""
+
+import sys
+from database import audit_query_plans
+
+def main():
+    violations = audit_query_plans()
+    if not violations:
+        print("✅ Nessuna scansione completa nelle query di database.py")
+        return 0
+    
+    print(f"❌ {len(violations)} query con scansione completa:")
+    for method, sql, detail in violations:
+        print(f"  - {method}: {detail}\n      {sql.strip()}")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
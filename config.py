@@ -13,8 +13,50 @@ BOT_TOKEN = os.getenv("BOT_TOKEN") or "USALO_NELLA_TUA_ENV"
 ADMIN_CHAT_ID = int(os.getenv("ADMIN_CHAT_ID", "0"))
 REGISTRATION_PASSWORD = os.getenv("REGISTRATION_PASSWORD", "fantamattopwd")
 
+# Runtime del bot: "sync" (TeleBot con thread) oppure "async" (polling e API con AsyncTeleBot,
+# handler sincroni in un pool di ASYNC_MAX_CONCURRENT_UPDATES thread, vedi async_frontend.py);
+# si può forzare anche con `python main.py --async`
+BOT_RUNTIME = os.getenv("BOT_RUNTIME", "sync")
+ASYNC_MAX_CONCURRENT_UPDATES = int(os.getenv("ASYNC_MAX_CONCURRENT_UPDATES", "32"))
+
+# Processi worker: con più di 1 un supervisore fa il polling e smista gli update
+# ai worker per chat_id (si può indicare anche con `python main.py --workers N`)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "1"))
+
+# Ricezione degli update: "polling" (long polling) oppure "webhook" (server HTTP integrato)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# URL pubblico da registrare su Telegram; se vuoto il webhook va impostato a mano
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+# Secret token obbligatorio in modalità webhook: Telegram lo invia in ogni richiesta
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+
+# Backend degli stati di conversazione: "memory" (solo nel processo) oppure
+# "sqlite" (tabella chat_sessions, sopravvive ai riavvii ed è condivisibile tra processi)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))  # secondi tra due scritture a batch
+
+# Modalità di invio degli annunci: "caption" (testo come didascalia del media,
+# una sola chiamata per utente) oppure "separate" (messaggio + media)
+BROADCAST_MODE = os.getenv("BROADCAST_MODE", "caption")
+
+# Numero di segnalazioni per pagina nelle gallerie (un album Telegram ne contiene al massimo 10)
+GALLERY_PAGE_SIZE = 10
+
+# Pulsanti per pagina nelle tastiere di selezione di matti e utenti
+SELECTION_PAGE_SIZE = 20
+
 # Configurazione database
 DB_PATH = "bot_matti.db"
+# Commit di gruppo: con DB_GROUP_COMMIT_MS > 0 le scritture sono confermate insieme
+# ogni DB_GROUP_COMMIT_MS millisecondi o dopo DB_GROUP_COMMIT_MAX scritture (0 = commit immediato)
+DB_GROUP_COMMIT_MS = int(os.getenv("DB_GROUP_COMMIT_MS", "0"))
+DB_GROUP_COMMIT_MAX = int(os.getenv("DB_GROUP_COMMIT_MAX", "200"))
+# Connessioni di sola lettura aperte al massimo: oltre, le letture attendono una connessione libera
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "8"))
 
 # Configurazione logging
 def setup_logging():
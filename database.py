@@ -1,22 +1,472 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import sqlite3
+import json
 import logging
-from threading import Lock
-from datetime import datetime, timezone
-from collections import defaultdict
-from config import DB_PATH
+import re
+import tempfile
+import itertools
+import time
+from threading import Lock, Condition, Thread
+from queue import LifoQueue, Empty
+from contextlib import contextmanager
+from datetime import datetime, timezone, timedelta
+from config import DB_PATH, GALLERY_PAGE_SIZE, DB_GROUP_COMMIT_MS, DB_GROUP_COMMIT_MAX, DB_READ_POOL_SIZE
+from ranking import RankIndex
+from catalogue import MattiCatalogue
+from profiles import UserProfileCache
 
 logger = logging.getLogger(__name__)
 
+# Pragma applicati a ogni connessione
+CONNECTION_PRAGMAS = {
+    "synchronous": "NORMAL",  # sicuro in modalità WAL, evita un fsync per commit
+    "cache_size": -16000,  # 16 MB di page cache
+    "mmap_size": 134217728,  # 128 MB letti via mmap
+    "busy_timeout": 5000,
+    "temp_store": "MEMORY",
+}
+
+# Indici gestiti: nome → definizione, creati all'avvio se mancanti
+MANAGED_INDEXES = {
+    "idx_users_leaderboard": "users(registered, total_points)",
+    "idx_sightings_user": "sightings(user_chat_id, id)",
+    "idx_sightings_matto": "sightings(matto_id, id)",
+    "idx_sightings_target": "sightings(target_chat_id)",
+    "idx_suggestions_status": "matto_suggestions(status, created_at)",
+    "idx_suggestions_user": "matto_suggestions(user_chat_id, created_at)",
+    "idx_suggestions_name": "matto_suggestions(suggested_name, status)",
+    "idx_outbox_pending": "outbox(status, next_attempt_at)",
+    "idx_chat_sessions_expiry": "chat_sessions(expires_at)",
+    "idx_import_staging_name": "import_staging(import_id, name, seq)",
+    "idx_imports_created": "imports(created_at)",
+}
+
+# Tabelle che crescono con l'uso: una scansione completa su di esse è una regressione
+HOT_TABLES = ("users", "sightings", "matto_suggestions", "outbox", "chat_sessions", "import_staging", "user_matto_stats")
+
+# Righe della tabella di appoggio {table} di un import (import_id due volte), senza i nomi ripetuti
+STAGED_FIRST_OCCURRENCE = (
+    "i.import_id = ? AND i.seq IN ("
+    "SELECT MIN(seq) FROM {table} WHERE import_id = ? GROUP BY name)"
+)
+
+# Inserisce un matto o ne aggiorna i punti: l'id resta lo stesso e le segnalazioni restano collegate
+MATTO_UPSERT = (
+    "INSERT INTO matti (name, points) VALUES (?, ?) "
+    "ON CONFLICT(name) DO UPDATE SET points = excluded.points;"
+)
+
+# Tabelle da cui dipendono le cache in memoria (classifica, catalogo, profili)
+CACHED_TABLES = ("users", "matti", "sightings")
+# Trigger che incrementano cache_version, presenti solo in modalità condivisa: (nome, tabella, evento)
+CACHE_TRIGGERS = [
+    (f"{table}_cache_{event.lower()}", table, event)
+    for table in CACHED_TABLES for event in ("INSERT", "UPDATE", "DELETE")
+]
+
+IMPORT_TTL_HOURS = 24  # ore dopo cui un'anteprima di import non applicata viene scartata
+
+AUDIT_ALIAS_RE = re.compile(r"\b(?:FROM|JOIN)\s+(\w+)\s+(?:AS\s+)?(?!ON\b|WHERE\b|JOIN\b|LEFT\b|ORDER\b)(\w+)", re.IGNORECASE)
+
+class FetchedRows:
+    """Righe già lette, con i metodi di lettura di un cursore"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.pos = 0
+
+    def fetchone(self):
+        if self.pos >= len(self.rows):
+            return None
+        self.pos += 1
+        return self.rows[self.pos - 1]
+
+    def fetchmany(self, size=1):
+        rows = self.rows[self.pos:self.pos + size]
+        self.pos += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.rows[self.pos:]
+        self.pos = len(self.rows)
+        return rows
+
+# Chiamate eseguite dall'audit dei piani di esecuzione, in ordine: (metodo, argomenti)
+PLAN_AUDIT_CALLS = [
+    ("register_user", (1, "audit", "Audit")),
+    ("register_user", (2, "bersaglio", "Bersaglio")),
+    ("set_registered", (1, True)),
+    ("set_registered", (2, True)),
+    ("add_matto", ("matto", 5)),
+    ("add_matto", ("arma", -3)),
+    ("get_registered_users", ()),
+    ("get_registered_chat_ids", ()),
+    ("get_user", (1,)),
+    ("get_users", ((1, 2, 3),)),
+    ("get_leaderboard", ()),
+    ("get_leaderboard", (10,)),
+    ("iter_leaderboard", ()),
+    ("get_user_rank_and_points", (1,)),
+    ("update_user_points", (1, 10)),
+    ("list_matti", ()),
+    ("stage_catalogue_import", (1, [[("caricato", 4), ("nuovo catalogo", 1)]])),
+    ("get_import", (1,)),
+    ("diff_catalogue_import", (1,)),
+    ("apply_catalogue_import", (1,)),
+    ("stage_catalogue_import", (1, [[("scartato", 1)]])),
+    ("discard_import", (2,)),
+    ("get_matto_by_id", (1,)),
+    ("add_sighting", (1, 1, 5, "file")),
+    ("add_sighting", (1, 2, -3, "file", 2)),
+    ("get_matto_gallery_page", (1,)),
+    ("get_matto_gallery_page", (1, 1)),
+    ("get_matto_gallery_page", (1, 1, "prev")),
+    ("get_user_gallery_page", (1,)),
+    ("get_user_gallery_page", (1, 2, "prev")),
+    ("count_matto_sightings", (1,)),
+    ("get_user_matto_stats", (1,)),
+    ("delete_sighting", (2,)),
+    ("add_suggestion", (1, "nuovo", 3)),
+    ("add_suggestions_bulk", (1, [[("nuovo", 3), ("matto", 5)], [("nuovo", 4)]])),
+    ("get_pending_suggestions", ()),
+    ("get_suggestion_by_id", (1,)),
+    ("get_user_suggestions", (1,)),
+    ("approve_suggestion", (1,)),
+    ("reject_suggestion", (1,)),
+    ("enqueue_outbox", ([1, 2], [])),
+    ("get_outbox_batch", ()),
+    ("mark_outbox_sent", ([1],)),
+    ("mark_outbox_failed", (2, "errore")),
+    ("purge_outbox", ("9999",)),
+    ("write_chat_sessions", ([(1, "password", "true", 2e9)], [2])),
+    ("get_chat_session", (1, 0)),
+    ("get_chat_session_ids", (0,)),
+    ("purge_chat_sessions", (0,)),
+    ("unregister_user", (2,)),
+    ("remove_matto", (2,)),
+]
+
 class DatabaseManager:
-    def __init__(self, db_path=DB_PATH):
+    """Accesso al database: una connessione di scrittura e un pool di connessioni di lettura.
+
+    In modalità WAL le letture non bloccano e non sono bloccate dalle scritture,
+    che restano serializzate da self.lock sulla connessione self.db.
+
+    Con group_commit_ms > 0 le scritture non fanno commit una per una: restano
+    in una transazione aperta, ognuna nel proprio savepoint, e un thread le
+    conferma insieme ogni group_commit_ms millisecondi o dopo group_commit_max
+    scritture. Letture e cache vedono solo dati confermati: una lettura con
+    scritture in attesa conferma prima il gruppo, e le cache in memoria sono
+    aggiornate solo dopo il commit (vedi _after_commit).
+    """
+
+    def __init__(self, db_path=DB_PATH, group_commit_ms=DB_GROUP_COMMIT_MS, group_commit_max=DB_GROUP_COMMIT_MAX,
+                 read_pool_size=DB_READ_POOL_SIZE):
         self.db_path = db_path
-        self.db = sqlite3.connect(db_path, check_same_thread=False)
-        self.db.row_factory = sqlite3.Row
+        self.trace_callback = None
+        self.db = self._connect()
+        self.db.execute("PRAGMA journal_mode = WAL;")
         self.cursor = self.db.cursor()
         self.lock = Lock()
+        self.readers = []  # tutte le connessioni di lettura aperte, al massimo read_pool_size
+        self.idle_readers = LifoQueue()
+        self.read_pool_size = max(read_pool_size, 1)
+        self.readers_lock = Lock()
+        self.ranks = RankIndex()
+        self.catalogue = MattiCatalogue()
+        self.profiles = UserProfileCache()
+        self.stage_ids = itertools.count(1)  # import nella tabella temporanea della connessione
+        self.users_version = 0  # cambia quando cambia l'elenco degli utenti registrati
+        self.shared = False  # altri processi scrivono sullo stesso file
+        self.data_version = None
+        self.cache_version = None
+        self.group_interval = group_commit_ms / 1000
+        self.group_max = max(group_commit_max, 1)
+        self.committed = Condition(self.lock)
+        self.write_seq = 0  # scritture eseguite
+        self.committed_seq = 0  # scritture confermate con un commit
+        self.pending_since = None  # prima scrittura non confermata (time.monotonic)
+        self.in_write = False
+        self.commit_hooks = []  # aggiornamenti delle cache in attesa del commit di gruppo
+        self.failed_commits = []  # committed_seq al momento di ogni commit di gruppo fallito
+        self.committer = None
+        self.closing = False
+
+    def _connect(self, read_only=False):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        for name, value in CONNECTION_PRAGMAS.items():
+            conn.execute(f"PRAGMA {name} = {value};")
+        if read_only:
+            conn.execute("PRAGMA query_only = ON;")
+        if self.trace_callback:
+            conn.set_trace_callback(self.trace_callback)
+        return conn
+
+    @contextmanager
+    def _reader(self):
+        """Connessione di sola lettura presa dal pool per la durata del blocco.
+
+        Le connessioni sono aperte al primo uso fino a read_pool_size; poi chi
+        legge attende che un altro thread ne restituisca una. LIFO: si riusa
+        la connessione usata più di recente, con la cache delle pagine calda.
+        """
+        try:
+            conn = self.idle_readers.get_nowait()
+        except Empty:
+            conn = None
+            with self.readers_lock:
+                if len(self.readers) < self.read_pool_size:
+                    conn = self._connect(read_only=True)
+                    self.readers.append(conn)
+            if conn is None:
+                conn = self.idle_readers.get()
+        try:
+            yield conn
+        finally:
+            self.idle_readers.put(conn)
+
+    def _read(self, sql, params=()):
+        """Esegue una lettura su una connessione del pool e ne restituisce le righe.
+
+        Con il commit di gruppo le scritture in attesa vengono prima confermate:
+        la lettura vede anche quelle fatte da un altro thread (es. l'update
+        precedente dello stesso utente) e mai dati che un crash può perdere.
+        """
+        self.flush()
+        # Le righe sono lette subito, così la connessione torna libera nel pool
+        with self._reader() as conn:
+            return FetchedRows(conn.execute(sql, params).fetchall())
+
+    # ————— SCRITTURE E COMMIT —————
+    @contextmanager
+    def _write(self):
+        """Blocco di scrittura sotto self.lock, confermato da self._commit().
+
+        Un'eccezione prima di _commit() annulla le modifiche del blocco: in
+        modalità commit di gruppo solo le sue, grazie al savepoint.
+        """
+        with self.lock:
+            group = self.group_interval > 0
+            if group:
+                if not self.db.in_transaction:
+                    self.db.execute("BEGIN;")
+                self.db.execute("SAVEPOINT write_op;")
+            self.in_write = True
+            try:
+                yield
+            except BaseException:
+                if self.in_write:
+                    self.in_write = False
+                    if group:
+                        self.db.execute("ROLLBACK TO write_op;")
+                        self.db.execute("RELEASE write_op;")
+                    else:
+                        self.db.rollback()
+                raise
+            if self.in_write:
+                # Blocco uscito senza _commit() (es. return anticipato): nulla da confermare
+                self.in_write = False
+                if group:
+                    self.db.execute("RELEASE write_op;")
+
+    def _commit(self, durable=False):
+        # Da chiamare dentro _write(), dopo l'ultima istruzione del blocco.
+        # durable=True conferma subito anche in modalità commit di gruppo
+        self.in_write = False
+        self.write_seq += 1
+        if self.group_interval <= 0:
+            try:
+                self.db.commit()
+            except sqlite3.Error:
+                self.write_seq -= 1
+                self.db.rollback()
+                raise
+            self.committed_seq = self.write_seq
+            return
+        self.db.execute("RELEASE write_op;")
+        if self.pending_since is None:
+            self.pending_since = time.monotonic()
+        if durable or self.write_seq - self.committed_seq >= self.group_max:
+            self._commit_group()
+        elif self.committer is None:
+            self.committer = Thread(target=self._run_committer, name="db-committer", daemon=True)
+            self.committer.start()
+        else:
+            self.committed.notify_all()
+
+    def _after_commit(self, fn, *args):
+        # Da chiamare dentro _write(), dopo _commit(): fn(*args) aggiorna le cache in
+        # memoria quando la scrittura è confermata, cioè subito se non c'è un gruppo in attesa
+        if self.committed_seq == self.write_seq:
+            fn(*args)
+        else:
+            self.commit_hooks.append((fn, args))
+
+    def _commit_group(self):
+        # Da chiamare con self.lock acquisito. Se il commit fallisce l'intero gruppo
+        # è annullato, le cache restano allo stato confermato e l'errore passa al chiamante
+        try:
+            self.db.commit()
+        except sqlite3.Error:
+            self.db.rollback()
+            self.failed_commits.append(self.committed_seq)
+            self.write_seq = self.committed_seq
+            self.pending_since = None
+            self.commit_hooks = []
+            self.committed.notify_all()
+            raise
+        self.committed_seq = self.write_seq
+        self.pending_since = None
+        hooks, self.commit_hooks = self.commit_hooks, []
+        for fn, args in hooks:
+            fn(*args)
+        self.committed.notify_all()
+
+    def _run_committer(self):
+        with self.lock:
+            while not self.closing:
+                if self.pending_since is None:
+                    self.committed.wait()
+                    continue
+                delay = self.pending_since + self.group_interval - time.monotonic()
+                if delay > 0:
+                    self.committed.wait(delay)
+                    continue
+                try:
+                    self._commit_group()
+                except sqlite3.Error as e:
+                    logger.error(f"Errore nel commit di gruppo, scritture annullate: {str(e)}")
+
+    def flush(self):
+        """Conferma subito le scritture in attesa del commit di gruppo.
+
+        Se il commit fallisce il gruppo è annullato e l'errore è rilanciato;
+        le scritture successive ripartono da una transazione nuova:
+
+        >>> manager = DatabaseManager(os.path.join(tempfile.mkdtemp(), "flush.db"), group_commit_ms=60000)
+        >>> manager.init_db()
+        >>> _ = manager.db.execute("PRAGMA foreign_keys = ON;")
+        >>> manager.add_matto("confermato", 1)
+        True
+        >>> manager.flush()
+        >>> manager.add_matto("annullato", 2)
+        True
+        >>> _ = manager.db.execute("PRAGMA defer_foreign_keys = ON;")  # vincolo verificato al commit
+        >>> manager.add_sighting(99, 1, 5, "file")
+        >>> manager.flush()
+        Traceback (most recent call last):
+        ...
+        sqlite3.IntegrityError: FOREIGN KEY constraint failed
+        >>> manager.db.in_transaction, manager.write_seq == manager.committed_seq, manager.commit_hooks
+        (False, True, [])
+        >>> [m["name"] for m in manager.list_matti()]
+        ['confermato']
+        >>> manager.add_matto("dopo", 3)
+        True
+        >>> manager.flush()
+        >>> [m["name"] for m in manager.list_matti()]
+        ['dopo', 'confermato']
+        >>> manager.close()
+        """
+        if self.committed_seq == self.write_seq:
+            return
+        with self.lock:
+            if self.committed_seq != self.write_seq:
+                self._commit_group()
+
+    def wait_durable(self, timeout=None):
+        """Attende che le scritture eseguite finora siano confermate.
+
+        False se scade il timeout o se un commit di gruppo fallito le ha annullate.
+        """
+        with self.lock:
+            target, failures = self.write_seq, len(self.failed_commits)
+            self.committed.wait_for(
+                lambda: self.committed_seq >= target or len(self.failed_commits) > failures, timeout
+            )
+            if len(self.failed_commits) > failures:
+                # Confermate solo se lo erano già prima del primo commit fallito
+                return target <= self.failed_commits[failures]
+            return self.committed_seq >= target
+
+    def enable_shared_mode(self):
+        """Da usare quando più processi scrivono sullo stesso database.
+
+        PRAGMA data_version sulla connessione di scrittura cambia solo per i
+        commit di altre connessioni; le cache vengono scartate solo se quei
+        commit hanno toccato una delle CACHED_TABLES, cioè se è cambiata la
+        riga di cache_version aggiornata dai loro trigger. I trigger sono
+        creati qui: in un solo processo nessuno legge cache_version e
+        upgrade_db() li rimuove.
+        """
+        self.flush()
+        with self.lock:
+            existing = {row["name"] for row in self.cursor.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'trigger';"
+            ).fetchall()}
+            missing = [trigger for trigger in CACHE_TRIGGERS if trigger[0] not in existing]
+            for name, table, event in missing:
+                self.cursor.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS {name} AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE cache_version SET version = version + 1 WHERE id = 1;
+                    END;
+                """)
+            if missing:
+                self.db.commit()
+            self.shared = True
+            self.data_version = self.db.execute("PRAGMA data_version;").fetchone()[0]
+            self.cache_version = self._read_cache_version()
+
+    def _read_cache_version(self):
+        # Da chiamare con self.lock acquisito
+        return self.db.execute("SELECT version FROM cache_version WHERE id = 1;").fetchone()[0]
+
+    def _sync_caches(self):
+        # Controllo economico, fatto prima di servire una lettura dalla cache:
+        # i commit altrui su outbox o sessioni non scartano le cache
+        self.flush()
+        if not self.shared:
+            return
+        with self.lock:
+            version = self.db.execute("PRAGMA data_version;").fetchone()[0]
+            if version == self.data_version:
+                return
+            self.data_version = version
+            cache_version = self._read_cache_version()
+            if cache_version == self.cache_version:
+                return
+            self.cache_version = cache_version
+        self.invalidate_caches()
+
+    def invalidate_caches(self):
+        """Scarta le cache in memoria, ricostruite al prossimo utilizzo"""
+        self.ranks.invalidate()
+        self.catalogue.invalidate()
+        self.profiles.invalidate()
+        self.users_version += 1
+
+    def catalogue_version(self):
+        """Versione corrente del catalogo dei matti"""
+        self._sync_caches()
+        return self.catalogue.version
+
+    def registered_users_version(self):
+        """Versione corrente dell'elenco degli utenti registrati"""
+        self._sync_caches()
+        return self.users_version
+
+    def set_trace_callback(self, callback):
+        """Imposta la trace callback su tutte le connessioni, presenti e future"""
+        self.trace_callback = callback
+        self.db.set_trace_callback(callback)
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.set_trace_callback(callback)
         
     def init_db(self):
         """Inizializza le tabelle del database"""
@@ -75,6 +525,50 @@ class DatabaseManager:
                     );
                 """)
                 
+                # Coda persistente dei messaggi in uscita
+                self.cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS outbox (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id INTEGER NOT NULL,
+                        payload TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'failed')),
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        last_error TEXT DEFAULT NULL,
+                        created_at TEXT NOT NULL,
+                        next_attempt_at TEXT NOT NULL,
+                        sent_at TEXT DEFAULT NULL
+                    );
+                """)
+                
+                # Sessioni di conversazione persistenti (backend di stato "sqlite")
+                self.cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS chat_sessions (
+                        chat_id INTEGER PRIMARY KEY,
+                        state TEXT NOT NULL,
+                        data TEXT NOT NULL,
+                        expires_at REAL NOT NULL
+                    );
+                """)
+                
+                # Import a blocchi: righe in attesa di essere confrontate o applicate
+                self.cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS imports (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        chat_id INTEGER NOT NULL,
+                        kind TEXT NOT NULL,
+                        created_at TEXT NOT NULL
+                    );
+                """)
+                self.cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS import_staging (
+                        import_id INTEGER NOT NULL,
+                        seq INTEGER NOT NULL,
+                        name TEXT NOT NULL,
+                        points INTEGER NOT NULL,
+                        PRIMARY KEY (import_id, seq)
+                    );
+                """)
+                
                 self.db.commit()
                 logger.info("Tabelle del database create con successo")
         except Exception as e:
@@ -90,10 +584,6 @@ class DatabaseManager:
             
             if 'target_chat_id' not in columns:
                 self.cursor.execute("ALTER TABLE sightings ADD COLUMN target_chat_id INTEGER DEFAULT NULL;")
-                self.cursor.execute("""
-                    CREATE INDEX IF NOT EXISTS idx_sightings_target 
-                    ON sightings(target_chat_id);
-                """)
                 self.db.commit()
                 logger.info("Database aggiornato con la colonna target_chat_id")
             
@@ -121,112 +611,422 @@ class DatabaseManager:
                 """)
                 self.db.commit()
                 logger.info("Database aggiornato con la tabella matto_suggestions")
+            
+            # Riepilogo per utente e matto, mantenuto dai trigger sulle segnalazioni
+            self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='user_matto_stats';")
+            if not self.cursor.fetchone():
+                self.cursor.execute("""
+                    CREATE TABLE user_matto_stats (
+                        user_chat_id INTEGER NOT NULL,
+                        matto_id INTEGER NOT NULL,
+                        sightings INTEGER NOT NULL,
+                        points INTEGER NOT NULL,
+                        PRIMARY KEY (user_chat_id, matto_id)
+                    ) WITHOUT ROWID;
+                """)
+                self.cursor.execute("""
+                    CREATE TRIGGER sightings_stats_insert AFTER INSERT ON sightings
+                    BEGIN
+                        INSERT INTO user_matto_stats (user_chat_id, matto_id, sightings, points)
+                        VALUES (NEW.user_chat_id, NEW.matto_id, 1, NEW.points_awarded)
+                        ON CONFLICT(user_chat_id, matto_id) DO UPDATE
+                        SET sightings = sightings + 1, points = points + excluded.points;
+                    END;
+                """)
+                self.cursor.execute("""
+                    CREATE TRIGGER sightings_stats_delete AFTER DELETE ON sightings
+                    BEGIN
+                        UPDATE user_matto_stats
+                        SET sightings = sightings - 1, points = points - OLD.points_awarded
+                        WHERE user_chat_id = OLD.user_chat_id AND matto_id = OLD.matto_id;
+                        DELETE FROM user_matto_stats
+                        WHERE user_chat_id = OLD.user_chat_id AND matto_id = OLD.matto_id AND sightings <= 0;
+                    END;
+                """)
+                # Le segnalazioni già presenti vanno contate una volta, nella stessa transazione
+                self.cursor.execute("""
+                    INSERT INTO user_matto_stats (user_chat_id, matto_id, sightings, points)
+                    SELECT user_chat_id, matto_id, COUNT(*), SUM(points_awarded)
+                    FROM sightings GROUP BY user_chat_id, matto_id;
+                """)
+                self.db.commit()
+                logger.info("Database aggiornato con la tabella user_matto_stats")
+            
+            # Versione dei dati in cache, incrementata in modalità condivisa dai CACHE_TRIGGERS
+            self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='cache_version';")
+            if not self.cursor.fetchone():
+                self.cursor.execute("""
+                    CREATE TABLE cache_version (
+                        id INTEGER PRIMARY KEY CHECK (id = 1),
+                        version INTEGER NOT NULL
+                    );
+                """)
+                self.cursor.execute("INSERT INTO cache_version (id, version) VALUES (1, 0);")
+                self.db.commit()
+                logger.info("Database aggiornato con la tabella cache_version")
+            
+            # Trigger rimasti da un avvio con più processi: li ricrea enable_shared_mode() se serve
+            self.cursor.execute("SELECT name FROM sqlite_master WHERE type='trigger';")
+            existing = {row["name"] for row in self.cursor.fetchall()}
+            stale = [name for name, _, _ in CACHE_TRIGGERS if name in existing]
+            for name in stale:
+                self.cursor.execute(f"DROP TRIGGER {name};")
+            if stale:
+                self.db.commit()
+        
+        self.ensure_indexes()
+
+    def ensure_indexes(self):
+        """Crea gli indici gestiti mancanti e ricrea quelli con una definizione diversa"""
+        with self.lock:
+            existing = {row["name"]: row["sql"] for row in self.cursor.execute(
+                "SELECT name, sql FROM sqlite_master WHERE type = 'index';"
+            ).fetchall()}
+            missing = [
+                name for name, definition in MANAGED_INDEXES.items()
+                if existing.get(name) != f"CREATE INDEX {name} ON {definition}"
+            ]
+            for name in missing:
+                self.cursor.execute(f"DROP INDEX IF EXISTS {name};")
+                self.cursor.execute(f"CREATE INDEX {name} ON {MANAGED_INDEXES[name]};")
+            if missing:
+                self.db.commit()
+                logger.info(f"Indici creati: {', '.join(missing)}")
+
+    # ————— IMPORT A BLOCCHI —————
+    def _stage_rows(self, batches):
+        """Copia i blocchi [(nome, punti), ...] nella tabella temporanea: (stage_id, righe).
+
+        Il lock è preso un blocco alla volta, così il download e il parsing che
+        producono i blocchi non fermano le altre scritture. La tabella è TEMP:
+        i commit dei blocchi non toccano il file del database, che cambia solo
+        con la transazione finale di chi usa le righe.
+        """
+        stage_id = next(self.stage_ids)
+        total = 0
+        try:
+            for batch in batches:
+                with self._write():
+                    self.cursor.execute(
+                        "CREATE TEMP TABLE IF NOT EXISTS import_rows ("
+                        "import_id INTEGER NOT NULL, seq INTEGER NOT NULL, "
+                        "name TEXT NOT NULL, points INTEGER NOT NULL, PRIMARY KEY (import_id, seq));"
+                    )
+                    self.cursor.execute(
+                        "CREATE INDEX IF NOT EXISTS temp.idx_import_rows_name ON import_rows(import_id, name, seq);"
+                    )
+                    self.cursor.executemany(
+                        "INSERT INTO temp.import_rows (import_id, seq, name, points) VALUES (?, ?, ?, ?);",
+                        ((stage_id, total + i, name, points) for i, (name, points) in enumerate(batch))
+                    )
+                    self._commit()
+                total += len(batch)
+        except Exception:
+            self._discard_rows(stage_id)
+            raise
+        return stage_id, total
+
+    def _discard_rows(self, stage_id):
+        with self._write():
+            if self.cursor.execute("SELECT 1 FROM temp.sqlite_master WHERE name = 'import_rows';").fetchone():
+                self.cursor.execute("DELETE FROM temp.import_rows WHERE import_id = ?;", (stage_id,))
+                self._commit()
+
+    def _stage_import(self, chat_id, batches):
+        """Salva i blocchi [(nome, punti), ...] in import_staging: (import_id, righe).
+
+        Le righe restano nel database finché l'anteprima non viene applicata o
+        scartata, anche da un altro processo; l'intestazione in imports è
+        salvata per prima, così un import interrotto viene comunque eliminato
+        dopo IMPORT_TTL_HOURS.
+        """
+        now = datetime.now(timezone.utc)
+        with self._write():
+            self._purge_imports(now - timedelta(hours=IMPORT_TTL_HOURS))
+            self.cursor.execute(
+                "INSERT INTO imports (chat_id, kind, created_at) VALUES (?, ?, ?);",
+                (chat_id, "catalogue", now.isoformat())
+            )
+            import_id = self.cursor.lastrowid
+            self._commit()
+        total = 0
+        try:
+            for batch in batches:
+                with self._write():
+                    self.cursor.executemany(
+                        "INSERT INTO import_staging (import_id, seq, name, points) VALUES (?, ?, ?, ?);",
+                        ((import_id, total + i, name, points) for i, (name, points) in enumerate(batch))
+                    )
+                    self._commit()
+                total += len(batch)
+        except Exception:
+            self.discard_import(import_id)
+            raise
+        return import_id, total
+
+    def _drop_import(self, import_id):
+        # Da chiamare con self.lock acquisito, prima del commit
+        self.cursor.execute("DELETE FROM import_staging WHERE import_id = ?;", (import_id,))
+        self.cursor.execute("DELETE FROM imports WHERE id = ?;", (import_id,))
+
+    def _purge_imports(self, before):
+        # Anteprime abbandonate: da chiamare con self.lock acquisito
+        stale = [r["id"] for r in self.cursor.execute(
+            "SELECT id FROM imports WHERE created_at < ?;", (before.isoformat(),)
+        ).fetchall()]
+        for import_id in stale:
+            self._drop_import(import_id)
+
+    def discard_import(self, import_id):
+        """Scarta le righe di un import non applicato"""
+        with self._write():
+            self._drop_import(import_id)
+            self._commit()
+
+    def get_import(self, import_id):
+        """Intestazione di un import in attesa (id, chat_id, kind, created_at), o None"""
+        return self._read(
+            "SELECT id, chat_id, kind, created_at FROM imports WHERE id = ?;", (import_id,)
+        ).fetchone()
 
     # ————— METODI USERS —————
     def register_user(self, chat_id, username, first_name):
-        with self.lock:
+        with self._write():
             self.cursor.execute(
                 "INSERT OR IGNORE INTO users(chat_id, username, first_name) VALUES(?, ?, ?);",
                 (chat_id, username, first_name)
             )
-            self.db.commit()
+            self._commit()
 
     def set_registered(self, chat_id, is_reg=True):
-        with self.lock:
+        with self._write():
             self.cursor.execute(
                 "UPDATE users SET registered = ? WHERE chat_id = ?;",
                 (1 if is_reg else 0, chat_id)
             )
-            self.db.commit()
+            self._commit()
+            self._after_commit(self._user_changed, chat_id)
+            
+            if not is_reg:
+                self._after_commit(self.ranks.remove, chat_id)
+            elif self.ranks.loaded:
+                row = self.cursor.execute(
+                    "SELECT total_points, username, first_name FROM users WHERE chat_id = ?;", (chat_id,)
+                ).fetchone()
+                if row:
+                    self._after_commit(self.ranks.set, chat_id, row["total_points"], row["username"], row["first_name"])
 
     def unregister_user(self, chat_id):
-        with self.lock:
+        with self._write():
             self.cursor.execute("UPDATE users SET registered = 0 WHERE chat_id = ?;", (chat_id,))
-            self.db.commit()
+            self._commit()
+            self._after_commit(self._user_changed, chat_id)
+            self._after_commit(self.ranks.remove, chat_id)
+
+    def _user_changed(self, chat_id):
+        self.users_version += 1
+        self.profiles.invalidate(chat_id)
 
     def get_registered_users(self):
-        with self.lock:
-            return self.cursor.execute(
-                "SELECT chat_id, username, first_name FROM users WHERE registered = 1 ORDER BY username;"
+        return self._read(
+            "SELECT chat_id, username, first_name FROM users WHERE registered = 1 ORDER BY username;"
+        ).fetchall()
+
+    def _load_profiles(self, chat_ids):
+        # Blocchi da 500 per restare sotto il limite di parametri di SQLite
+        chat_ids = list(chat_ids)
+        for start in range(0, len(chat_ids), 500):
+            chunk = chat_ids[start:start + 500]
+            yield from self._read(
+                f"SELECT chat_id, username, first_name FROM users "
+                f"WHERE chat_id IN ({', '.join('?' * len(chunk))}) AND registered = 1;",
+                chunk
             ).fetchall()
 
+    def get_users(self, chat_ids):
+        """Utenti registrati per chat_id: {chat_id: utente}, senza quelli non registrati"""
+        self._sync_caches()
+        found = self.profiles.get_many(chat_ids, self._load_profiles)
+        return {chat_id: user for chat_id, user in found.items() if user is not None}
+
+    def get_user(self, chat_id):
+        """Un utente registrato (chat_id, username, first_name), o None"""
+        return self.get_users((chat_id,)).get(chat_id)
+
     def get_registered_chat_ids(self):
+        return [r["chat_id"] for r in self._read(
+            "SELECT chat_id FROM users WHERE registered = 1"
+        ).fetchall()]
+
+    def _ensure_ranks(self):
+        # Carica l'indice delle posizioni al primo utilizzo
+        self._sync_caches()
+        if self.ranks.loaded:
+            return
         with self.lock:
-            return [r["chat_id"] for r in self.cursor.execute(
-                "SELECT chat_id FROM users WHERE registered = 1"
-            ).fetchall()]
+            if not self.ranks.loaded:
+                # Gli aggiornamenti in attesa del commit non devono sommarsi a un indice che già li contiene
+                if self.committed_seq != self.write_seq:
+                    self._commit_group()
+                self.ranks.load(
+                    (r["chat_id"], r["total_points"], r["username"], r["first_name"]) for r in self.cursor.execute(
+                        "SELECT chat_id, total_points, username, first_name FROM users WHERE registered = 1;"
+                    ).fetchall()
+                )
 
     def get_leaderboard(self, limit=None):
-        with self.lock:
-            query = "SELECT chat_id, username, first_name, total_points FROM users WHERE registered = 1 ORDER BY total_points DESC"
-            if limit:
-                query += f" LIMIT {limit}"
-            return self.cursor.execute(query).fetchall()
+        """Classifica degli utenti registrati, dall'indice in memoria"""
+        self._ensure_ranks()
+        return self.ranks.top(limit)
+
+    def iter_leaderboard(self, batch_size=500):
+        """Classifica completa letta dal cursore a blocchi, per gli export.
+
+        Tiene occupata una connessione del pool finché il generatore non è
+        consumato o chiuso.
+        """
+        # Le scritture non ancora confermate devono comparire nell'export
+        self.flush()
+        with self._reader() as conn:
+            cursor = conn.execute(
+                "SELECT chat_id, username, first_name, total_points FROM users "
+                "WHERE registered = 1 ORDER BY total_points DESC, chat_id;"
+            )
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+
+    def get_leaderboard_text(self, key, render, limit=None):
+        """Classifica impaginata con render(righe), rigenerata solo quando cambiano i punti"""
+        self._ensure_ranks()
+        return self.ranks.render(key, limit, render)
 
     def get_user_rank_and_points(self, chat_id):
-        with self.lock:
-            res = self.cursor.execute(
-                """
-                SELECT chat_id, total_points,
-                       (SELECT COUNT(*) + 1 FROM users u2
-                        WHERE u2.total_points > u1.total_points AND u2.registered = 1
-                       ) AS rank
-                FROM users u1 WHERE chat_id = ? AND registered = 1;
-                """, (chat_id,)
-            ).fetchone()
-            return res
+        """Posizione e punti di un utente registrato, dall'indice in memoria"""
+        self._ensure_ranks()
+        res = self.ranks.rank(chat_id)
+        if not res:
+            return None
+        rank, points = res
+        return {"chat_id": chat_id, "total_points": points, "rank": rank}
 
     def update_user_points(self, chat_id, points):
         """Aggiorna i punti di un utente"""
-        with self.lock:
+        with self._write():
             self.cursor.execute(
                 "UPDATE users SET total_points = ? WHERE chat_id = ?;",
                 (points, chat_id)
             )
-            self.db.commit()
+            self._commit()
+            self._after_commit(self.ranks.update, chat_id, points)
 
     # ————— METODI MATTI —————
     def add_matto(self, name, points):
-        with self.lock:
-            self.cursor.execute(
-                "INSERT OR REPLACE INTO matti (name, points) VALUES (?, ?);",
-                (name, points)
-            )
-            self.db.commit()
+        with self._write():
+            self.cursor.execute(MATTO_UPSERT, (name, points))
+            self._commit()
+            self._after_commit(self.catalogue.invalidate)
         return True
 
     def remove_matto(self, matto_id):
-        with self.lock:
+        with self._write():
             self.cursor.execute("DELETE FROM matti WHERE id = ?;", (matto_id,))
-            self.db.commit()
+            self._commit()
+            self._after_commit(self.catalogue.invalidate)
         return True
 
+    def _load_catalogue(self):
+        return self._read(
+            "SELECT id, name, points FROM matti ORDER BY points DESC, name;"
+        ).fetchall()
+
     def list_matti(self):
-        with self.lock:
-            return self.cursor.execute(
-                "SELECT id, name, points FROM matti ORDER BY points DESC, name;"
-            ).fetchall()
+        """Catalogo dei matti, servito dalla cache in memoria"""
+        self._sync_caches()
+        return self.catalogue.list(self._load_catalogue)
 
     def get_matto_by_id(self, matto_id):
-        with self.lock:
-            return self.cursor.execute(
-                "SELECT id, name, points FROM matti WHERE id = ?;", (matto_id,)
-            ).fetchone()
+        self._sync_caches()
+        return self.catalogue.get(matto_id, self._load_catalogue)
+
+    def catalogue_stats(self):
+        """Contatori hit/miss della cache del catalogo"""
+        return self.catalogue.stats()
+
+    def stage_catalogue_import(self, chat_id, batches):
+        """Salva i blocchi [(nome, punti), ...] per un'anteprima: (import_id, righe lette)"""
+        return self._stage_import(chat_id, batches)
+
+    def _catalogue_diff(self, table, import_id, examples):
+        # Conteggi in una sola query; gli esempi solo se richiesti
+        first = STAGED_FIRST_OCCURRENCE.format(table=table)
+        row = self.cursor.execute(
+            f"""
+            SELECT COUNT(*) AS total,
+                   COALESCE(SUM(m.id IS NULL), 0) AS new,
+                   COALESCE(SUM(m.points <> i.points), 0) AS changed,
+                   COALESCE(SUM(m.points = i.points), 0) AS unchanged
+            FROM {table} i
+            LEFT JOIN matti m ON m.name = i.name
+            WHERE {first};
+            """,
+            (import_id, import_id)
+        ).fetchone()
+        diff = dict(row)
+        if examples:
+            diff["examples"] = [tuple(r) for r in self.cursor.execute(
+                f"""
+                SELECT i.name, m.points AS old_points, i.points AS new_points
+                FROM {table} i
+                LEFT JOIN matti m ON m.name = i.name
+                WHERE {first} AND (m.id IS NULL OR m.points <> i.points)
+                ORDER BY i.seq LIMIT ?;
+                """,
+                (import_id, import_id, examples)
+            ).fetchall()]
+        return diff
+
+    def _upsert_catalogue(self, table, import_id):
+        # I matti esistenti sono aggiornati sul posto: l'id non cambia e le segnalazioni restano collegate.
+        # "WHERE true" evita che SQLite legga ON CONFLICT come parte della SELECT
+        self.cursor.execute(
+            f"""
+            INSERT INTO matti (name, points)
+            SELECT i.name, i.points FROM {table} i
+            WHERE true AND {STAGED_FIRST_OCCURRENCE.format(table=table)}
+            ORDER BY i.seq
+            ON CONFLICT(name) DO UPDATE SET points = excluded.points
+            WHERE points <> excluded.points;
+            """,
+            (import_id, import_id)
+        )
 
-    def load_matti_from_data(self, matti_data):
-        """Carica una lista di matti dal formato [(nome, punti), ...]"""
+    def diff_catalogue_import(self, import_id, examples=10):
+        """Confronto tra un import e il catalogo: conteggi new/changed/unchanged ed esempi.
+
+        Gli esempi sono tuple (nome, punti attuali o None, nuovi punti).
+        """
         with self.lock:
-            self.cursor.executemany(
-                "INSERT OR REPLACE INTO matti (name, points) VALUES (?, ?);", 
-                matti_data
-            )
-            self.db.commit()
-        return len(matti_data)
+            return self._catalogue_diff("import_staging", import_id, examples)
+
+    def apply_catalogue_import(self, import_id):
+        """Applica un import in anteprima al catalogo in una transazione; None se non esiste più"""
+        with self._write():
+            if not self.cursor.execute("SELECT 1 FROM imports WHERE id = ?;", (import_id,)).fetchone():
+                return None
+            diff = self._catalogue_diff("import_staging", import_id, 0)
+            self._upsert_catalogue("import_staging", import_id)
+            self._drop_import(import_id)
+            self._commit()
+            self._after_commit(self.catalogue.invalidate)
+        return diff
 
     # ————— METODI SIGHTINGS —————
     def add_sighting(self, chat_id, matto_id, points, file_id, target_chat_id=None, media_type="photo"):
         now = datetime.now(timezone.utc).isoformat()
-        with self.lock:
+        with self._write():
             self.cursor.execute(
                 "INSERT INTO sightings(user_chat_id, matto_id, points_awarded, file_id, media_type, timestamp, target_chat_id) VALUES(?, ?, ?, ?, ?, ?, ?);",
                 (chat_id, matto_id, points, file_id, media_type, now, target_chat_id)
@@ -246,49 +1046,76 @@ class DatabaseManager:
                     (abs(points), target_chat_id)
                 )
             
-            self.db.commit()
+            self._commit()
+            
+            if points > 0:
+                self._after_commit(self.ranks.add, chat_id, points)
+            if target_chat_id:
+                self._after_commit(self.ranks.add, target_chat_id, -abs(points))
 
-    def get_matto_gallery(self, matto_id):
-        with self.lock:
-            return self.cursor.execute(
-                "SELECT s.id, s.file_id, s.media_type, s.timestamp, u.username, u.first_name, t.username AS target_username, t.first_name AS target_first_name "
-                "FROM sightings s "
-                "JOIN users u ON s.user_chat_id = u.chat_id "
-                "LEFT JOIN users t ON s.target_chat_id = t.chat_id "
-                "WHERE matto_id = ? ORDER BY s.timestamp DESC;",
-                (matto_id,)
-            ).fetchall()
+    def _sightings_page(self, select_sql, where_sql, params, cursor, direction, limit):
+        """Pagina di segnalazioni con paginazione keyset sull'id decrescente.
 
-    def get_user_gallery(self, chat_id):
-        with self.lock:
-            # Ottieni tutte le segnalazioni dell'utente
-            sightings = self.cursor.execute(
-                "SELECT s.id, m.name, s.points_awarded, s.file_id, s.media_type, s.timestamp, t.username AS target_username, t.first_name AS target_first_name "
-                "FROM sightings s "
-                "JOIN matti m ON s.matto_id = m.id "
-                "LEFT JOIN users t ON s.target_chat_id = t.chat_id "
-                "WHERE s.user_chat_id = ? ORDER BY s.timestamp DESC;",
-                (chat_id,)
-            ).fetchall()
-            
-            # Raggruppa per matto
-            matto_stats = defaultdict(lambda: {"count": 0, "points": 0, "photos": []})
-            for s in sightings:
-                name = s["name"]
-                matto_stats[name]["count"] += 1
-                matto_stats[name]["points"] += s["points_awarded"]
-                matto_stats[name]["photos"].append({
-                    "file_id": s["file_id"],
-                    "media_type": s["media_type"] if s["media_type"] else "photo",
-                    "sighting_id": s["id"],
-                    "target_username": s["target_username"],
-                    "target_first_name": s["target_first_name"]
-                })
-            
-            return matto_stats
+        L'id AUTOINCREMENT segue l'ordine di inserimento, quindi quello
+        cronologico. cursor è l'id della segnalazione di confine della pagina
+        corrente, e funziona anche se nel frattempo è stata eliminata: "next"
+        restituisce le più vecchie, "prev" le più recenti. Restituisce
+        (righe, has_prev, has_next).
+        """
+        query = select_sql + " WHERE " + where_sql
+        args = list(params)
+        if cursor is not None:
+            query += " AND s.id < ?" if direction == "next" else " AND s.id > ?"
+            args.append(cursor)
+        order = "DESC" if direction == "next" else "ASC"
+        query += f" ORDER BY s.id {order} LIMIT ?;"
+        args.append(limit + 1)
+        
+        rows = self._read(query, args).fetchall()
+        
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if direction == "next":
+            return rows, cursor is not None, more
+        rows.reverse()
+        return rows, more, True
+
+    def get_matto_gallery_page(self, matto_id, cursor=None, direction="next", limit=GALLERY_PAGE_SIZE):
+        """Pagina della galleria di un matto, dalla segnalazione più recente"""
+        return self._sightings_page(
+            "SELECT s.id, s.file_id, s.media_type, s.timestamp, u.username, u.first_name, t.username AS target_username, t.first_name AS target_first_name "
+            "FROM sightings s "
+            "JOIN users u ON s.user_chat_id = u.chat_id "
+            "LEFT JOIN users t ON s.target_chat_id = t.chat_id",
+            "s.matto_id = ?", (matto_id,), cursor, direction, limit
+        )
+
+    def get_user_gallery_page(self, chat_id, cursor=None, direction="next", limit=GALLERY_PAGE_SIZE):
+        """Pagina delle segnalazioni di un utente, dalla più recente"""
+        return self._sightings_page(
+            "SELECT s.id, m.name, s.points_awarded, s.file_id, s.media_type, s.timestamp, t.username AS target_username, t.first_name AS target_first_name "
+            "FROM sightings s "
+            "JOIN matti m ON s.matto_id = m.id "
+            "LEFT JOIN users t ON s.target_chat_id = t.chat_id",
+            "s.user_chat_id = ?", (chat_id,), cursor, direction, limit
+        )
+
+    def count_matto_sightings(self, matto_id):
+        return self._read(
+            "SELECT COUNT(*) FROM sightings WHERE matto_id = ?;", (matto_id,)
+        ).fetchone()[0]
+
+    def get_user_matto_stats(self, chat_id):
+        """Segnalazioni e punti di un utente per matto (name, sightings, points), dal riepilogo"""
+        return self._read(
+            "SELECT m.name, st.sightings, st.points FROM user_matto_stats st "
+            "JOIN matti m ON m.id = st.matto_id "
+            "WHERE st.user_chat_id = ? ORDER BY st.sightings DESC, st.points DESC, m.name;",
+            (chat_id,)
+        ).fetchall()
 
     def delete_sighting(self, sighting_id):
-        with self.lock:
+        with self._write():
             # Ottieni i dettagli della segnalazione
             sighting = self.cursor.execute(
                 "SELECT user_chat_id, points_awarded, target_chat_id FROM sightings WHERE id = ?;",
@@ -314,37 +1141,72 @@ class DatabaseManager:
                     (abs(sighting["points_awarded"]), sighting["target_chat_id"])
                 )
             
-            self.db.commit()
+            self._commit()
+            
+            self._after_commit(self.ranks.add, sighting["user_chat_id"], -sighting["points_awarded"])
+            if sighting["target_chat_id"]:
+                self._after_commit(self.ranks.add, sighting["target_chat_id"], abs(sighting["points_awarded"]))
             return True
 
     # ————— METODI SUGGESTIONS —————
     def add_suggestion(self, user_chat_id, name, points):
         """Aggiunge un suggerimento per un nuovo matto"""
-        with self.lock:
+        with self._write():
             self.cursor.execute(
                 "INSERT INTO matto_suggestions (user_chat_id, suggested_name, suggested_points) VALUES (?, ?, ?);",
                 (user_chat_id, name, points)
             )
-            self.db.commit()
+            self._commit()
             return self.cursor.lastrowid
 
+    def add_suggestions_bulk(self, user_chat_id, batches):
+        """Aggiunge molti suggerimenti, a blocchi [(nome, punti), ...], con un solo commit.
+
+        Salta i nomi già presenti nel catalogo, già in attesa di approvazione o
+        ripetuti nel file. Restituisce (inseriti, saltati).
+        """
+        stage_id, total = self._stage_rows(batches)
+        try:
+            with self._write():
+                self.cursor.execute(
+                    f"""
+                    INSERT INTO matto_suggestions (user_chat_id, suggested_name, suggested_points)
+                    SELECT ?, i.name, i.points
+                    FROM temp.import_rows i
+                    WHERE {STAGED_FIRST_OCCURRENCE.format(table="temp.import_rows")}
+                      AND NOT EXISTS (SELECT 1 FROM matti m WHERE m.name = i.name)
+                      AND NOT EXISTS (
+                          SELECT 1 FROM matto_suggestions s
+                          WHERE s.suggested_name = i.name AND s.status = 'pending'
+                      )
+                    ORDER BY i.seq;
+                    """,
+                    (user_chat_id, stage_id, stage_id)
+                )
+                inserted = self.cursor.rowcount
+                self.cursor.execute("DELETE FROM temp.import_rows WHERE import_id = ?;", (stage_id,))
+                self._commit()
+        except Exception:
+            self._discard_rows(stage_id)
+            raise
+        return inserted, total - inserted
+
     def get_pending_suggestions(self):
         """Ottiene tutti i suggerimenti in attesa di approvazione"""
-        with self.lock:
-            return self.cursor.execute(
-                """
-                SELECT s.id, s.suggested_name, s.suggested_points, s.created_at,
-                       u.username, u.first_name, u.chat_id as user_chat_id
-                FROM matto_suggestions s
-                JOIN users u ON s.user_chat_id = u.chat_id
-                WHERE s.status = 'pending'
-                ORDER BY s.created_at ASC;
-                """
-            ).fetchall()
+        return self._read(
+            """
+            SELECT s.id, s.suggested_name, s.suggested_points, s.created_at,
+                   u.username, u.first_name, u.chat_id as user_chat_id
+            FROM matto_suggestions s
+            JOIN users u ON s.user_chat_id = u.chat_id
+            WHERE s.status = 'pending'
+            ORDER BY s.created_at ASC;
+            """
+        ).fetchall()
 
     def approve_suggestion(self, suggestion_id, admin_notes=None):
         """Approva un suggerimento e aggiunge il matto"""
-        with self.lock:
+        with self._write():
             # Ottieni i dettagli del suggerimento
             suggestion = self.cursor.execute(
                 "SELECT suggested_name, suggested_points FROM matto_suggestions WHERE id = ? AND status = 'pending';",
@@ -355,10 +1217,7 @@ class DatabaseManager:
                 return False
             
             # Aggiungi il matto
-            self.cursor.execute(
-                "INSERT OR REPLACE INTO matti (name, points) VALUES (?, ?);",
-                (suggestion["suggested_name"], suggestion["suggested_points"])
-            )
+            self.cursor.execute(MATTO_UPSERT, (suggestion["suggested_name"], suggestion["suggested_points"]))
             
             # Aggiorna lo stato del suggerimento
             now = datetime.now(timezone.utc).isoformat()
@@ -367,45 +1226,210 @@ class DatabaseManager:
                 (admin_notes, now, suggestion_id)
             )
             
-            self.db.commit()
+            self._commit()
+            self._after_commit(self.catalogue.invalidate)
             return True
 
     def reject_suggestion(self, suggestion_id, admin_notes=None):
         """Rifiuta un suggerimento"""
-        with self.lock:
+        with self._write():
             now = datetime.now(timezone.utc).isoformat()
             self.cursor.execute(
                 "UPDATE matto_suggestions SET status = 'rejected', admin_notes = ?, reviewed_at = ? WHERE id = ?;",
                 (admin_notes, now, suggestion_id)
             )
-            self.db.commit()
+            self._commit()
             return True
 
     def get_suggestion_by_id(self, suggestion_id):
         """Ottiene un suggerimento specifico"""
-        with self.lock:
-            return self.cursor.execute(
-                """
-                SELECT s.id, s.suggested_name, s.suggested_points, s.status, s.admin_notes, s.created_at,
-                       u.username, u.first_name, u.chat_id as user_chat_id
-                FROM matto_suggestions s
-                JOIN users u ON s.user_chat_id = u.chat_id
-                WHERE s.id = ?;
-                """,
-                (suggestion_id,)
-            ).fetchone()
+        return self._read(
+            """
+            SELECT s.id, s.suggested_name, s.suggested_points, s.status, s.admin_notes, s.created_at,
+                   u.username, u.first_name, u.chat_id as user_chat_id
+            FROM matto_suggestions s
+            JOIN users u ON s.user_chat_id = u.chat_id
+            WHERE s.id = ?;
+            """,
+            (suggestion_id,)
+        ).fetchone()
 
     def get_user_suggestions(self, user_chat_id):
         """Ottiene tutti i suggerimenti di un utente"""
-        with self.lock:
-            return self.cursor.execute(
-                "SELECT id, suggested_name, suggested_points, status, admin_notes, created_at FROM matto_suggestions WHERE user_chat_id = ? ORDER BY created_at DESC;",
-                (user_chat_id,)
-            ).fetchall()
+        return self._read(
+            "SELECT id, suggested_name, suggested_points, status, admin_notes, created_at FROM matto_suggestions WHERE user_chat_id = ? ORDER BY created_at DESC;",
+            (user_chat_id,)
+        ).fetchall()
+
+    # ————— METODI OUTBOX —————
+    # Accodamenti ed esiti delle consegne sono confermati subito anche con il
+    # commit di gruppo: un crash non deve perdere un messaggio già accodato né
+    # far rispedire una consegna già segnata come inviata.
+    def enqueue_outbox(self, chat_ids, payloads):
+        """Accoda la sequenza di payload per ogni chat; restituisce il numero di consegne accodate"""
+        now = datetime.now(timezone.utc).isoformat()
+        data = json.dumps(payloads)
+        rows = [(cid, data, now, now) for cid in dict.fromkeys(chat_ids)]
+        with self._write():
+            self.cursor.executemany(
+                "INSERT INTO outbox (chat_id, payload, created_at, next_attempt_at) VALUES (?, ?, ?, ?);",
+                rows
+            )
+            self._commit(durable=True)
+        return len(rows)
+
+    def get_outbox_batch(self, limit=100):
+        """Ottiene le consegne in attesa il cui prossimo tentativo è scaduto"""
+        now = datetime.now(timezone.utc).isoformat()
+        return self._read(
+            "SELECT id, chat_id, payload, attempts FROM outbox "
+            "WHERE status = 'pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?;",
+            (now, limit)
+        ).fetchall()
+
+    def mark_outbox_sent(self, outbox_ids):
+        now = datetime.now(timezone.utc).isoformat()
+        with self._write():
+            self.cursor.executemany(
+                "UPDATE outbox SET status = 'sent', sent_at = ? WHERE id = ?;",
+                [(now, oid) for oid in outbox_ids]
+            )
+            self._commit(durable=True)
+
+    def mark_outbox_failed(self, outbox_id, error, next_attempt_at=None):
+        """Registra un tentativo fallito: senza next_attempt_at la consegna è abbandonata"""
+        with self._write():
+            self.cursor.execute(
+                "UPDATE outbox SET attempts = attempts + 1, last_error = ?, "
+                "status = ?, next_attempt_at = COALESCE(?, next_attempt_at) WHERE id = ?;",
+                (error, 'pending' if next_attempt_at else 'failed', next_attempt_at, outbox_id)
+            )
+            self._commit(durable=True)
+
+    def purge_outbox(self, sent_before):
+        """Elimina le consegne completate prima della data indicata"""
+        with self._write():
+            self.cursor.execute(
+                "DELETE FROM outbox WHERE status = 'sent' AND sent_at < ?;", (sent_before,)
+            )
+            self._commit()
+            return self.cursor.rowcount
+
+    # ————— METODI SESSIONI CHAT —————
+    def write_chat_sessions(self, upserts, deletes):
+        """Applica in una transazione un batch di sessioni (chat_id, state, data, expires_at) e cancellazioni"""
+        with self._write():
+            self.cursor.executemany(
+                "INSERT INTO chat_sessions (chat_id, state, data, expires_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(chat_id) DO UPDATE SET state = excluded.state, data = excluded.data, "
+                "expires_at = excluded.expires_at;",
+                upserts
+            )
+            self.cursor.executemany(
+                "DELETE FROM chat_sessions WHERE chat_id = ?;", [(cid,) for cid in deletes]
+            )
+            self._commit()
+
+    def get_chat_session(self, chat_id, now):
+        """Ottiene la sessione di una chat se non è scaduta"""
+        return self._read(
+            "SELECT state, data, expires_at FROM chat_sessions WHERE chat_id = ? AND expires_at > ?;",
+            (chat_id, now)
+        ).fetchone()
+
+    def get_chat_session_ids(self, now):
+        """Ottiene le chat con una sessione non scaduta"""
+        rows = self._read(
+            "SELECT chat_id FROM chat_sessions WHERE expires_at > ?;", (now,)
+        ).fetchall()
+        return [row["chat_id"] for row in rows]
+
+    def purge_chat_sessions(self, now):
+        """Elimina le sessioni scadute"""
+        with self._write():
+            self.cursor.execute("DELETE FROM chat_sessions WHERE expires_at <= ?;", (now,))
+            self._commit()
+            return self.cursor.rowcount
 
     def close(self):
-        """Chiude la connessione al database"""
+        """Conferma le scritture in attesa e chiude le connessioni al database"""
+        with self.lock:
+            self.closing = True
+            if self.committed_seq != self.write_seq:
+                try:
+                    self._commit_group()
+                except sqlite3.Error as e:
+                    logger.error(f"Scritture in attesa perse alla chiusura: {str(e)}")
+            self.committed.notify_all()
+        if self.committer is not None:
+            self.committer.join()
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers.clear()
         self.db.close()
 
+def _scanned_table(detail):
+    """Tabella (o alias) letta per intero secondo una riga di EXPLAIN QUERY PLAN, o None.
+
+    SQLite prima della 3.36 scrive "SCAN TABLE nome", le versioni successive "SCAN nome".
+
+    >>> _scanned_table("SCAN users")
+    'users'
+    >>> _scanned_table("SCAN TABLE users")
+    'users'
+    >>> _scanned_table("SCAN TABLE sightings AS s")
+    'sightings'
+    >>> _scanned_table("SCAN s USING COVERING INDEX idx_sightings_user")
+    's'
+    >>> _scanned_table("SEARCH users USING INDEX idx_users_leaderboard (registered=?)") is None
+    True
+    """
+    words = detail.split()
+    if len(words) < 2 or words[0] != "SCAN":
+        return None
+    if words[1] == "TABLE" and len(words) > 2:
+        return words[2]
+    return words[1]
+
+def audit_query_plans(calls=PLAN_AUDIT_CALLS):
+    """Esegue le query del modulo su un database temporaneo e ne analizza i piani.
+
+    Restituisce una lista di (metodo, sql, dettaglio) per ogni query che ricorre
+    a una scansione completa di una delle HOT_TABLES.
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        manager = DatabaseManager(os.path.join(tmp, "audit.db"))
+        try:
+            manager.init_db()
+            manager.upgrade_db()
+            
+            statements = []
+            manager.set_trace_callback(statements.append)
+            executed = []
+            for name, args in calls:
+                del statements[:]
+                result = getattr(manager, name)(*args)
+                if hasattr(result, "__next__"):
+                    # I generatori eseguono la query solo quando vengono consumati
+                    list(result)
+                executed.extend((name, sql) for sql in statements)
+            manager.set_trace_callback(None)
+            
+            violations = []
+            for name, sql in executed:
+                if not sql.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "INSERT")):
+                    continue
+                # I piani riportano gli alias (es. "SCAN s"): si risale alla tabella
+                aliases = {alias: table for table, alias in AUDIT_ALIAS_RE.findall(sql)}
+                for row in manager.db.execute("EXPLAIN QUERY PLAN " + sql).fetchall():
+                    detail = row["detail"]
+                    scanned = _scanned_table(detail)
+                    if aliases.get(scanned, scanned) in HOT_TABLES:
+                        violations.append((name, sql, detail))
+            return violations
+        finally:
+            manager.close()
+
 # Istanza globale del database
 db_manager = DatabaseManager()
@@ -1,20 +1,22 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import tempfile
-import os
 import logging
 from telebot import types
 from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-from telebot.apihelper import ApiException
 
 from config import ADMIN_CHAT_ID, REGISTRATION_PASSWORD, logger
 from database import db_manager
 from states import state_manager
+from broadcast import announcement_payloads
+from outbox import outbox_dispatcher
+from keyboards import selection_keyboard, search_keyboard, EXCLUDE_SELF
 from utils import (
-    parse_matti_file_content, create_temp_file_from_content, 
-    cleanup_temp_file, format_username, format_user_info,
-    create_leaderboard_text, save_text_to_temp_file, escape_markdown_v1
+    ParseReport, parse_matti_stream, download_chunks, import_format,
+    format_username, format_user_info,
+    create_leaderboard_text, text_to_buffer, export_leaderboard, EXPORT_FORMATS,
+    escape_markdown_v1,
+    build_sighting_text, build_sighting_caption
 )
 
 # ————— HANDLER COMANDI BASE —————
@@ -77,6 +79,7 @@ def handle_help(bot, msg: types.Message):
 /remove_matto - ❌ Rimuovi un matto
 /upload_matti - 📤 Carica matti da file
 /setpunti - 🔢 Modifica punti di un utente
+/export_classifica - 📊 Esporta la classifica (csv o json)
 
 🎯 *Come giocare:*
 1️⃣ Registrati con /start
@@ -118,36 +121,54 @@ def handle_me(bot, msg: types.Message):
         parse_mode="Markdown"
     )
 
+def render_full_leaderboard(rows):
+    """Classifica completa in testo semplice, senza markdown problematico"""
+    if not rows:
+        return "🏆 Classifica Completa\nLa classifica è vuota!"
+    lines = ["🏆 Classifica Completa"]
+    for i, row in enumerate(rows):
+        usr = format_username(row['username'], row['first_name'], row['chat_id'])
+        lines.append(f"🔹 {i+1}. {usr} – {row['total_points']} punti")
+    return "\n".join(lines) + "\n"
+
 def handle_leaderboard(bot, msg: types.Message):
-    top = db_manager.get_leaderboard(10)
-    text = create_leaderboard_text(top, "🏆 *Classifica – Top10*", True, 10)
+    text = db_manager.get_leaderboard_text(
+        "top10", lambda rows: create_leaderboard_text(rows, "🏆 *Classifica – Top10*", True, 10), limit=10
+    )
     bot.send_message(msg.chat.id, text, parse_mode="MarkdownV2")
 
 def handle_full_leaderboard(bot, msg: types.Message):
-    all_users = db_manager.get_leaderboard()
-    
-    # Crea il testo della classifica senza markdown problematico
-    if not all_users:
-        text = "🏆 Classifica Completa\nLa classifica è vuota!"
-    else:
-        text = "🏆 Classifica Completa\n"
-        for i, row in enumerate(all_users):
-            usr = format_username(row['username'], row['first_name'], row['chat_id'])
-            pts = row['total_points']
-            text += f"🔹 {i+1}. {usr} – {pts} punti\n"
+    text = db_manager.get_leaderboard_text("full", render_full_leaderboard)
     
-    # Se il messaggio è troppo lungo, invialo come file
+    # Se il messaggio è troppo lungo, invialo come file (dalla memoria, senza file temporanei)
     if len(text) > 4000:
-        tmp_path = save_text_to_temp_file(text)
-        try:
-            with open(tmp_path, "rb") as f:
-                bot.send_document(msg.chat.id, f, caption="Classifica completa")
-        finally:
-            cleanup_temp_file(tmp_path)
+        bot.send_document(
+            msg.chat.id, text_to_buffer(text),
+            caption="Classifica completa", visible_file_name="classifica.txt"
+        )
     else:
         # Invia senza parse_mode per evitare problemi di parsing
         bot.send_message(msg.chat.id, text, parse_mode=None)
 
+def handle_export_leaderboard(bot, msg: types.Message):
+    """/export_classifica [csv|json]: classifica completa come file, solo admin"""
+    if msg.chat.id != ADMIN_CHAT_ID:
+        bot.send_message(msg.chat.id, "❌ Comando riservato all'admin!")
+        return
+    
+    parts = msg.text.split()
+    fmt = parts[1].lower() if len(parts) > 1 else "csv"
+    if fmt not in EXPORT_FORMATS:
+        bot.send_message(msg.chat.id, "❌ Formato non supportato. Usa: /export_classifica [csv|json]", parse_mode=None)
+        return
+    
+    # Le righe passano dal cursore al buffer senza costruire la classifica intera in memoria
+    buf = export_leaderboard(db_manager.iter_leaderboard(), fmt)
+    bot.send_document(
+        msg.chat.id, buf,
+        caption="📊 Export classifica", visible_file_name=f"classifica.{fmt}"
+    )
+
 def handle_unregister(bot, msg: types.Message):
     db_manager.unregister_user(msg.chat.id)
     bot.send_message(
@@ -175,19 +196,11 @@ def handle_listmatti(bot, msg: types.Message):
 
 # ————— HANDLER GALLERIE —————
 def handle_galleria_utente(bot, msg: types.Message):
-    users = db_manager.get_registered_users()
-    if not users:
+    markup = selection_keyboard("select_user")
+    if not markup:
         bot.send_message(msg.chat.id, "👥 Nessun utente registrato.")
         return
     
-    markup = InlineKeyboardMarkup(row_width=1)
-    for user in users:
-        username = format_username(user['username'], user['first_name'], user['chat_id'])
-        markup.add(InlineKeyboardButton(
-            text=username,
-            callback_data=f"select_user|{user['chat_id']}"
-        ))
-    
     bot.send_message(
         msg.chat.id, 
         "👤 Scegli un utente per vedere la sua galleria:", 
@@ -195,8 +208,8 @@ def handle_galleria_utente(bot, msg: types.Message):
     )
 
 def handle_galleria_matto(bot, msg: types.Message):
-    items = db_manager.list_matti()
-    if not items:
+    markup = selection_keyboard("select_matto")
+    if not markup:
         bot.send_message(
             msg.chat.id, 
             "📂 Nessun matto definito.",
@@ -204,37 +217,38 @@ def handle_galleria_matto(bot, msg: types.Message):
         )
         return
     
-    markup = InlineKeyboardMarkup(row_width=2)
-    for itm in items:
-        markup.add(InlineKeyboardButton(
-            text=f"{itm['name']} ({itm['points']} punti)",
-            callback_data=f"select_matto|{itm['id']}"
-        ))
-    
     bot.send_message(
         msg.chat.id, 
         "🏞️ Scegli un matto per vedere la sua galleria:", 
         reply_markup=markup
     )
 
+def handle_selection_search(bot, msg: types.Message):
+    """Testo inviato dopo '🔍 Cerca per nome' in una tastiera di selezione"""
+    chat_id = msg.chat.id
+    prefix = state_manager.pop_pending_search(chat_id)
+    if not prefix:
+        return
+    
+    exclude = chat_id if prefix in EXCLUDE_SELF else None
+    markup = search_keyboard(prefix, msg.text, exclude=exclude)
+    if not markup:
+        bot.send_message(chat_id, "🔍 Nessun risultato. Riprova dal pulsante Cerca.", parse_mode=None)
+        return
+    
+    bot.send_message(chat_id, f"🔍 Risultati per \"{msg.text.strip()}\":", reply_markup=markup, parse_mode=None)
+
 # ————— HANDLER ADMIN —————
 def handle_setpunti(bot, msg: types.Message):
     if msg.chat.id != ADMIN_CHAT_ID:
         bot.reply_to(msg, "❌ Comando riservato all'amministratore.")
         return
 
-    users = db_manager.get_registered_users()
-    if not users:
+    markup = selection_keyboard("modifica_punti")
+    if not markup:
         bot.send_message(msg.chat.id, "⚠️ Nessun partecipante registrato.")
         return
 
-    markup = InlineKeyboardMarkup(row_width=1)
-    for user in users:
-        nome = user["first_name"] or user["username"] or str(user["chat_id"])
-        markup.add(InlineKeyboardButton(
-            f"{nome}", callback_data=f"modifica_punti|{user['chat_id']}"
-        ))
-
     bot.send_message(msg.chat.id, "👤 Seleziona un utente per aggiornare i punti:", reply_markup=markup)
 
 def handle_admin(bot, msg: types.Message):
@@ -242,19 +256,11 @@ def handle_admin(bot, msg: types.Message):
         bot.send_message(msg.chat.id, "❌ Comando riservato all'admin!")
         return
     
-    users = db_manager.get_registered_users()
-    if not users:
+    markup = selection_keyboard("manage_user")
+    if not markup:
         bot.send_message(msg.chat.id, "👥 Nessun utente registrato.")
         return
     
-    markup = InlineKeyboardMarkup(row_width=1)
-    for user in users:
-        username = format_username(user['username'], user['first_name'], user['chat_id'])
-        markup.add(InlineKeyboardButton(
-            text=username,
-            callback_data=f"manage_user|{user['chat_id']}"
-        ))
-    
     bot.send_message(
         msg.chat.id, 
         "👤 Scegli un utente per gestire le sue segnalazioni:", 
@@ -283,18 +289,11 @@ def handle_remove_matto(bot, msg: types.Message):
         bot.send_message(msg.chat.id, "❌ Comando riservato all'admin!")
         return
     
-    items = db_manager.list_matti()
-    if not items:
+    markup = selection_keyboard("remove_matto")
+    if not markup:
         bot.send_message(msg.chat.id, "📂 Nessun matto definito.")
         return
     
-    markup = InlineKeyboardMarkup(row_width=2)
-    for itm in items:
-        markup.add(InlineKeyboardButton(
-            text=f"{itm['name']} ({itm['points']} punti)",
-            callback_data=f"remove_matto|{itm['id']}"
-        ))
-    
     bot.send_message(
         msg.chat.id, 
         "❌ Scegli un matto da rimuovere:", 
@@ -309,33 +308,73 @@ def handle_upload_matti(bot, msg: types.Message):
     state_manager.set_admin_upload_pending(True)
     bot.send_message(
         msg.chat.id, 
-        "📄 Invia ora il file .txt con la lista (ogni riga: nome, punti).",
+        "📄 Invia ora il file con la lista dei matti:\n"
+        "• .txt o .csv: una riga 'nome, punti' per matto\n"
+        "• .tsv: nome e punti separati da tabulazione\n"
+        "• .json: lista di {\"name\": ..., \"points\": ...}\n\n"
+        "Prima di applicare le modifiche riceverai un'anteprima.",
         parse_mode=None
     )
 
+def _import_preview_text(fmt, diff, report):
+    lines = [
+        f"📋 Anteprima import ({fmt.upper()})",
+        "",
+        f"🆕 Nuovi: {diff['new']}",
+        f"✏️ Punti modificati: {diff['changed']}",
+        f"➖ Invariati: {diff['unchanged']}",
+    ]
+    if diff["examples"]:
+        lines.append("")
+        for name, old_points, new_points in diff["examples"]:
+            if old_points is None:
+                lines.append(f"• {name}: nuovo, {new_points} punti")
+            else:
+                lines.append(f"• {name}: {old_points} → {new_points} punti")
+        others = diff["new"] + diff["changed"] - len(diff["examples"])
+        if others > 0:
+            lines.append(f"• … e altre {others} modifiche")
+    if report.rejected:
+        lines.extend(["", report.summary()])
+    return "\n".join(lines)
+
 def handle_document(bot, msg: types.Message):
     if msg.chat.id != ADMIN_CHAT_ID or not state_manager.is_admin_upload_pending():
         return
     
     doc = msg.document
-    if not doc.file_name.lower().endswith(".txt"):
-        bot.send_message(msg.chat.id, "❌ Per favore invia un file di testo .txt.", parse_mode=None)
+    fmt = import_format(doc.file_name)
+    if not fmt:
+        bot.send_message(msg.chat.id, "❌ Formato non supportato: invia un file .txt, .csv, .tsv o .json.", parse_mode=None)
         state_manager.set_admin_upload_pending(False)
         return
     
     try:
         file_info = bot.get_file(doc.file_id)
-        content = bot.download_file(file_info.file_path).decode("utf-8")
-        
-        matti_data = parse_matti_file_content(content)
-        count = db_manager.load_matti_from_data(matti_data)
+        report = ParseReport()
+        batches = parse_matti_stream(download_chunks(bot.token, file_info.file_path), report, fmt=fmt)
+        import_id, _ = db_manager.stage_catalogue_import(msg.chat.id, batches)
+        diff = db_manager.diff_catalogue_import(import_id)
         
         state_manager.set_admin_upload_pending(False)
-        bot.send_message(msg.chat.id, f"✅ Caricati {count} matti nel database (aggiunti/aggiornati senza sovrascrivere).")
+        text = _import_preview_text(fmt, diff, report)
+        
+        if not diff["new"] and not diff["changed"]:
+            db_manager.discard_import(import_id)
+            bot.send_message(msg.chat.id, text + "\n\nℹ️ Nessuna modifica da applicare.", parse_mode=None)
+            return
+        
+        # Le righe restano nella tabella di appoggio fino alla conferma
+        markup = InlineKeyboardMarkup()
+        markup.row(
+            InlineKeyboardButton("✅ Applica", callback_data=f"import_apply|{import_id}"),
+            InlineKeyboardButton("❌ Annulla", callback_data=f"import_cancel|{import_id}")
+        )
+        bot.send_message(msg.chat.id, text, reply_markup=markup, parse_mode=None)
         
     except Exception as e:
         logger.error(f"Errore caricamento matti: {str(e)}")
-        bot.send_message(msg.chat.id, f"❌ Errore durante il caricamento: {str(e)}")
+        bot.send_message(msg.chat.id, f"❌ Errore durante il caricamento: {str(e)}", parse_mode=None)
         state_manager.set_admin_upload_pending(False)
 
 def handle_modifica_punti(bot, msg: types.Message):
@@ -355,8 +394,7 @@ def handle_modifica_punti(bot, msg: types.Message):
 
     db_manager.update_user_points(target_id, nuovo_punteggio)
     
-    users = db_manager.get_registered_users()
-    user = next((u for u in users if u['chat_id'] == target_id), None)
+    user = db_manager.get_user(target_id)
     
     if user:
         nome = user["first_name"] or user["username"] or str(target_id)
@@ -372,8 +410,8 @@ def handle_report(bot, msg: types.Message):
         bot.send_message(chat_id, "❌ Devi prima registrarti con /start.")
         return
     
-    items = db_manager.list_matti()
-    if not items:
+    markup = selection_keyboard("matto")
+    if not markup:
         bot.send_message(
             chat_id, 
             "📂 Nessun matto definito. L'admin può caricarli con /upload_matti.",
@@ -381,13 +419,6 @@ def handle_report(bot, msg: types.Message):
         )
         return
     
-    markup = InlineKeyboardMarkup(row_width=2)
-    for itm in items:
-        markup.add(InlineKeyboardButton(
-            text=f"{itm['name']} ({itm['points']} punti)",
-            callback_data=f"matto|{itm['id']}"
-        ))
-    
     bot.send_message(
         chat_id, 
         "🏹 Scegli il matto cliccando sul pulsante:", 
@@ -435,23 +466,12 @@ def process_media_sighting(bot, msg: types.Message, file_id: str, media_type: st
             "username": uname
         })
         
-        users = db_manager.get_registered_users()
-        if not users:
+        # Tutti i giocatori tranne se stesso, a pagine
+        markup = selection_keyboard("use_weapon", exclude=chat_id)
+        if not markup:
             bot.send_message(chat_id, "👥 Nessun giocatore registrato per usare l'arma!")
             return
         
-        markup = InlineKeyboardMarkup(row_width=1)
-        for user in users:
-            if user['chat_id'] == chat_id:
-                continue  # Salta se stesso
-                
-            username = format_username(user['username'], user['first_name'], user['chat_id'])
-            markup.add(InlineKeyboardButton(
-                text=username,
-                callback_data=f"use_weapon|{user['chat_id']}"
-            ))
-        
-        media_emoji = "📹" if media_type == "video" else "📸"
         bot.send_message(
             chat_id, 
             f"💥 Hai trovato un'arma! {name} ha {pts} punti.\n"
@@ -467,45 +487,16 @@ def process_media_sighting(bot, msg: types.Message, file_id: str, media_type: st
     user_data = db_manager.get_user_rank_and_points(chat_id)
     total_pts = user_data["total_points"] if user_data else 0
     
-    # Prepara i testi senza formattazione Markdown
+    # Prepara l'annuncio senza formattazione Markdown
     user_info = format_user_info(uname, first)
-    media_emoji = "📹" if media_type == "video" else "📸"
-    text = (
-        f"{media_emoji} {user_info} ha trovato il matto {name} ➕ {pts} punti\n"
-        f"🏅 Ora ha {total_pts} punti."
-    )
+    text = build_sighting_text(user_info, name, pts, total_pts, media_type)
+    caption = build_sighting_caption(user_info, name, pts)
     
-    photo_caption = (
-        f"Segnalato da: {user_info}\n"
-        f"Matto: {name} ({pts} punti)"
-    )
-    
-    # Invia a tutti gli utenti registrati
-    sent = 0
-    registered_ids = db_manager.get_registered_chat_ids()
-
-    for cid in registered_ids:
-        try:
-            bot.send_message(cid, text, parse_mode=None)
-            
-            # Invia il media appropriato
-            if media_type == "video":
-                bot.send_video(cid, video=file_id, caption=photo_caption, parse_mode=None)
-            else:
-                bot.send_photo(cid, photo=file_id, caption=photo_caption, parse_mode=None)
-            sent += 1
+    # Accoda l'invio a tutti gli utenti registrati: la consegna avviene in background
+    payloads = announcement_payloads(media_type, file_id, text, caption)
+    queued = outbox_dispatcher.enqueue(db_manager.get_registered_chat_ids(), payloads)
 
-        except ApiException as e:
-            error_msg = str(e).lower()
-            if any(kw in error_msg for kw in ("blocked", "not found", "deactivated")):
-                db_manager.unregister_user(cid)
-            else:
-                logger.error(f"Errore invio a {cid}: {error_msg}")
-
-        except Exception as e:
-            logger.error(f"Errore generico invio a {cid}: {str(e)}")
-
-    bot.send_message(chat_id, f"✅ Segnalazione inviata a {sent} utenti.", parse_mode=None)
+    bot.send_message(chat_id, f"✅ Segnalazione in consegna a {queued} utenti.", parse_mode=None)
 
 # ————— HANDLER ADMIN SUGGERIMENTI —————
 def handle_review_suggestions(bot, msg: types.Message):
@@ -693,8 +684,7 @@ def handle_suggestion_points(bot, msg: types.Message):
     )
     
     # Notifica all'admin
-    users = db_manager.get_registered_users()
-    user = next((u for u in users if u['chat_id'] == chat_id), None)
+    user = db_manager.get_user(chat_id)
     user_info = format_username(user['username'], user['first_name'], user['chat_id']) if user else "Utente sconosciuto"
     
     # Escape dei caratteri speciali per evitare errori di parsing
@@ -762,34 +752,41 @@ def handle_suggestion_document(bot, msg: types.Message):
     
     try:
         file_info = bot.get_file(doc.file_id)
-        content = bot.download_file(file_info.file_path).decode("utf-8")
         
-        # Parsa il contenuto
-        suggestions = parse_matti_file_content(content)
+        # Parsa il file mentre viene scaricato e salva tutto in una sola transazione
+        report = ParseReport()
+        batches = parse_matti_stream(download_chunks(bot.token, file_info.file_path), report)
+        count, skipped = db_manager.add_suggestions_bulk(chat_id, batches)
         
-        if not suggestions:
-            bot.send_message(chat_id, "❌ Nessun suggerimento valido trovato nel file.")
-            state_manager.set_suggestion_upload_pending(chat_id, False)
-            return
+        state_manager.set_suggestion_upload_pending(chat_id, False)
         
-        # Salva tutti i suggerimenti
-        count = 0
-        for name, points in suggestions:
-            db_manager.add_suggestion(chat_id, name, points)
-            count += 1
+        if not report.valid:
+            text = "❌ Nessun suggerimento valido trovato nel file."
+            if report.rejected:
+                text += "\n\n" + report.summary()
+            bot.send_message(chat_id, text, parse_mode=None)
+            return
         
-        state_manager.set_suggestion_upload_pending(chat_id, False)
+        if not count:
+            text = "ℹ️ Tutti i matti del file sono già nel catalogo o in attesa di approvazione."
+            if report.rejected:
+                text += "\n\n" + report.summary()
+            bot.send_message(chat_id, text, parse_mode=None)
+            return
         
+        skipped_text = f"⏭️ {skipped} già presenti o duplicati, saltati.\n\n" if skipped else ""
         bot.send_message(
             chat_id,
             f"✅ {count} suggerimenti inviati con successo!\n\n"
+            f"{skipped_text}"
             f"L'admin riceverà le tue proposte per l'approvazione.",
             parse_mode="Markdown"
         )
+        if report.rejected:
+            bot.send_message(chat_id, report.summary(), parse_mode=None)
         
         # Notifica all'admin
-        users = db_manager.get_registered_users()
-        user = next((u for u in users if u['chat_id'] == chat_id), None)
+        user = db_manager.get_user(chat_id)
         user_info = format_username(user['username'], user['first_name'], user['chat_id']) if user else "Utente sconosciuto"
         
         # Escape dei caratteri speciali
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from threading import Lock
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+
+from config import SELECTION_PAGE_SIZE
+from database import db_manager
+from name_index import NameIndex
+from utils import format_username
+
+class KeyboardCache:
+    """Tastiere inline già serializzate in JSON, valide per una versione dei dati.
+
+    Il JSON si passa direttamente come reply_markup: telebot inoltra le
+    stringhe così come sono, senza ricostruire né riserializzare i pulsanti.
+    """
+
+    def __init__(self):
+        self.entries = {}  # chiave → (versione, valore)
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get(self, key, version, build):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] == version:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        value = build()
+        with self.lock:
+            self.entries[key] = (version, value)
+        return value
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
+
+def user_display_name(user):
+    return format_username(user['username'], user['first_name'], user['chat_id'])
+
+def user_plain_name(user):
+    return user["first_name"] or user["username"] or str(user["chat_id"])
+
+def matto_label(itm):
+    return f"{itm['name']} ({itm['points']} punti)"
+
+# Tastiere di selezione: prefisso della callback → (elenco, etichetta del pulsante)
+SELECTIONS = {
+    "matto": ("matti", matto_label),
+    "select_matto": ("matti", matto_label),
+    "remove_matto": ("matti", matto_label),
+    "select_user": ("users", user_display_name),
+    "manage_user": ("users", user_display_name),
+    "modifica_punti": ("users", user_plain_name),
+    "use_weapon": ("users", user_display_name),
+}
+
+# Selezioni che escludono chi le apre (non si usa un'arma su se stessi)
+EXCLUDE_SELF = {"use_weapon"}
+
+# Selezioni che solo l'admin può sfogliare
+ADMIN_SELECTIONS = {"remove_matto", "manage_user", "modifica_punti"}
+
+# ————— ELENCHI —————
+def _entries(prefix):
+    """(pulsanti, indice di ricerca) della selezione, ricostruiti solo quando cambiano i dati"""
+    kind, label = SELECTIONS[prefix]
+    if kind == "matti":
+        # La versione va letta prima dei dati: al peggio si ricostruisce una volta di troppo
+        version = db_manager.catalogue_version()
+        load = db_manager.list_matti
+        key = lambda itm: itm["id"]
+        name = lambda itm: itm["name"]
+    else:
+        version = db_manager.registered_users_version()
+        load = db_manager.get_registered_users
+        key = lambda user: user["chat_id"]
+        name = lambda user: " ".join(filter(None, (user["first_name"], user["username"])))
+
+    def build():
+        rows = load()
+        buttons = [(key(row), label(row)) for row in rows]
+        return buttons, NameIndex((name(row), button) for row, button in zip(rows, buttons))
+
+    return version, keyboard_cache.get(("entries", kind, label), version, build)
+
+def _markup(prefix, buttons, page=None, pages=1):
+    markup = InlineKeyboardMarkup()
+    for item_id, text in buttons:
+        markup.row(InlineKeyboardButton(text=text, callback_data=f"{prefix}|{item_id}"))
+    if page is not None and pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"kb_page|{prefix}|{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"kb_page|{prefix}|{page}"))
+        if page < pages - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"kb_page|{prefix}|{page + 1}"))
+        markup.row(*nav)
+        markup.row(InlineKeyboardButton("🔍 Cerca per nome", callback_data=f"kb_search|{prefix}"))
+    return markup.to_json()
+
+# ————— TASTIERE —————
+def selection_keyboard(prefix, page=0, exclude=None):
+    """Una pagina della selezione con callback '{prefix}|{id}'; None se l'elenco è vuoto.
+
+    Le pagine sono in cache per versione dei dati; con exclude (l'utente che
+    apre la selezione) la pagina è costruita al momento.
+    """
+    version, (buttons, _) = _entries(prefix)
+    if exclude is not None:
+        buttons = [b for b in buttons if b[0] != exclude]
+    if not buttons:
+        return None
+
+    pages = (len(buttons) + SELECTION_PAGE_SIZE - 1) // SELECTION_PAGE_SIZE
+    page = min(max(page, 0), pages - 1)
+    build = lambda: _markup(
+        prefix, buttons[page * SELECTION_PAGE_SIZE:(page + 1) * SELECTION_PAGE_SIZE], page, pages
+    )
+    if exclude is not None:
+        return build()
+    return keyboard_cache.get(("page", prefix, page), version, build)
+
+def search_keyboard(prefix, query, exclude=None):
+    """Risultati della ricerca per nome come tastiera di selezione; None se non trova nulla"""
+    _, (_, index) = _entries(prefix)
+    found = [b for b in index.search(query, SELECTION_PAGE_SIZE + 1) if b[0] != exclude]
+    if not found:
+        return None
+    return _markup(prefix, found[:SELECTION_PAGE_SIZE])
+
+def _mode_markup(prefix):
+    markup = InlineKeyboardMarkup()
+    markup.row(
+        InlineKeyboardButton("Solo testo", callback_data=f"{prefix}|text"),
+        InlineKeyboardButton("Con media", callback_data=f"{prefix}|photos")
+    )
+    return markup.to_json()
+
+def mode_keyboard(prefix):
+    """Scelta tra galleria solo testo e con media: non cambia mai, si serializza una volta"""
+    return keyboard_cache.get(("mode", prefix), 0, lambda: _mode_markup(prefix))
+
+# Istanza globale della cache delle tastiere
+keyboard_cache = KeyboardCache()
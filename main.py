@@ -1,198 +1,165 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-from telebot import TeleBot, types
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
+import sys
+import signal
+from threading import Thread
+from telebot import TeleBot
 
 # Import delle configurazioni e moduli
-from config import BOT_TOKEN, logger
+from config import BOT_TOKEN, BOT_RUNTIME, BOT_MODE, BOT_WORKERS, WEBHOOK_URL, WEBHOOK_SECRET, logger
 from database import db_manager
-from states import state_manager
+from states import state_manager, ChatState
+from router import Router
+from broadcast import broadcast_engine
+from outbox import outbox_dispatcher
 import handlers
 import callbacks
 
-# Inizializza il bot
-bot = TeleBot(BOT_TOKEN)
-
-# ————— REGISTRAZIONE HANDLER COMANDI —————
-@bot.message_handler(commands=["start"])
-def cmd_start(msg: types.Message):
-    handlers.handle_start(bot, msg)
+# ————— ROUTING —————
+def build_router():
+    """Costruisce le tabelle di smistamento di comandi, stati di input e callback"""
+    router = Router(state_of=state_manager.get_state)
+
+    # /start e /help funzionano anche durante la richiesta della password
+    router.command("start", handlers.handle_start, priority=True)
+    router.command(["comandi", "help"], handlers.handle_help, priority=True)
+
+    router.command("me", handlers.handle_me)
+    router.command("leaderboard", handlers.handle_leaderboard)
+    router.command("classifica", handlers.handle_full_leaderboard)
+    router.command("export_classifica", handlers.handle_export_leaderboard)
+    router.command("unregister", handlers.handle_unregister)
+    router.command("listmatti", handlers.handle_listmatti)
+    router.command("galleria_utente", handlers.handle_galleria_utente)
+    router.command("galleria_matto", handlers.handle_galleria_matto)
+    router.command("setpunti", handlers.handle_setpunti)
+    router.command("admin", handlers.handle_admin)
+    router.command("add_matto", handlers.handle_add_matto)
+    router.command("remove_matto", handlers.handle_remove_matto)
+    router.command("upload_matti", handlers.handle_upload_matti)
+    router.command("suggest", handlers.handle_suggest)
+    router.command("suggest_file", handlers.handle_suggest_file)
+    router.command("my_suggestions", handlers.handle_my_suggestions)
+    router.command("review_suggestions", handlers.handle_review_suggestions)
+    router.command("report", handlers.handle_report)
+
+    # Stati di input: la password intercetta ogni testo, gli altri cedono ai comandi
+    router.state(ChatState.AWAITING_PASSWORD, handlers.handle_password, capture_commands=True)
+    router.state(ChatState.AWAITING_MATTI_UPLOAD, handlers.handle_document, content_types=["document"])
+    router.state(ChatState.AWAITING_SUGGESTION_FILE, handlers.handle_suggestion_document, content_types=["document"])
+    router.state(ChatState.AWAITING_POINT_UPDATE, handlers.handle_modifica_punti)
+    router.state(ChatState.AWAITING_SUGGESTION_NAME, handlers.handle_suggestion_name)
+    router.state(ChatState.AWAITING_SUGGESTION_POINTS, handlers.handle_suggestion_points)
+    router.state(ChatState.AWAITING_REVIEW_NOTES, handlers.handle_suggestion_review_notes)
+    router.state(ChatState.AWAITING_SEARCH, handlers.handle_selection_search)
+
+    # Foto e video contano solo dopo aver scelto un matto con /report
+    router.state(ChatState.AWAITING_MEDIA, handlers.handle_photo, content_types=["photo"])
+    router.state(ChatState.AWAITING_MEDIA, handlers.handle_video, content_types=["video"])
+
+    router.callback("matto", callbacks.callback_matto)
+    router.callback("remove_matto", callbacks.callback_remove_matto)
+    router.callback("select_user", callbacks.callback_select_user)
+    router.callback("select_matto", callbacks.callback_select_matto)
+    router.callback("modifica_punti", callbacks.callback_modifica_punti)
+    router.callback("manage_user", callbacks.callback_manage_user)
+    router.callback("delete_sighting", callbacks.callback_delete_sighting)
+    router.callback("use_weapon", callbacks.callback_use_weapon)
+    router.callback("gallery_mode", callbacks.callback_gallery_mode)
+    router.callback("matto_mode", callbacks.callback_matto_mode)
+    router.callback("gallery_page", callbacks.callback_gallery_page)
+    router.callback("kb_page", callbacks.callback_selection_page)
+    router.callback("kb_search", callbacks.callback_selection_search)
+    router.callback("approve_suggestion", callbacks.callback_approve_suggestion)
+    router.callback("approve_suggestion_silent", callbacks.callback_approve_suggestion)
+    router.callback("reject_suggestion", callbacks.callback_reject_suggestion)
+    router.callback("reject_suggestion_silent", callbacks.callback_reject_suggestion)
+    router.callback("import_apply", callbacks.callback_import_apply)
+    router.callback("import_cancel", callbacks.callback_import_cancel)
+    return router
+
+router = build_router()
+
+def register_handlers(bot, wrap):
+    """Registra il router su un TeleBot o AsyncTeleBot.
+
+    wrap(handler) deve restituire la funzione da registrare, che riceve solo l'update.
+    """
+    bot.register_message_handler(wrap(router.dispatch_message), content_types=router.content_types())
+    bot.register_callback_query_handler(wrap(router.dispatch_callback), func=None)
 
-@bot.message_handler(commands=["comandi", "help"])
-def cmd_help(msg: types.Message):
-    handlers.handle_help(bot, msg)
+# ————— AVVIO BOT —————
+def run_sync():
+    """Runtime classico: TeleBot con long polling e thread di worker"""
+    db_manager.init_db()
+    db_manager.upgrade_db()
 
-@bot.message_handler(func=lambda message: state_manager.has_pending_password(message.chat.id))
-def handler_password(msg: types.Message):
-    handlers.handle_password(bot, msg)
-
-@bot.message_handler(commands=["me"])
-def cmd_me(msg: types.Message):
-    handlers.handle_me(bot, msg)
-
-@bot.message_handler(commands=["leaderboard"])
-def cmd_leaderboard(msg: types.Message):
-    handlers.handle_leaderboard(bot, msg)
-
-@bot.message_handler(commands=["classifica"])
-def cmd_classifica(msg: types.Message):
-    handlers.handle_full_leaderboard(bot, msg)
-
-@bot.message_handler(commands=["unregister"])
-def cmd_unregister(msg: types.Message):
-    handlers.handle_unregister(bot, msg)
-
-@bot.message_handler(commands=["listmatti"])
-def cmd_listmatti(msg: types.Message):
-    handlers.handle_listmatti(bot, msg)
-
-@bot.message_handler(commands=["galleria_utente"])
-def cmd_galleria_utente(msg: types.Message):
-    handlers.handle_galleria_utente(bot, msg)
-
-@bot.message_handler(commands=["galleria_matto"])
-def cmd_galleria_matto(msg: types.Message):
-    handlers.handle_galleria_matto(bot, msg)
-
-@bot.message_handler(commands=["setpunti"])
-def cmd_setpunti(msg: types.Message):
-    handlers.handle_setpunti(bot, msg)
-
-@bot.message_handler(commands=["admin"])
-def cmd_admin(msg: types.Message):
-    handlers.handle_admin(bot, msg)
-
-@bot.message_handler(commands=["add_matto"])
-def cmd_add_matto(msg: types.Message):
-    handlers.handle_add_matto(bot, msg)
-
-@bot.message_handler(commands=["remove_matto"])
-def cmd_remove_matto(msg: types.Message):
-    handlers.handle_remove_matto(bot, msg)
-
-@bot.message_handler(commands=["upload_matti"])
-def cmd_upload_matti(msg: types.Message):
-    handlers.handle_upload_matti(bot, msg)
-
-@bot.message_handler(commands=["suggest"])
-def cmd_suggest(msg: types.Message):
-    handlers.handle_suggest(bot, msg)
+    bot = TeleBot(BOT_TOKEN)
+    register_handlers(bot, lambda handler: lambda update: handler(bot, update))
 
-@bot.message_handler(commands=["suggest_file"])
-def cmd_suggest_file(msg: types.Message):
-    handlers.handle_suggest_file(bot, msg)
+    # Un webhook rimasto attivo da una modalità precedente bloccherebbe il polling
+    bot.remove_webhook()
 
-@bot.message_handler(commands=["my_suggestions"])
-def cmd_my_suggestions(msg: types.Message):
-    handlers.handle_my_suggestions(bot, msg)
+    # Riprende le consegne rimaste in coda dall'ultima esecuzione
+    outbox_dispatcher.start(bot)
 
-@bot.message_handler(commands=["review_suggestions"])
-def cmd_review_suggestions(msg: types.Message):
-    handlers.handle_review_suggestions(bot, msg)
+    logger.info("Bot avviato – in attesa di comandi.")
+    bot.infinity_polling()
 
-@bot.message_handler(content_types=["document"])
-def handler_document(msg: types.Message):
-    # Gestisce sia upload admin che suggerimenti utenti
-    if msg.chat.id == ADMIN_CHAT_ID and state_manager.is_admin_upload_pending():
-        handlers.handle_document(bot, msg)
-    elif state_manager.is_suggestion_upload_pending(msg.chat.id):
-        handlers.handle_suggestion_document(bot, msg)
+def run_webhook():
+    """Runtime webhook: gli update arrivano via HTTP e girano nel pool del server"""
+    from webhook import WebhookServer
 
-@bot.message_handler(func=lambda msg: state_manager.has_awaiting_point_update(msg.chat.id))
-def handler_modifica_punti(msg: types.Message):
-    handlers.handle_modifica_punti(bot, msg)
+    db_manager.init_db()
+    db_manager.upgrade_db()
 
-@bot.message_handler(func=lambda msg: state_manager.has_pending_suggestion_name(msg.chat.id))
-def handler_suggestion_name(msg: types.Message):
-    handlers.handle_suggestion_name(bot, msg)
+    # threaded=False: gli handler girano nei worker del WebhookServer, che li attende in chiusura
+    bot = TeleBot(BOT_TOKEN, threaded=False)
+    register_handlers(bot, lambda handler: lambda update: handler(bot, update))
 
-@bot.message_handler(func=lambda msg: state_manager.has_pending_suggestion_points(msg.chat.id))
-def handler_suggestion_points(msg: types.Message):
-    handlers.handle_suggestion_points(bot, msg)
+    server = WebhookServer(bot)
+    if WEBHOOK_URL:
+        bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET)
 
-@bot.message_handler(func=lambda msg: state_manager.has_pending_suggestion_review(msg.chat.id))
-def handler_suggestion_review_notes(msg: types.Message):
-    handlers.handle_suggestion_review_notes(bot, msg)
-
-@bot.message_handler(commands=["report"])
-def cmd_report(msg: types.Message):
-    handlers.handle_report(bot, msg)
+    outbox_dispatcher.start(bot)
 
-@bot.message_handler(content_types=["photo"])
-def handler_photo(msg: types.Message):
-    handlers.handle_photo(bot, msg)
+    # SIGTERM: shutdown() va chiamato fuori dal thread di serve_forever; lo stop() del
+    # finally attende che questo thread abbia completato gli update in corso
+    signal.signal(signal.SIGTERM, lambda signum, frame: Thread(target=server.stop).start())
 
-# ————— NUOVO HANDLER PER I VIDEO —————
-@bot.message_handler(content_types=["video"])
-def handler_video(msg: types.Message):
-    handlers.handle_video(bot, msg)
-
-# ————— REGISTRAZIONE CALLBACK HANDLER —————
-@bot.callback_query_handler(func=lambda call: call.data.startswith("matto|"))
-def callback_matto_handler(call: types.CallbackQuery):
-    callbacks.callback_matto(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("remove_matto|"))
-def callback_remove_matto_handler(call: types.CallbackQuery):
-    callbacks.callback_remove_matto(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("select_user|"))
-def callback_select_user_handler(call: types.CallbackQuery):
-    callbacks.callback_select_user(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("select_matto|"))
-def callback_select_matto_handler(call: types.CallbackQuery):
-    callbacks.callback_select_matto(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("modifica_punti|"))
-def callback_modifica_punti_handler(call: types.CallbackQuery):
-    callbacks.callback_modifica_punti(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("manage_user|"))
-def callback_manage_user_handler(call: types.CallbackQuery):
-    callbacks.callback_manage_user(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("delete_sighting|"))
-def callback_delete_sighting_handler(call: types.CallbackQuery):
-    callbacks.callback_delete_sighting(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("use_weapon|"))
-def callback_use_weapon_handler(call: types.CallbackQuery):
-    callbacks.callback_use_weapon(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("gallery_mode|"))
-def callback_gallery_mode_handler(call: types.CallbackQuery):
-    callbacks.callback_gallery_mode(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("matto_mode|"))
-def callback_matto_mode_handler(call: types.CallbackQuery):
-    callbacks.callback_matto_mode(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("approve_suggestion"))
-def callback_approve_suggestion_handler(call: types.CallbackQuery):
-    callbacks.callback_approve_suggestion(bot, call)
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith("reject_suggestion"))
-def callback_reject_suggestion_handler(call: types.CallbackQuery):
-    callbacks.callback_reject_suggestion(bot, call)
+    logger.info("Bot avviato (webhook) – in attesa di update.")
+    try:
+        server.serve_forever()
+    finally:
+        server.stop()
 
-# ————— AVVIO BOT —————
 if __name__ == "__main__":
+    runtime = "async" if "--async" in sys.argv[1:] else BOT_RUNTIME
+    mode = "webhook" if "--webhook" in sys.argv[1:] else BOT_MODE
+    workers = BOT_WORKERS
+    if "--workers" in sys.argv[1:-1]:
+        workers = int(sys.argv[sys.argv.index("--workers") + 1])
     try:
-        # Inizializza il database
-        db_manager.init_db()
-        db_manager.upgrade_db()
-        
-        logger.info("Bot avviato – in attesa di comandi.")
-        bot.infinity_polling()
-        
+        if workers > 1:
+            import supervisor
+            supervisor.run(workers)
+        elif runtime == "async":
+            import async_frontend
+            async_frontend.run(register_handlers)
+        elif mode == "webhook":
+            run_webhook()
+        else:
+            run_sync()
+
     except KeyboardInterrupt:
         logger.info("Bot fermato dall'utente")
     except Exception as e:
         logger.error(f"Errore critico: {str(e)}")
     finally:
         # Pulizia risorse
+        outbox_dispatcher.stop()
+        broadcast_engine.shutdown()
         state_manager.cleanup_all_states()
         db_manager.close()
         logger.info("Risorse pulite, bot terminato")
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import difflib
+import unicodedata
+from bisect import bisect_left
+from collections import defaultdict
+
+def normalize_name(text):
+    """Minuscolo, senza accenti né '@', per confronti indulgenti"""
+    decomposed = unicodedata.normalize("NFKD", text or "")
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(stripped.casefold().replace("@", " ").split())
+
+class NameIndex:
+    """Ricerca per nome su un elenco di elementi, tutta in memoria.
+
+    Per ogni nome indicizza i suffissi che iniziano a un confine di parola,
+    così una ricerca per prefisso con bisect trova anche parole interne
+    ("grande" trova "Il Matto Grande"). Se nessun prefisso corrisponde si passa
+    a una ricerca approssimata con difflib.
+    """
+
+    def __init__(self, entries):
+        # entries: (nome, elemento) nell'ordine in cui mostrarli
+        self.items = []
+        self.keys = []  # (suffisso normalizzato, posizione) ordinati
+        self.positions = defaultdict(list)  # suffisso → posizioni, per la ricerca approssimata
+        for pos, (name, item) in enumerate(entries):
+            self.items.append(item)
+            words = normalize_name(name).split(" ")
+            for i in range(len(words)):
+                key = " ".join(words[i:])
+                self.keys.append((key, pos))
+                self.positions[key].append(pos)
+        self.keys.sort()
+
+    def search(self, query, limit=20):
+        """Elementi che corrispondono alla ricerca, al più limit"""
+        q = normalize_name(query)
+        if not q:
+            return []
+
+        found = set()
+        start = bisect_left(self.keys, (q, -1))
+        for i in range(start, len(self.keys)):
+            key, pos = self.keys[i]
+            if not key.startswith(q):
+                break
+            found.add(pos)
+
+        if not found:
+            for key in difflib.get_close_matches(q, list(self.positions), n=limit, cutoff=0.6):
+                found.update(self.positions[key])
+
+        return [self.items[pos] for pos in sorted(found)[:limit]]
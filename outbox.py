@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import json
+import logging
+from threading import Event, Thread
+from datetime import datetime, timezone, timedelta
+
+from database import db_manager
+from broadcast import broadcast_engine
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 200
+POLL_INTERVAL = 2.0  # secondi tra due controlli quando la coda è vuota
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 5  # secondi, raddoppiati ad ogni tentativo
+SENT_RETENTION = timedelta(days=1)
+PURGE_INTERVAL = timedelta(hours=1)
+
+class OutboxDispatcher:
+    """Svuota la tabella outbox in background con semantica at-least-once.
+
+    Una consegna resta 'pending' finché l'invio non è confermato, quindi
+    dopo un crash o un riavvio il dispatcher riprende da dove si era fermato.
+    """
+
+    def __init__(self, db, engine, batch_size=BATCH_SIZE, poll_interval=POLL_INTERVAL, max_attempts=MAX_ATTEMPTS):
+        self.db = db
+        self.engine = engine
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.bot = None
+        self.thread = None
+        self.wakeup = Event()
+        self.stopping = Event()
+        self.last_purge = None
+
+    def enqueue(self, chat_ids, payloads):
+        """Accoda la sequenza di payload per ogni chat e sveglia il dispatcher"""
+        count = self.db.enqueue_outbox(chat_ids, payloads)
+        self.wakeup.set()
+        return count
+
+    def start(self, bot):
+        self.bot = bot
+        self.stopping.clear()
+        self.thread = Thread(target=self._run, name="outbox-dispatcher", daemon=True)
+        self.thread.start()
+        logger.info("Dispatcher outbox avviato")
+
+    def stop(self, timeout=10):
+        if not self.thread:
+            return
+        self.stopping.set()
+        self.wakeup.set()
+        self.thread.join(timeout)
+        self.thread = None
+        logger.info("Dispatcher outbox fermato")
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.wakeup.clear()
+            try:
+                processed = self.drain_once()
+            except Exception as e:
+                logger.error(f"Errore nel dispatcher outbox: {str(e)}")
+                processed = 0
+            if not processed:
+                self._purge_sent()
+                self.wakeup.wait(self.poll_interval)
+
+    def drain_once(self):
+        """Consegna un batch di messaggi in coda; restituisce quanti ne ha processati"""
+        rows = self.db.get_outbox_batch(self.batch_size)
+        if not rows:
+            return 0
+
+        by_id = {row["id"]: row for row in rows}
+        report = self.engine.deliver(
+            self.bot,
+            [(row["id"], row["chat_id"], json.loads(row["payload"])) for row in rows]
+        )
+
+        if report.sent:
+            self.db.mark_outbox_sent(report.sent)
+
+        for oid in report.blocked:
+            self.db.mark_outbox_failed(oid, "utente non raggiungibile")
+        for cid in {by_id[oid]["chat_id"] for oid in report.blocked}:
+            self.db.unregister_user(cid)
+
+        now = datetime.now(timezone.utc)
+        for oid, error in report.failed.items():
+            attempts = by_id[oid]["attempts"] + 1
+            if attempts >= self.max_attempts:
+                self.db.mark_outbox_failed(oid, error)
+                logger.error(f"Consegna {oid} abbandonata dopo {attempts} tentativi")
+            else:
+                retry_at = now + timedelta(seconds=RETRY_BASE_DELAY * 2 ** (attempts - 1))
+                self.db.mark_outbox_failed(oid, error, retry_at.isoformat())
+
+        return len(rows)
+
+    def _purge_sent(self):
+        now = datetime.now(timezone.utc)
+        if self.last_purge and now - self.last_purge < PURGE_INTERVAL:
+            return
+        self.last_purge = now
+        try:
+            self.db.purge_outbox((now - SENT_RETENTION).isoformat())
+        except Exception as e:
+            logger.warning(f"Errore nella pulizia dell'outbox: {str(e)}")
+
+# Istanza globale del dispatcher
+outbox_dispatcher = OutboxDispatcher(db_manager, broadcast_engine)
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from threading import Lock
+
+class UserProfileCache:
+    """Profili degli utenti registrati (chat_id, username, first_name) per chat_id.
+
+    Conserva anche le ricerche a vuoto (utente assente o non registrato): ogni
+    modifica a un utente chiama invalidate(chat_id). Come per il catalogo, un
+    caricamento iniziato prima di un'invalidazione non viene salvato.
+    """
+
+    def __init__(self):
+        self.version = 0
+        self.entries = {}  # chat_id → profilo, o None se non registrato
+        self.hits = 0
+        self.misses = 0
+        self.lock = Lock()
+
+    def get_many(self, chat_ids, loader):
+        """Profili per chat_id; loader(ids) legge dal database quelli mancanti"""
+        found = {}
+        with self.lock:
+            missing = []
+            for chat_id in chat_ids:
+                if chat_id in self.entries:
+                    self.hits += 1
+                    found[chat_id] = self.entries[chat_id]
+                elif chat_id not in missing:
+                    self.misses += 1
+                    missing.append(chat_id)
+            version = self.version
+        if not missing:
+            return found
+
+        loaded = dict.fromkeys(missing)
+        for row in loader(missing):
+            loaded[row["chat_id"]] = dict(row)
+        with self.lock:
+            if self.version == version:
+                self.entries.update(loaded)
+        found.update(loaded)
+        return found
+
+    def invalidate(self, chat_id=None):
+        """Scarta il profilo di un utente, o tutti se chat_id è None"""
+        with self.lock:
+            self.version += 1
+            if chat_id is None:
+                self.entries = {}
+            else:
+                self.entries.pop(chat_id, None)
+
+    def stats(self):
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "size": len(self.entries)}
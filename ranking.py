@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+from bisect import bisect_left, insort
+from threading import Lock
+
+class RankIndex:
+    """Classifica in memoria degli utenti registrati, aggiornata a ogni variazione di punti.
+
+    Tiene gli utenti in una lista ordinata per (-punti, chat_id): la classifica
+    è una fetta della lista e il rank di un utente è il numero di punteggi
+    strettamente maggiori + 1, calcolato con una ricerca binaria. I testi già
+    impaginati restano validi finché la versione non cambia.
+    """
+
+    def __init__(self):
+        self.points = {}  # chat_id → punti
+        self.names = {}  # chat_id → (username, first_name)
+        self.order = []  # (-punti, chat_id) in ordine di classifica
+        self.version = 0
+        self.rendered = {}  # chiave → (versione, testo)
+        self.loaded = False
+        self.lock = Lock()
+
+    def load(self, rows):
+        """Ricostruisce l'indice da tuple (chat_id, punti, username, first_name)"""
+        with self.lock:
+            self.points = {}
+            self.names = {}
+            for chat_id, pts, username, first_name in rows:
+                self.points[chat_id] = pts
+                self.names[chat_id] = (username, first_name)
+            self.order = sorted((-pts, chat_id) for chat_id, pts in self.points.items())
+            self.version += 1
+            self.loaded = True
+
+    def invalidate(self):
+        with self.lock:
+            self.loaded = False
+            self.version += 1
+
+    def _discard(self, chat_id, pts):
+        idx = bisect_left(self.order, (-pts, chat_id))
+        del self.order[idx]
+
+    def _set(self, chat_id, pts):
+        old = self.points.get(chat_id)
+        if old == pts:
+            return
+        if old is not None:
+            self._discard(chat_id, old)
+        self.points[chat_id] = pts
+        insort(self.order, (-pts, chat_id))
+        self.version += 1
+
+    def set(self, chat_id, pts, username=None, first_name=None):
+        with self.lock:
+            self.names[chat_id] = (username, first_name)
+            self._set(chat_id, pts)
+            self.version += 1
+
+    def add(self, chat_id, delta):
+        """Somma delta ai punti di un utente già presente nell'indice"""
+        with self.lock:
+            old = self.points.get(chat_id)
+            if old is None or not delta:
+                return
+            self._set(chat_id, old + delta)
+
+    def update(self, chat_id, pts):
+        """Come set(), ma solo se l'utente è già presente nell'indice"""
+        with self.lock:
+            if chat_id in self.points:
+                self._set(chat_id, pts)
+
+    def remove(self, chat_id):
+        with self.lock:
+            old = self.points.pop(chat_id, None)
+            self.names.pop(chat_id, None)
+            if old is not None:
+                self._discard(chat_id, old)
+                self.version += 1
+
+    def rank(self, chat_id):
+        """Restituisce (rank, punti) oppure None se l'utente non è in classifica"""
+        with self.lock:
+            pts = self.points.get(chat_id)
+            if pts is None:
+                return None
+            return bisect_left(self.order, (-pts,)) + 1, pts
+
+    def _rows(self, limit):
+        entries = self.order[:limit] if limit else self.order
+        return [
+            {"chat_id": chat_id, "username": self.names[chat_id][0],
+             "first_name": self.names[chat_id][1], "total_points": -neg}
+            for neg, chat_id in entries
+        ]
+
+    def top(self, limit=None):
+        """Righe della classifica (chat_id, username, first_name, total_points), al più limit"""
+        with self.lock:
+            return self._rows(limit)
+
+    def render(self, key, limit, render):
+        """Testo della classifica impaginato con render(righe), ricalcolato solo se è cambiata"""
+        with self.lock:
+            cached = self.rendered.get(key)
+            if cached is not None and cached[0] == self.version:
+                return cached[1]
+            version = self.version
+            rows = self._rows(limit)
+        text = render(rows)
+        with self.lock:
+            if self.version == version:
+                self.rendered[key] = (version, text)
+        return text
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+class Router:
+    """Smista messaggi e callback con lookup su dizionari invece di una catena di predicati.
+
+    Per un messaggio l'ordine è: comandi sempre disponibili, stati che catturano
+    anche i comandi, comandi, stato di input della chat, tipo di contenuto.
+    Ogni passo è una singola lookup, quindi il costo non cresce con le rotte.
+    Lavora su qualsiasi oggetto con gli attributi di un Message/CallbackQuery.
+    """
+
+    def __init__(self, state_of=None):
+        self.state_of = state_of  # chat_id → stato di input corrente, o None
+        self.commands = {}  # comando → handler
+        self.priority_commands = set()  # comandi che precedono anche gli stati
+        self.states = {}  # (stato, content_type) → handler
+        self.capturing_states = set()  # stati che ricevono anche i comandi
+        self.content_handlers = {}  # content_type → handler
+        self.callbacks = {}  # prefisso di call.data → handler
+
+    # ————— REGISTRAZIONE —————
+    def command(self, names, handler, priority=False):
+        for name in ([names] if isinstance(names, str) else names):
+            self.commands[name] = handler
+            if priority:
+                self.priority_commands.add(name)
+
+    def state(self, state, handler, content_types=("text",), capture_commands=False):
+        for content_type in content_types:
+            self.states[(state, content_type)] = handler
+        if capture_commands:
+            self.capturing_states.add(state)
+
+    def content(self, content_type, handler):
+        self.content_handlers[content_type] = handler
+
+    def callback(self, prefix, handler):
+        self.callbacks[prefix] = handler
+
+    def content_types(self):
+        """Tipi di contenuto per cui esiste almeno una rotta"""
+        types = {"text"} if self.commands else set()
+        types.update(content_type for _, content_type in self.states)
+        types.update(self.content_handlers)
+        return sorted(types)
+
+    # ————— SMISTAMENTO —————
+    @staticmethod
+    def extract_command(text):
+        """'/cmd@bot argomenti' → 'cmd'; None se il testo non è un comando"""
+        if not text or text[0] != "/":
+            return None
+        return text.split(maxsplit=1)[0][1:].split("@", 1)[0]
+
+    def resolve_message(self, msg):
+        """Restituisce l'handler per il messaggio, o None"""
+        content_type = msg.content_type
+        command = self.extract_command(msg.text) if content_type == "text" else None
+        if command in self.priority_commands:
+            return self.commands[command]
+
+        state = self.state_of(msg.chat.id) if self.state_of else None
+        state_handler = self.states.get((state, content_type)) if state is not None else None
+        if state_handler and (command is None or state in self.capturing_states):
+            return state_handler
+
+        if command in self.commands:
+            return self.commands[command]
+        return state_handler or self.content_handlers.get(content_type)
+
+    def resolve_callback(self, call):
+        """Restituisce l'handler per la callback, o None"""
+        return self.callbacks.get((call.data or "").split("|", 1)[0])
+
+    def dispatch_message(self, bot, msg):
+        handler = self.resolve_message(msg)
+        if handler is None:
+            return False
+        handler(bot, msg)
+        return True
+
+    def dispatch_callback(self, bot, call):
+        handler = self.resolve_callback(call)
+        if handler is None:
+            logger.warning(f"Callback senza handler: {call.data}")
+            return False
+        handler(bot, call)
+        return True
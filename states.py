@@ -2,196 +2,473 @@
 # -*- coding: utf-8 -*-
 
 import atexit
+import json
 import logging
+import time
+from collections import OrderedDict
+from enum import Enum
+from threading import Event, Lock, Thread
+
+from config import ADMIN_CHAT_ID, STATE_BACKEND, STATE_FLUSH_INTERVAL
+from database import db_manager
 
 logger = logging.getLogger(__name__)
 
+SESSION_TTL = 30 * 60  # secondi di inattività dopo cui un flusso abbandonato scade
+MAX_SESSIONS = 10000  # oltre questo numero si scartano le sessioni usate meno di recente
+SWEEP_INTERVAL = 60  # secondi minimi tra due pulizie delle sessioni scadute
+FLUSH_BATCH_SIZE = 100  # sessioni in attesa oltre cui si scrive subito senza aspettare l'intervallo
+PURGE_INTERVAL = 3600  # secondi tra due pulizie delle sessioni scadute salvate
+
+class ChatState(Enum):
+    """Stato della conversazione di una chat"""
+    AWAITING_PASSWORD = "password"
+    AWAITING_MEDIA = "pending_matto"  # matto scelto, in attesa di foto/video
+    AWAITING_WEAPON_TARGET = "weapon_target"
+    GALLERY_USER = "gallery_user"
+    GALLERY_MATTO = "gallery_matto"
+    MANAGE_USER = "manage_user"
+    AWAITING_POINT_UPDATE = "point_update"
+    AWAITING_MATTI_UPLOAD = "admin_upload"
+    AWAITING_SUGGESTION_NAME = "suggestion_name"
+    AWAITING_SUGGESTION_POINTS = "suggestion_points"
+    AWAITING_SUGGESTION_FILE = "suggestion_upload"
+    AWAITING_REVIEW_NOTES = "suggestion_review"
+    AWAITING_SEARCH = "search"  # testo da cercare in una tastiera di selezione
+
+class ChatSession:
+    """Sessione di una chat: uno stato, i suoi dati e la scadenza"""
+    __slots__ = ("state", "data", "expires_at", "saved_expiry")
+
+    def __init__(self, state, data, expires_at):
+        self.state = state
+        self.data = data
+        self.expires_at = expires_at  # timestamp epoch, valido anche dopo un riavvio
+        self.saved_expiry = expires_at  # scadenza consegnata al backend
+
+# ————— BACKEND DEGLI STATI —————
+class MemoryStateBackend:
+    """Nessuna persistenza: le sessioni vivono solo nella memoria del processo"""
+    durable = False
+
+    def load(self, chat_id):
+        return None
+
+    def save(self, chat_id, session):
+        pass
+
+    def delete(self, chat_id):
+        pass
+
+    def close(self):
+        pass
+
+class SqliteStateBackend:
+    """Persistenza write-behind sulla tabella chat_sessions.
+
+    Le modifiche sono raccolte in memoria e scritte a batch da un thread ogni
+    flush_interval secondi; le letture arrivano qui solo quando la sessione non
+    è nella memoria dello StateManager (riavvio o espulsione LRU).
+    """
+    durable = True
+
+    def __init__(self, db, flush_interval=STATE_FLUSH_INTERVAL, batch_size=FLUSH_BATCH_SIZE):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.pending = {}  # chat_id → ChatSession da salvare, None da cancellare
+        self.flushing = {}  # batch in corso di scrittura
+        self.known = None  # chat con una sessione salvata, lette al primo uso
+        self.lock = Lock()
+        self.flush_lock = Lock()
+        self.wakeup = Event()
+        self.stopping = Event()
+        self.thread = None
+        self.last_purge = 0
+
+    def _known(self):
+        if self.known is None:
+            self.known = set(self.db.get_chat_session_ids(time.time()))
+        return self.known
+
+    def load(self, chat_id):
+        with self.lock:
+            # Le modifiche non ancora scritte sono più recenti del database
+            for batch in (self.pending, self.flushing):
+                if chat_id in batch:
+                    return batch[chat_id]
+            if chat_id not in self._known():
+                return None
+        row = self.db.get_chat_session(chat_id, time.time())
+        if row is not None:
+            try:
+                return ChatSession(ChatState(row["state"]), json.loads(row["data"]), row["expires_at"])
+            except ValueError as e:
+                logger.warning(f"Sessione salvata non valida per {chat_id}: {str(e)}")
+        with self.lock:
+            self.known.discard(chat_id)
+        return None
+
+    def save(self, chat_id, session):
+        self._queue(chat_id, session)
+
+    def delete(self, chat_id):
+        self._queue(chat_id, None)
+
+    def _queue(self, chat_id, session):
+        with self.lock:
+            self.pending[chat_id] = session
+            known = self._known()
+            if session is None:
+                known.discard(chat_id)
+            else:
+                known.add(chat_id)
+            if self.thread is None:
+                self.thread = Thread(target=self._run, name="state-writer", daemon=True)
+                self.thread.start()
+            if len(self.pending) >= self.batch_size:
+                self.wakeup.set()
+
+    def _run(self):
+        while not self.stopping.is_set():
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+            now = time.time()
+            if now - self.last_purge >= PURGE_INTERVAL:
+                self.last_purge = now
+                try:
+                    self.db.purge_chat_sessions(now)
+                except Exception as e:
+                    logger.warning(f"Errore nella pulizia delle sessioni: {str(e)}")
+
+    def flush(self):
+        """Scrive sul database le modifiche in attesa"""
+        with self.flush_lock:
+            with self.lock:
+                batch, self.pending = self.pending, {}
+                self.flushing = batch
+            if not batch:
+                return
+            upserts = [
+                (cid, session.state.value, json.dumps(session.data), session.expires_at)
+                for cid, session in batch.items() if session is not None
+            ]
+            deletes = [cid for cid, session in batch.items() if session is None]
+            try:
+                self.db.write_chat_sessions(upserts, deletes)
+            except Exception as e:
+                logger.error(f"Errore nel salvataggio delle sessioni: {str(e)}")
+                with self.lock:
+                    # Si riprova al prossimo giro, senza scavalcare modifiche più recenti
+                    for cid, session in batch.items():
+                        self.pending.setdefault(cid, session)
+            finally:
+                with self.lock:
+                    self.flushing = {}
+
+    def close(self):
+        """Ferma il thread di scrittura e salva le modifiche in attesa"""
+        if self.thread is not None:
+            self.stopping.set()
+            self.wakeup.set()
+            self.thread.join()
+            self.thread = None
+            self.stopping.clear()
+        self.flush()
+
+def create_state_backend(name=STATE_BACKEND):
+    """Backend degli stati configurato con STATE_BACKEND"""
+    if name == "sqlite":
+        return SqliteStateBackend(db_manager)
+    if name != "memory":
+        logger.warning(f"STATE_BACKEND sconosciuto: {name}, uso la memoria")
+    return MemoryStateBackend()
+
 class StateManager:
-    """Gestisce gli stati temporanei del bot"""
-    
-    def __init__(self):
-        self.pending_matto = {}  # chat_id → {'id':..., 'name':..., 'points':...}
-        self.pending_password = {}  # chat_id: True (in attesa di password)
-        self.admin_upload_pending = False
-        self.pending_gallery_user = {}  # chat_id → selected_user_chat_id
-        self.pending_gallery_matto = {}  # chat_id → matto_id
-        self.pending_manage_user = {}  # chat_id → selected_user_chat_id
-        self.pending_weapon_target = {}  # chat_id → {'matto_id':..., 'file_id':..., 'points':...}
-        self.awaiting_point_update = {}  # admin_chat_id -> chat_id_da_modificare
-        
-        # Stati per i suggerimenti
-        self.pending_suggestion_name = {}  # chat_id: True (in attesa del nome)
-        self.pending_suggestion_points = {}  # chat_id → nome_matto (in attesa dei punti)
-        self.suggestion_upload_pending = {}  # chat_id: True (in attesa del file txt)
-        self.pending_suggestion_review = {}  # admin_chat_id → suggestion_id (in attesa di note per review)
-        
+    """Gestisce gli stati temporanei del bot.
+
+    Ogni chat ha al più una sessione: entrare in un nuovo stato sostituisce il
+    flusso precedente. Le sessioni scadono dopo ttl secondi di inattività e sono
+    tenute in ordine LRU, così la pulizia e il limite max_sessions scartano
+    sempre dalla testa.
+    """
+
+    def __init__(self, backend=None, ttl=SESSION_TTL, max_sessions=MAX_SESSIONS, sweep_interval=SWEEP_INTERVAL):
+        self.backend = backend or MemoryStateBackend()
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sweep_interval = sweep_interval
+        self.sessions = OrderedDict()  # chat_id → ChatSession, dalla meno recente
+        self.lock = Lock()
+        self.last_sweep = time.time()
+
         # Registra la funzione di pulizia per la chiusura
         atexit.register(self.cleanup_all_states)
-    
+
+    # ————— SESSIONI —————
+    def get_state(self, chat_id):
+        """Restituisce lo ChatState corrente della chat, o None"""
+        session = self._get(chat_id)
+        return session.state if session else None
+
+    def _get(self, chat_id, state=None):
+        now = time.time()
+        with self.lock:
+            session = self.sessions.get(chat_id)
+        if session is None:
+            # Lettura dal backend solo se la sessione non è in memoria
+            loaded = self.backend.load(chat_id)
+            if loaded is None:
+                return None
+            with self.lock:
+                session = self.sessions.setdefault(chat_id, loaded)
+        with self.lock:
+            if session.expires_at <= now:
+                if self.sessions.get(chat_id) is session:
+                    del self.sessions[chat_id]
+                return None
+            if state is not None and session.state is not state:
+                return None
+            session.expires_at = now + self.ttl
+            self.sessions.move_to_end(chat_id)
+            # Il backend riceve il rinnovo della scadenza solo ogni tanto, non a ogni accesso
+            refresh = session.expires_at - session.saved_expiry >= self.ttl / 4
+            if refresh:
+                session.saved_expiry = session.expires_at
+        if refresh:
+            self.backend.save(chat_id, session)
+        return session
+
+    def _set(self, chat_id, state, data=True):
+        now = time.time()
+        session = ChatSession(state, data, now + self.ttl)
+        self.backend.save(chat_id, session)
+        with self.lock:
+            self.sessions[chat_id] = session
+            self.sessions.move_to_end(chat_id)
+            if now - self.last_sweep >= self.sweep_interval:
+                self._sweep(now)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+
+    def _pop(self, chat_id, state):
+        """Chiude la sessione se è nello stato indicato e ne restituisce i dati"""
+        session = self._get(chat_id, state)
+        if session is None:
+            return None
+        with self.lock:
+            if self.sessions.get(chat_id) is session:
+                del self.sessions[chat_id]
+        self.backend.delete(chat_id)
+        return session.data
+
+    def _data(self, chat_id, state):
+        session = self._get(chat_id, state)
+        return session.data if session else None
+
+    def _has(self, chat_id, state):
+        return self._get(chat_id, state) is not None
+
+    def _sweep(self, now):
+        # Con TTL uniforme l'ordine LRU coincide con l'ordine di scadenza.
+        # Le sessioni scadute o espulse restano nel backend, che le ripulisce da sé
+        self.last_sweep = now
+        expired = 0
+        while self.sessions:
+            chat_id, session = next(iter(self.sessions.items()))
+            if session.expires_at > now:
+                break
+            del self.sessions[chat_id]
+            expired += 1
+        if expired:
+            logger.debug(f"Scadute {expired} sessioni inattive")
+
+    def sweep_expired(self):
+        """Rimuove subito tutte le sessioni scadute"""
+        with self.lock:
+            self._sweep(time.time())
+
     # ————— PENDING MATTO —————
     def set_pending_matto(self, chat_id, matto_info):
-        self.pending_matto[chat_id] = matto_info
-    
+        self._set(chat_id, ChatState.AWAITING_MEDIA, matto_info)
+
     def get_pending_matto(self, chat_id):
-        return self.pending_matto.get(chat_id)
-    
+        return self._data(chat_id, ChatState.AWAITING_MEDIA)
+
     def remove_pending_matto(self, chat_id):
-        return self.pending_matto.pop(chat_id, None)
-    
+        return self._pop(chat_id, ChatState.AWAITING_MEDIA)
+
     def has_pending_matto(self, chat_id):
-        return chat_id in self.pending_matto
-    
+        return self._has(chat_id, ChatState.AWAITING_MEDIA)
+
     # ————— PENDING PASSWORD —————
     def set_pending_password(self, chat_id):
-        self.pending_password[chat_id] = True
-    
+        self._set(chat_id, ChatState.AWAITING_PASSWORD)
+
     def has_pending_password(self, chat_id):
-        return chat_id in self.pending_password
-    
+        return self._has(chat_id, ChatState.AWAITING_PASSWORD)
+
     def remove_pending_password(self, chat_id):
-        return self.pending_password.pop(chat_id, None)
-    
+        return self._pop(chat_id, ChatState.AWAITING_PASSWORD)
+
     # ————— ADMIN UPLOAD —————
     def set_admin_upload_pending(self, status=True):
-        self.admin_upload_pending = status
-    
+        if status:
+            self._set(ADMIN_CHAT_ID, ChatState.AWAITING_MATTI_UPLOAD)
+        else:
+            self._pop(ADMIN_CHAT_ID, ChatState.AWAITING_MATTI_UPLOAD)
+
     def is_admin_upload_pending(self):
-        return self.admin_upload_pending
-    
+        return self._has(ADMIN_CHAT_ID, ChatState.AWAITING_MATTI_UPLOAD)
+
     # ————— PENDING GALLERY USER —————
     def set_pending_gallery_user(self, chat_id, user_chat_id):
-        self.pending_gallery_user[chat_id] = user_chat_id
-    
+        self._set(chat_id, ChatState.GALLERY_USER, user_chat_id)
+
     def get_pending_gallery_user(self, chat_id):
-        return self.pending_gallery_user.get(chat_id)
-    
+        return self._data(chat_id, ChatState.GALLERY_USER)
+
     def remove_pending_gallery_user(self, chat_id):
-        return self.pending_gallery_user.pop(chat_id, None)
-    
+        return self._pop(chat_id, ChatState.GALLERY_USER)
+
     def has_pending_gallery_user(self, chat_id):
-        return chat_id in self.pending_gallery_user
-    
+        return self._has(chat_id, ChatState.GALLERY_USER)
+
     # ————— PENDING GALLERY MATTO —————
     def set_pending_gallery_matto(self, chat_id, matto_id):
-        self.pending_gallery_matto[chat_id] = matto_id
-    
+        self._set(chat_id, ChatState.GALLERY_MATTO, matto_id)
+
     def get_pending_gallery_matto(self, chat_id):
-        return self.pending_gallery_matto.get(chat_id)
-    
+        return self._data(chat_id, ChatState.GALLERY_MATTO)
+
     def remove_pending_gallery_matto(self, chat_id):
-        return self.pending_gallery_matto.pop(chat_id, None)
-    
+        return self._pop(chat_id, ChatState.GALLERY_MATTO)
+
     def has_pending_gallery_matto(self, chat_id):
-        return chat_id in self.pending_gallery_matto
-    
+        return self._has(chat_id, ChatState.GALLERY_MATTO)
+
     # ————— PENDING MANAGE USER —————
     def set_pending_manage_user(self, chat_id, user_chat_id):
-        self.pending_manage_user[chat_id] = user_chat_id
-    
+        self._set(chat_id, ChatState.MANAGE_USER, user_chat_id)
+
     def get_pending_manage_user(self, chat_id):
-        return self.pending_manage_user.get(chat_id)
-    
+        return self._data(chat_id, ChatState.MANAGE_USER)
+
     def remove_pending_manage_user(self, chat_id):
-        return self.pending_manage_user.pop(chat_id, None)
-    
+        return self._pop(chat_id, ChatState.MANAGE_USER)
+
     def has_pending_manage_user(self, chat_id):
-        return chat_id in self.pending_manage_user
-    
+        return self._has(chat_id, ChatState.MANAGE_USER)
+
     # ————— PENDING WEAPON TARGET —————
     def set_pending_weapon_target(self, chat_id, weapon_info):
-        self.pending_weapon_target[chat_id] = weapon_info
-    
+        self._set(chat_id, ChatState.AWAITING_WEAPON_TARGET, weapon_info)
+
     def get_pending_weapon_target(self, chat_id):
-        return self.pending_weapon_target.get(chat_id)
-    
+        return self._data(chat_id, ChatState.AWAITING_WEAPON_TARGET)
+
     def remove_pending_weapon_target(self, chat_id):
-        return self.pending_weapon_target.pop(chat_id, None)
-    
+        return self._pop(chat_id, ChatState.AWAITING_WEAPON_TARGET)
+
     def has_pending_weapon_target(self, chat_id):
-        return chat_id in self.pending_weapon_target
-    
+        return self._has(chat_id, ChatState.AWAITING_WEAPON_TARGET)
+
     # ————— AWAITING POINT UPDATE —————
     def set_awaiting_point_update(self, admin_chat_id, target_chat_id):
-        self.awaiting_point_update[admin_chat_id] = target_chat_id
-    
+        self._set(admin_chat_id, ChatState.AWAITING_POINT_UPDATE, target_chat_id)
+
     def get_awaiting_point_update(self, admin_chat_id):
-        return self.awaiting_point_update.get(admin_chat_id)
-    
+        return self._data(admin_chat_id, ChatState.AWAITING_POINT_UPDATE)
+
     def remove_awaiting_point_update(self, admin_chat_id):
-        return self.awaiting_point_update.pop(admin_chat_id, None)
-    
+        return self._pop(admin_chat_id, ChatState.AWAITING_POINT_UPDATE)
+
     def has_awaiting_point_update(self, admin_chat_id):
-        return admin_chat_id in self.awaiting_point_update
-    
+        return self._has(admin_chat_id, ChatState.AWAITING_POINT_UPDATE)
+
     # ————— SUGGESTION STATES —————
     def set_pending_suggestion_name(self, chat_id):
         """Imposta che l'utente deve inserire il nome del matto suggerito"""
-        self.pending_suggestion_name[chat_id] = True
-    
+        self._set(chat_id, ChatState.AWAITING_SUGGESTION_NAME)
+
     def has_pending_suggestion_name(self, chat_id):
-        return chat_id in self.pending_suggestion_name
-    
+        return self._has(chat_id, ChatState.AWAITING_SUGGESTION_NAME)
+
     def remove_pending_suggestion_name(self, chat_id):
-        return self.pending_suggestion_name.pop(chat_id, None)
-    
+        return self._pop(chat_id, ChatState.AWAITING_SUGGESTION_NAME)
+
     def set_pending_suggestion_points(self, chat_id, matto_name):
         """Imposta che l'utente deve inserire i punti per il matto suggerito"""
-        self.pending_suggestion_points[chat_id] = matto_name
-    
+        self._set(chat_id, ChatState.AWAITING_SUGGESTION_POINTS, matto_name)
+
     def get_pending_suggestion_points(self, chat_id):
-        return self.pending_suggestion_points.get(chat_id)
-    
+        return self._data(chat_id, ChatState.AWAITING_SUGGESTION_POINTS)
+
     def remove_pending_suggestion_points(self, chat_id):
-        return self.pending_suggestion_points.pop(chat_id, None)
-    
+        return self._pop(chat_id, ChatState.AWAITING_SUGGESTION_POINTS)
+
     def has_pending_suggestion_points(self, chat_id):
-        return chat_id in self.pending_suggestion_points
-    
+        return self._has(chat_id, ChatState.AWAITING_SUGGESTION_POINTS)
+
     def set_suggestion_upload_pending(self, chat_id, status=True):
         """Imposta che l'utente deve caricare un file con suggerimenti"""
         if status:
-            self.suggestion_upload_pending[chat_id] = True
+            self._set(chat_id, ChatState.AWAITING_SUGGESTION_FILE)
         else:
-            self.suggestion_upload_pending.pop(chat_id, None)
-    
+            self._pop(chat_id, ChatState.AWAITING_SUGGESTION_FILE)
+
     def is_suggestion_upload_pending(self, chat_id):
-        return chat_id in self.suggestion_upload_pending
-    
+        return self._has(chat_id, ChatState.AWAITING_SUGGESTION_FILE)
+
     def set_pending_suggestion_review(self, admin_chat_id, suggestion_id, action):
         """Imposta che l'admin deve inserire note per la review"""
-        self.pending_suggestion_review[admin_chat_id] = {
+        self._set(admin_chat_id, ChatState.AWAITING_REVIEW_NOTES, {
             "suggestion_id": suggestion_id,
             "action": action  # 'approve' o 'reject'
-        }
-    
+        })
+
     def get_pending_suggestion_review(self, admin_chat_id):
-        return self.pending_suggestion_review.get(admin_chat_id)
-    
+        return self._data(admin_chat_id, ChatState.AWAITING_REVIEW_NOTES)
+
     def remove_pending_suggestion_review(self, admin_chat_id):
-        return self.pending_suggestion_review.pop(admin_chat_id, None)
-    
+        return self._pop(admin_chat_id, ChatState.AWAITING_REVIEW_NOTES)
+
     def has_pending_suggestion_review(self, admin_chat_id):
-        return admin_chat_id in self.pending_suggestion_review
-    
+        return self._has(admin_chat_id, ChatState.AWAITING_REVIEW_NOTES)
+
+    # ————— RICERCA NELLE SELEZIONI —————
+    def set_pending_search(self, chat_id, prefix):
+        """Attende il testo da cercare; il flusso in corso (es. arma da assegnare) riprende dopo"""
+        previous = self._get(chat_id)
+        resume = None
+        if previous is not None and previous.state is not ChatState.AWAITING_SEARCH:
+            resume = [previous.state.value, previous.data]
+        elif previous is not None:
+            resume = previous.data["resume"]
+        self._set(chat_id, ChatState.AWAITING_SEARCH, {"prefix": prefix, "resume": resume})
+
+    def pop_pending_search(self, chat_id):
+        """Chiude la ricerca ripristinando il flusso precedente; restituisce il prefisso cercato"""
+        data = self._pop(chat_id, ChatState.AWAITING_SEARCH)
+        if data is None:
+            return None
+        if data["resume"]:
+            state, previous = data["resume"]
+            self._set(chat_id, ChatState(state), previous)
+        return data["prefix"]
+
     # ————— PULIZIA STATI —————
     def cleanup_all_states(self):
-        """Pulisce tutti gli stati"""
-        self.pending_matto.clear()
-        self.pending_password.clear()
-        self.admin_upload_pending = False
-        self.pending_gallery_user.clear()
-        self.pending_gallery_matto.clear()
-        self.pending_manage_user.clear()
-        self.pending_weapon_target.clear()
-        self.awaiting_point_update.clear()
-        
-        # Pulizia stati suggerimenti
-        self.pending_suggestion_name.clear()
-        self.pending_suggestion_points.clear()
-        self.suggestion_upload_pending.clear()
-        self.pending_suggestion_review.clear()
-        
-        logger.info("Stati del bot puliti")
+        """Pulisce tutti gli stati; con un backend persistente li salva invece di perderli"""
+        self.backend.close()
+        with self.lock:
+            self.sessions.clear()
+
+        if self.backend.durable:
+            logger.info("Stati del bot salvati")
+        else:
+            logger.info("Stati del bot puliti")
 
 # Istanza globale del gestore stati
-state_manager = StateManager()
+state_manager = StateManager(create_state_backend())
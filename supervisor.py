@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Modalità supervisore: un processo fa il long polling e smista ogni update a uno
+di N processi worker scelto con chat_id % N, così gli update di una stessa chat
+sono elaborati in ordine dallo stesso worker.
+
+Lo stato condiviso passa dal database: le sessioni usano il backend "sqlite",
+le cache dei worker si invalidano quando un altro processo modifica utenti,
+matti o segnalazioni e l'outbox è consegnato solo dal supervisore.
+
+SIGTERM ferma supervisore e worker come un Ctrl+C.
+"""
+
+import os
+import time
+import signal
+import logging
+import multiprocessing
+from queue import Full
+from telebot import TeleBot, apihelper, types
+
+from config import BOT_TOKEN
+
+logger = logging.getLogger(__name__)
+
+POLL_TIMEOUT = 20  # secondi di long polling per chiamata a getUpdates
+POLL_LIMIT = 100
+ERROR_DELAY = 3  # secondi di attesa dopo un errore di rete
+QUEUE_SIZE = 1000  # update in coda per worker prima che il polling rallenti
+WORKER_MIN_UPTIME = 10  # secondi: un worker che cade prima è considerato fallito all'avvio
+RESTART_DELAY = 1  # secondi di attesa dopo il primo avvio fallito, raddoppiati a ogni fallimento
+RESTART_MAX_DELAY = 60
+MAX_FAST_FAILURES = 5  # avvii falliti consecutivi dopo cui il supervisore si ferma
+
+class WorkerStartupError(RuntimeError):
+    """Un worker continua a cadere subito dopo l'avvio"""
+
+def update_chat_id(update):
+    """chat_id a cui appartiene un update grezzo, o None"""
+    for key in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if key in update:
+            return update[key]["chat"]["id"]
+    call = update.get("callback_query")
+    if call:
+        # Gli handler delle callback lavorano su from_user.id
+        return call["from"]["id"]
+    for key in ("inline_query", "chosen_inline_result", "shipping_query", "pre_checkout_query",
+                "poll_answer", "my_chat_member", "chat_member", "chat_join_request"):
+        if key in update:
+            sender = update[key].get("from") or update[key].get("user") or update[key].get("chat")
+            if sender:
+                return sender["id"]
+    return None
+
+def _interrupt(signum, frame):
+    # SIGTERM (es. docker stop, systemd) gestito come un Ctrl+C
+    raise KeyboardInterrupt
+
+def worker_main(index, workers, queue):
+    """Processo worker: elabora in ordine gli update della propria coda"""
+    # Import qui: nel processo figlio (spawn) i moduli vengono caricati da zero
+    from database import db_manager
+    from states import state_manager
+    from broadcast import broadcast_engine, GLOBAL_RATE
+    from main import register_handlers
+
+    signal.signal(signal.SIGTERM, _interrupt)
+    db_manager.enable_shared_mode()
+    # Il limite globale di Telegram è diviso tra i worker e il supervisore
+    broadcast_engine.set_global_rate(GLOBAL_RATE / (workers + 1))
+
+    # threaded=False: un update alla volta, nell'ordine di arrivo
+    bot = TeleBot(BOT_TOKEN, threaded=False)
+    register_handlers(bot, lambda handler: lambda update: handler(bot, update))
+    logger.info(f"Worker {index} avviato (pid {os.getpid()})")
+
+    try:
+        while True:
+            raw = queue.get()
+            if raw is None:
+                break
+            try:
+                bot.process_new_updates([types.Update.de_json(raw)])
+            except Exception as e:
+                logger.error(f"Worker {index}: errore nell'update {raw.get('update_id')}: {str(e)}")
+    except KeyboardInterrupt:
+        pass
+    finally:
+        broadcast_engine.shutdown()
+        state_manager.cleanup_all_states()
+        db_manager.close()
+        logger.info(f"Worker {index} fermato")
+
+class Supervisor:
+    """Fa il polling degli update e li distribuisce ai processi worker"""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.context = multiprocessing.get_context("spawn")
+        self.queues = [self.context.Queue(QUEUE_SIZE) for _ in range(workers)]
+        self.processes = [None] * workers
+        self.started_at = [0.0] * workers
+        self.fast_failures = [0] * workers
+        self.restart_at = [None] * workers  # riavvio programmato (time.monotonic) dei worker caduti
+        self.offset = None
+        self.running = False
+
+    def _start_worker(self, index):
+        proc = self.context.Process(
+            target=worker_main, args=(index, self.workers, self.queues[index]),
+            name=f"bot-worker-{index}", daemon=True
+        )
+        proc.start()
+        self.processes[index] = proc
+        self.started_at[index] = time.monotonic()
+
+    def _check_workers(self):
+        # Un worker caduto viene riavviato sulla stessa coda, senza perdere gli update in attesa.
+        # Se cade subito dopo l'avvio (token, database, import) il riavvio è ritardato con un
+        # backoff esponenziale; dopo MAX_FAST_FAILURES avvii falliti di fila il supervisore si ferma
+        now = time.monotonic()
+        for index, proc in enumerate(self.processes):
+            if proc.is_alive():
+                continue
+            if self.restart_at[index] is None:
+                if now - self.started_at[index] < WORKER_MIN_UPTIME:
+                    self.fast_failures[index] += 1
+                else:
+                    self.fast_failures[index] = 0
+                failures = self.fast_failures[index]
+                if failures >= MAX_FAST_FAILURES:
+                    raise WorkerStartupError(
+                        f"Worker {index} terminato {failures} volte subito dopo l'avvio (exit {proc.exitcode})"
+                    )
+                delay = min(RESTART_DELAY * 2 ** (failures - 1), RESTART_MAX_DELAY) if failures else 0
+                self.restart_at[index] = now + delay
+                logger.error(f"Worker {index} terminato (exit {proc.exitcode}), riavvio tra {delay} s")
+            if now >= self.restart_at[index]:
+                self.restart_at[index] = None
+                self._start_worker(index)
+
+    def dispatch(self, update):
+        chat_id = update_chat_id(update)
+        key = chat_id if chat_id is not None else update["update_id"]
+        queue = self.queues[key % self.workers]
+        while True:
+            try:
+                queue.put(update, timeout=1)
+                return
+            except Full:
+                # Coda piena: il worker potrebbe essere caduto e in attesa di riavvio
+                self._check_workers()
+
+    def poll_once(self):
+        updates = apihelper.get_updates(
+            BOT_TOKEN, offset=self.offset, limit=POLL_LIMIT, timeout=POLL_TIMEOUT,
+            long_polling_timeout=POLL_TIMEOUT
+        )
+        for update in updates:
+            self.dispatch(update)
+            self.offset = update["update_id"] + 1
+        return len(updates)
+
+    def run(self):
+        from database import db_manager
+        from broadcast import broadcast_engine, GLOBAL_RATE
+        from outbox import outbox_dispatcher
+
+        # Le sessioni devono essere condivise tra i processi e sopravvivere ai riavvii
+        os.environ["STATE_BACKEND"] = "sqlite"
+
+        db_manager.init_db()
+        db_manager.upgrade_db()
+        db_manager.enable_shared_mode()
+        broadcast_engine.set_global_rate(GLOBAL_RATE / (self.workers + 1))
+
+        for index in range(self.workers):
+            self._start_worker(index)
+
+        bot = TeleBot(BOT_TOKEN, threaded=False)
+        bot.remove_webhook()
+        outbox_dispatcher.start(bot)
+
+        logger.info(f"Supervisore avviato con {self.workers} worker – in attesa di comandi.")
+        self.running = True
+        signal.signal(signal.SIGTERM, self._terminate)
+        try:
+            while self.running:
+                self._check_workers()
+                try:
+                    self.poll_once()
+                except WorkerStartupError:
+                    raise
+                except Exception as e:
+                    logger.error(f"Errore nel polling: {str(e)}")
+                    time.sleep(ERROR_DELAY)
+        finally:
+            self.stop()
+
+    def _terminate(self, signum, frame):
+        # Come un Ctrl+C, ma solo una volta: un secondo SIGTERM non interrompe stop()
+        if self.running:
+            self.running = False
+            raise KeyboardInterrupt
+
+    def stop(self, timeout=30):
+        """Chiude le code e attende che i worker finiscano gli update già ricevuti"""
+        self.running = False
+        for index, proc in enumerate(self.processes):
+            if proc is not None and proc.is_alive():
+                self.queues[index].put(None)
+        for proc in self.processes:
+            if proc is not None:
+                proc.join(timeout)
+                if proc.is_alive():
+                    proc.terminate()
+        self.processes = [None] * self.workers
+
+def run(workers):
+    Supervisor(workers).run()
@@ -1,9 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import tempfile
 import os
+import codecs
+import io
+import csv
+import json
+import re
 import logging
+import requests
+from telebot import apihelper
 
 logger = logging.getLogger(__name__)
 
@@ -35,47 +41,218 @@ def escape_markdown_v1(text):
             escaped_text.append(char)
     return ''.join(escaped_text)
 
-def parse_matti_file_content(content):
-    """Parsa il contenuto del file matti e restituisce una lista di tuple (nome, punti)"""
-    lines = [ln.strip() for ln in content.split('\n') if ln.strip()]
-    
-    parsed = []
-    seen_names = set()  # Per evitare duplicati esatti
-    
-    for ln in lines:
-        if ',' not in ln:
-            logger.warning(f"Riga malformata, salto: {ln}")
-            continue
-        
-        try:
-            nome = ln.split(',', 1)[0].strip()
-            pts = int(ln.split(',', 1)[1].strip())
-            
-            # Controlla se il nome esatto è già stato processato
-            if nome in seen_names:
-                logger.warning(f"Nome duplicato esatto, salto: {nome}")
-                continue
-                
-            parsed.append((nome, pts))
-            seen_names.add(nome)
-            
-        except ValueError:
-            logger.warning(f"Riga malformata, salto: {ln}")
-    
-    return parsed
+# ————— PARSING FILE MATTI —————
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # byte letti per volta dal download
+DOWNLOAD_TIMEOUT = (10, 30)  # secondi per la connessione e tra due blocchi ricevuti
+DOWNLOAD_MAX_BYTES = 20 * 1024 * 1024  # limite dei download dei bot di Telegram
+PARSE_BATCH_SIZE = 500  # righe valide per blocco
+MAX_REPORTED_ERRORS = 20  # righe scartate conservate nel rapporto
+
+class ParseReport:
+    """Esito del parsing: righe lette, righe valide e righe scartate (riga, motivo).
+
+    Conserva solo le prime MAX_REPORTED_ERRORS righe scartate, le altre sono
+    solo contate: la memoria non cresce con la dimensione del file.
+    """
+
+    def __init__(self):
+        self.lines = 0
+        self.valid = 0
+        self.rejected = 0
+        self.errors = []
 
-def create_temp_file_from_content(content):
-    """Crea un file temporaneo dal contenuto e restituisce il path"""
-    with tempfile.NamedTemporaryFile(mode="w", delete=False, encoding="utf-8") as tmp:
-        tmp.write(content)
-        return tmp.name
+    def reject(self, line_no, reason):
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line_no, reason))
 
-def cleanup_temp_file(filepath):
-    """Rimuove un file temporaneo"""
+    def summary(self):
+        """Elenco testuale delle righe scartate, vuoto se non ce ne sono"""
+        if not self.rejected:
+            return ""
+        lines = [f"⚠️ {self.rejected} righe scartate:"]
+        lines.extend(f"• riga {line_no}: {reason}" for line_no, reason in self.errors)
+        if self.rejected > len(self.errors):
+            lines.append(f"• … e altre {self.rejected - len(self.errors)}")
+        return "\n".join(lines)
+
+# Formati accettati per l'import del catalogo: estensione → formato
+IMPORT_FORMATS = {".txt": "txt", ".csv": "csv", ".tsv": "tsv", ".json": "json"}
+HEADER_NAMES = {"name", "nome"}  # prima colonna di un'eventuale riga di intestazione
+
+JSON_SPACE_RE = re.compile(r"\s*")
+JSON_MAX_ITEM_CHARS = 64 * 1024  # un elemento più lungo non è un matto: il file non è valido
+JSON_TOKEN_TAIL = 8  # caratteri finali che possono essere un token troncato (es. "fals", "\\u00e")
+
+def import_format(file_name):
+    """Formato di import dal nome del file, o None se non è supportato"""
+    return IMPORT_FORMATS.get(os.path.splitext(file_name or "")[1].lower())
+
+def parse_matto_record(fields):
+    """(nome, punti) da una riga già divisa in campi o da un oggetto JSON; ValueError con il motivo"""
+    if isinstance(fields, dict):
+        name = fields.get("name", fields.get("nome"))
+        points = fields.get("points", fields.get("punti"))
+    elif isinstance(fields, list) and len(fields) == 2:
+        name, points = fields
+    elif isinstance(fields, list) and len(fields) == 1:
+        raise ValueError("manca il separatore tra nome e punti")
+    elif isinstance(fields, list):
+        raise ValueError(f"attesi 2 campi, trovati {len(fields)}")
+    else:
+        raise ValueError("atteso un oggetto con nome e punti")
+
+    if not isinstance(name, str) or not name.strip():
+        raise ValueError("nome mancante")
+    if isinstance(points, int) and not isinstance(points, bool):
+        return name.strip(), points
     try:
-        os.unlink(filepath)
-    except Exception as e:
-        logger.warning(f"Errore nella rimozione del file temporaneo {filepath}: {e}")
+        return name.strip(), int(points.strip())
+    except (AttributeError, ValueError):
+        raise ValueError(f"punti non validi: {str(points).strip()[:20]!r}") from None
+
+def _decoded(chunks):
+    # Testo decodificato un blocco alla volta (il BOM iniziale viene scartato)
+    decoder = codecs.getincrementaldecoder("utf-8-sig")()
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+def _lines(texts):
+    pending = ""
+    for text in texts:
+        pending += text
+        *complete, pending = pending.split("\n")
+        yield from complete
+    if pending:
+        yield pending
+
+def _text_records(texts):
+    for line_no, line in enumerate(_lines(texts), 1):
+        if line.strip():
+            yield line_no, line.split(",", 1)
+
+def _delimited_records(texts, delimiter):
+    reader = csv.reader(_lines(texts), delimiter=delimiter)
+    for row in reader:
+        if any(field.strip() for field in row):
+            yield reader.line_num, row
+
+def _json_error(buf, pos, error):
+    # Motivo di un errore di raw_decode, o None se può dipendere dal testo non ancora arrivato
+    if len(buf) - pos > JSON_MAX_ITEM_CHARS:
+        return f"elemento JSON più lungo di {JSON_MAX_ITEM_CHARS} caratteri"
+    if error.msg.startswith("Unterminated string") or error.pos >= len(buf) - JSON_TOKEN_TAIL:
+        return None
+    return f"JSON non valido ({error.msg})"
+
+def _json_records(texts, report):
+    """Elementi di una lista JSON letti man mano che arriva il testo, con la riga di inizio.
+
+    Solo l'elemento incompleto resta nel buffer, al massimo JSON_MAX_ITEM_CHARS
+    caratteri. Un elemento non valido è registrato nel report e ferma la
+    lettura; un file che non è una lista interrompe l'import con ValueError.
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, line_no, state = "", 0, 1, "start"
+    for text in texts:
+        buf, pos = buf[pos:] + text, 0
+        while True:
+            end = JSON_SPACE_RE.match(buf, pos).end()
+            line_no += buf.count("\n", pos, end)
+            pos = end
+            if pos >= len(buf):
+                break
+            char = buf[pos]
+            if state == "start":
+                if char != "[":
+                    raise ValueError("il file JSON deve contenere una lista")
+                state = "item"
+                pos += 1
+            elif state == "item" and char != "]":
+                try:
+                    item, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError as e:
+                    reason = _json_error(buf, pos, e)
+                    if reason is None:
+                        break  # elemento incompleto: serve altro testo
+                    report.reject(line_no + buf.count("\n", pos, e.pos), f"{reason}, lettura interrotta")
+                    return
+                yield line_no, item
+                line_no += buf.count("\n", pos, end)
+                pos = end
+                state = "next"
+            elif state in ("item", "next") and char == "]":
+                state = "end"
+                pos += 1
+            elif state == "next" and char == ",":
+                state = "item"
+                pos += 1
+            else:
+                raise ValueError(f"JSON non valido alla riga {line_no}")
+    if state != "end":
+        raise ValueError(f"JSON incompleto o non valido alla riga {line_no}")
+
+def parse_matti_stream(chunks, report, batch_size=PARSE_BATCH_SIZE, fmt="txt"):
+    """Legge matti (nome, punti) da blocchi di byte e restituisce blocchi di tuple valide.
+
+    fmt è uno dei valori di IMPORT_FORMATS: righe 'nome, punti', CSV, TSV o
+    una lista JSON di oggetti {"name", "points"} o coppie [nome, punti]. Il
+    testo è decodificato un blocco alla volta; i duplicati non sono filtrati
+    qui, li scarta il database durante l'import.
+    """
+    texts = _decoded(chunks)
+    if fmt == "json":
+        records = _json_records(texts, report)
+    elif fmt in ("csv", "tsv"):
+        records = _delimited_records(texts, "," if fmt == "csv" else "\t")
+    else:
+        records = _text_records(texts)
+
+    batch = []
+    first = True
+    for line_no, fields in records:
+        report.lines = line_no
+        try:
+            batch.append(parse_matto_record(fields))
+        except ValueError as e:
+            # Un'intestazione in prima riga non è un errore
+            header = first and isinstance(fields, list) and fields[0].strip().lower() in HEADER_NAMES
+            if not header:
+                report.reject(line_no, str(e))
+            continue
+        finally:
+            first = False
+        report.valid += 1
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def download_chunks(token, file_path, chunk_size=DOWNLOAD_CHUNK_SIZE, max_bytes=DOWNLOAD_MAX_BYTES):
+    """Scarica un file di Telegram a blocchi, senza tenerlo tutto in memoria.
+
+    Un download fermo per più di DOWNLOAD_TIMEOUT secondi solleva un errore di
+    requests; un file più grande di max_bytes solleva ValueError.
+    """
+    url = (apihelper.FILE_URL or "https://api.telegram.org/file/bot{0}/{1}").format(token, file_path)
+    too_large = f"file troppo grande (massimo {max_bytes // (1024 * 1024)} MB)"
+    with requests.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT, proxies=apihelper.proxy) as response:
+        if response.status_code != 200:
+            raise apihelper.ApiHTTPException("Download file", response)
+        if int(response.headers.get("Content-Length") or 0) > max_bytes:
+            raise ValueError(too_large)
+        received = 0
+        for chunk in response.iter_content(chunk_size):
+            received += len(chunk)
+            if received > max_bytes:
+                raise ValueError(too_large)
+            yield chunk
 
 def format_username(username=None, first_name=None, chat_id=None):
     """Formatta il nome utente per la visualizzazione (senza escape markdown)"""
@@ -134,12 +311,57 @@ def get_media_emoji(media_type):
     """Restituisce l'emoji appropriato per il tipo di media"""
     return "📹" if media_type == "video" else "📸"
 
-def format_media_type_text(media_type):
-    """Restituisce il testo descrittivo per il tipo di media"""
-    return "video" if media_type == "video" else "foto"
+def build_sighting_text(user_info, matto_name, points, total_points, media_type):
+    """Testo dell'annuncio di una segnalazione (senza Markdown)"""
+    return (
+        f"{get_media_emoji(media_type)} {user_info} ha trovato il matto {matto_name} ➕ {points} punti\n"
+        f"🏅 Ora ha {total_points} punti."
+    )
+
+def build_sighting_caption(user_info, matto_name, points):
+    """Didascalia breve del media quando l'annuncio è inviato separatamente"""
+    return (
+        f"Segnalato da: {user_info}\n"
+        f"Matto: {matto_name} ({points} punti)"
+    )
+
+def build_weapon_text(finder_name, weapon_name, target_name, damage):
+    """Testo dell'annuncio di un'arma usata (Markdown v1)"""
+    finder_name = escape_markdown_v1(finder_name)
+    weapon_name = escape_markdown_v1(weapon_name)
+    target_name = escape_markdown_v1(target_name)
+    return (
+        f"💥 *{finder_name}* ha usato l'arma *{weapon_name}* contro *{target_name}*!\n"
+        f"🔥 {target_name} perde *{damage} punti*!"
+    )
 
-def save_text_to_temp_file(text, suffix=".txt"):
-    """Salva del testo in un file temporaneo e restituisce il path"""
-    with tempfile.NamedTemporaryFile(mode="w", delete=False, suffix=suffix, encoding="utf-8") as tmp:
-        tmp.write(text)
-        return tmp.name
+def text_to_buffer(text):
+    """Testo come file in memoria, da inviare con send_document senza passare dal disco"""
+    return io.BytesIO(text.encode("utf-8"))
+
+# ————— EXPORT CLASSIFICA —————
+EXPORT_FORMATS = ("csv", "json")
+EXPORT_FIELDS = ("position", "chat_id", "username", "first_name", "total_points")
+
+def _export_record(position, row):
+    return (position, row["chat_id"], row["username"] or "", row["first_name"] or "", row["total_points"])
+
+def export_leaderboard(rows, fmt="csv"):
+    """Scrive le righe della classifica, man mano che arrivano, in un buffer in memoria (csv o json)"""
+    buf = io.BytesIO()
+    out = io.TextIOWrapper(buf, encoding="utf-8", newline="")
+    if fmt == "json":
+        out.write("[")
+        for position, row in enumerate(rows, 1):
+            record = dict(zip(EXPORT_FIELDS, _export_record(position, row)))
+            out.write(("," if position > 1 else "") + "\n  " + json.dumps(record, ensure_ascii=False))
+        out.write("\n]\n")
+    else:
+        writer = csv.writer(out)
+        writer.writerow(EXPORT_FIELDS)
+        for position, row in enumerate(rows, 1):
+            writer.writerow(_export_record(position, row))
+    out.flush()
+    out.detach()
+    buf.seek(0)
+    return buf
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Ricezione degli update via webhook con un server HTTP integrato.
+
+Per provarlo in locale si possono rispedire update registrati:
+    python webhook.py update.json [http://127.0.0.1:8443/webhook]
+"""
+
+import hmac
+import json
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Event
+from urllib import request as urlrequest
+from telebot import types
+
+from config import WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_WORKERS
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_BODY_SIZE = 1024 * 1024  # gli update Telegram sono ben sotto il mega
+
+class WebhookRequestHandler(BaseHTTPRequestHandler):
+    """Valida e accoda un update; risponde subito a Telegram senza aspettare l'handler"""
+
+    def do_POST(self):
+        server = self.server.webhook
+        if self.path != server.path:
+            return self._reply(404)
+        if not hmac.compare_digest(self.headers.get(SECRET_HEADER, ""), server.secret):
+            logger.warning(f"Update webhook rifiutato: secret token non valido da {self.client_address[0]}")
+            return self._reply(403)
+
+        length = int(self.headers.get("Content-Length") or 0)
+        if not 0 < length <= MAX_BODY_SIZE:
+            return self._reply(413 if length else 400)
+        try:
+            update = types.Update.de_json(self.rfile.read(length).decode("utf-8"))
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Update webhook non valido: {str(e)}")
+            return self._reply(400)
+
+        if not server.submit(update):
+            # In chiusura: Telegram ritenterà la consegna più tardi
+            return self._reply(503)
+        self._reply(200)
+
+    def _reply(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+class WebhookServer:
+    """Server HTTP che inoltra gli update a un pool di worker del bot"""
+
+    def __init__(self, bot, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                 secret=WEBHOOK_SECRET, workers=WEBHOOK_WORKERS):
+        # Senza secret chiunque conosca l'URL potrebbe inviare update falsi, anche a nome dell'admin
+        if not secret:
+            raise ValueError("WEBHOOK_SECRET mancante: la modalità webhook richiede un secret token")
+        self.bot = bot
+        self.path = path
+        self.secret = secret
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webhook")
+        self.accepting = True
+        self.lock = Lock()
+        self.stopped = Event()
+        self.httpd = ThreadingHTTPServer((host, port), WebhookRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.webhook = self
+
+    @property
+    def address(self):
+        return self.httpd.server_address
+
+    def submit(self, update):
+        with self.lock:
+            if not self.accepting:
+                return False
+            self.executor.submit(self._process, update)
+            return True
+
+    def _process(self, update):
+        try:
+            self.bot.process_new_updates([update])
+        except Exception as e:
+            logger.error(f"Errore nell'elaborazione dell'update {update.update_id}: {str(e)}")
+
+    def serve_forever(self):
+        host, port = self.address[:2]
+        logger.info(f"Webhook in ascolto su http://{host}:{port}{self.path}")
+        self.httpd.serve_forever()
+
+    def stop(self):
+        """Smette di accettare update e attende quelli già in elaborazione.
+
+        Si può chiamare più volte e da più thread: ogni chiamata ritorna solo
+        quando il server è fermo e gli update in corso sono completati.
+        """
+        with self.lock:
+            first = self.accepting
+            self.accepting = False
+        if not first:
+            self.stopped.wait()
+            return
+        try:
+            self.httpd.shutdown()
+            self.httpd.server_close()
+            self.executor.shutdown(wait=True)
+            logger.info("Webhook fermato, update in corso completati")
+        finally:
+            self.stopped.set()
+
+def post_update(update, url, secret=WEBHOOK_SECRET):
+    """Invia un update registrato al webhook come farebbe Telegram; restituisce lo status HTTP"""
+    req = urlrequest.Request(url, data=json.dumps(update).encode("utf-8"), method="POST",
+                             headers={"Content-Type": "application/json", SECRET_HEADER: secret})
+    try:
+        with urlrequest.urlopen(req) as resp:
+            return resp.status
+    except urlrequest.HTTPError as e:
+        return e.code
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Uso: python webhook.py <update.json> [url]")
+        sys.exit(2)
+    with open(sys.argv[1], encoding="utf-8") as f:
+        recorded = json.load(f)
+    target = sys.argv[2] if len(sys.argv) > 2 else f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    for upd in recorded if isinstance(recorded, list) else [recorded]:
+        print(upd.get("update_id"), post_update(upd, target))